@@ -1,8 +1,22 @@
 import os
-import openai
+import importlib.util
+import httpx
 import json
+import hashlib
+import logging
+import time
 from typing import List, Dict, Optional, Any
 
+from .resilience import Resilience, UpstreamError, CircuitOpenError, counts_against_budget, retry_after_seconds
+from .pool import ProviderPool, ProviderKey
+from .codec import loads
+from .lazy import lazy_import
+
+# The SDK takes a while to import and is only needed once a completion is sent
+openai = lazy_import("openai")
+
+logger = logging.getLogger(__name__)
+
 # # print the openai module version
 # print(f"OpenAI Version: {openai.__version__}")
 class CostCalculator:
@@ -30,12 +44,14 @@ class Prompt:
     def __init__(self , system_content , user_content):
         self.system_content = system_content
         self.user_content = user_content
+        # Built once, the budget, the cache key and the request all read the same list
+        self.messages = [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": user_content}
+        ]
         
     def get_messages(self) -> list: 
-        return [
-            {"role": "system", "content": self.system_content},
-            {"role": "user", "content": self.user_content}
-        ]
+        return self.messages
 
 class Function: 
     name: str
@@ -52,10 +68,9 @@ class Function:
         self.required = required 
         self.strict = strict
         self.additional_properties = additional_properties
-    
-    
-    def get_dict(self): 
-        function_dict = {
+        # The schema is compiled once: the dict handed to the SDK, its compact JSON for token
+        # counting, and a digest of that JSON for cache keys
+        self.schema = {
           "name": self.name,
           "description": self.description,
           "strict": self.strict,
@@ -66,30 +81,172 @@ class Function:
             "additionalProperties": self.additional_properties
           }
         }
-        
-        return function_dict
+        self.schema_json = json.dumps(self.schema , separators=(",", ":") , sort_keys=True , ensure_ascii=False)
+        self.schema_bytes = self.schema_json.encode("utf-8")
+        self.fingerprint = hashlib.sha256(self.schema_bytes).hexdigest()
+    
+    
+    def get_dict(self): 
+        return self.schema
+
+    def conform(self , arguments):
+        # The arguments with loosely typed values coerced to the schema's types (a "string"
+        # confidence sent as 8 becomes "8"), or None when a required field is missing or a
+        # value cannot be read as its type
+        if not isinstance(arguments , dict):
+            return None
+        conformed = dict(arguments)
+        for name , spec in self.properties.items():
+            value = conformed.get(name)
+            if value is None:
+                if name in self.required:
+                    return None
+                continue
+            coerce = COERCIONS.get(spec.get("type"))
+            if coerce is not None:
+                try:
+                    conformed[name] = coerce(value)
+                except (TypeError , ValueError):
+                    return None
+        return conformed
+
+def coerce_string(value):
+    if isinstance(value , str):
+        return value
+    if isinstance(value , bool):
+        return "true" if value else "false"
+    if isinstance(value , (int , float)):
+        return str(value)
+    raise TypeError(f"expected a string, got {type(value).__name__}")
+
+def coerce_integer(value):
+    if isinstance(value , bool):
+        raise TypeError("expected an integer, got a boolean")
+    if isinstance(value , int):
+        return value
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(f"expected an integer, got {value}")
+    return int(number)
+
+def coerce_number(value):
+    if isinstance(value , bool):
+        raise TypeError("expected a number, got a boolean")
+    if isinstance(value , (int , float)):
+        return value
+    return float(value)
+
+def coerce_boolean(value):
+    if isinstance(value , bool):
+        return value
+    if isinstance(value , str) and value.strip().lower() in ("true" , "false"):
+        return value.strip().lower() == "true"
+    raise TypeError(f"expected a boolean, got {value!r}")
+
+def coerce_type(kind):
+    def coerce(value):
+        if not isinstance(value , kind):
+            raise TypeError(f"expected {kind.__name__}, got {type(value).__name__}")
+        return value
+    return coerce
+
+COERCIONS = {
+    "string" : coerce_string ,
+    "integer" : coerce_integer ,
+    "number" : coerce_number ,
+    "boolean" : coerce_boolean ,
+    "array" : coerce_type(list) ,
+    "object" : coerce_type(dict) ,
+}
 
 class Response: 
     successful : bool
     #response_dict : dict
-    structured_arguments : dict
+    # The function-call arguments as JSON bytes, when the response came with them. Cache hits
+    # are only decoded if something reads structured_arguments
+    raw_arguments : Optional[bytes] = None
+    _structured_arguments : Optional[dict] = None
     input_tokens: int
     output_tokens: int
     cost: int
     model : Model
+    cached : bool = False
+    # Which path produced the result: "model", "cache" or "local"
+    source : str = "model"
+    parse_seconds : float = 0.0
 
     def __init__(self , model , response):
         self.model = model
         arguments = response.choices[0].message.function_call.arguments
-        self.structured_arguments = json.loads(arguments)
+        started = time.perf_counter()
+        self.structured_arguments = loads(arguments)
+        self.raw_arguments = arguments.encode("utf-8")
+        self.parse_seconds = time.perf_counter() - started
         usage = response.usage
         self.input_tokens = usage.prompt_tokens
         self.output_tokens = usage.completion_tokens
         self.cost = CostCalculator.calculate_cost(self.input_tokens , self.output_tokens , self.model.cost_per_thousand_input , self.model.cost_per_thousand_output)
 
+    @property
+    def structured_arguments(self) -> dict:
+        if self._structured_arguments is None and self.raw_arguments is not None:
+            self._structured_arguments = loads(self.raw_arguments)
+        return self._structured_arguments
+
+    @structured_arguments.setter
+    def structured_arguments(self , value): 
+        self._structured_arguments = value
+
+    @classmethod
+    def from_cache(cls , model , structured_arguments = None , raw_arguments = None): 
+        # A cache hit never reaches the provider, so it costs no tokens
+        response = cls.__new__(cls)
+        response.model = model
+        response.structured_arguments = structured_arguments
+        response.raw_arguments = raw_arguments
+        response.input_tokens = 0
+        response.output_tokens = 0
+        response.cost = 0
+        response.cached = True
+        response.source = "cache"
+        return response
+
+    @classmethod
+    def from_local(cls , model , structured_arguments): 
+        # Answered by a local classifier, no tokens billed
+        response = cls.from_cache(model , structured_arguments)
+        response.cached = False
+        response.source = "local"
+        return response
+
+    @classmethod
+    def from_stream(cls , model , arguments , prompt_tokens , completion_tokens): 
+        response = cls.__new__(cls)
+        response.model = model
+        response.structured_arguments = loads(arguments)
+        response.input_tokens = prompt_tokens
+        response.output_tokens = completion_tokens
+        response.cost = CostCalculator.calculate_cost(prompt_tokens , completion_tokens , model.cost_per_thousand_input , model.cost_per_thousand_output)
+        return response
+
+    @classmethod
+    def combine(cls , model , structured_arguments , responses): 
+        # One result assembled from several completions, e.g. the chunks of a long document
+        response = cls.__new__(cls)
+        response.model = model
+        response.structured_arguments = structured_arguments
+        response.input_tokens = sum(part.input_tokens for part in responses)
+        response.output_tokens = sum(part.output_tokens for part in responses)
+        response.cost = sum(part.cost for part in responses)
+        response.cached = all(part.cached for part in responses)
+        response.source = "cache" if response.cached else "model"
+        return response
+
     def get_dict(self): 
         return {
             "structured_arguments" : self.structured_arguments , 
+            "cached" : self.cached , 
+            "source" : self.source , 
             "input_tokens" : self.input_tokens , 
             "output_tokens" : self.output_tokens , 
             "cost_in_dollors" : self.cost , 
@@ -97,33 +254,252 @@ class Response:
         }
 
     def log(self): 
-        print(self.get_dict())
+        logger.debug("completion", extra={"fields": self.get_dict()})
     
 
+# Defaults for the shared HTTP connection pool, overridable via "http_pool" in config.json
+DEFAULT_POOL_SETTINGS = {
+    "max_connections": 200,
+    "max_keepalive_connections": 100,
+    "keepalive_expiry": 30.0,
+    "http2": True,
+    "connect_timeout": 5.0,
+    "read_timeout": 60.0,
+    "write_timeout": 10.0,
+    "pool_timeout": 10.0,
+}
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+def pool_snapshot(http_client) -> Dict[str, int]:
+    # httpx does not publish pool statistics, so read them off the httpcore pool when it is there
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", None) or [])
+    requests = list(getattr(pool, "_requests", None) or [])
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {
+        "connections": len(connections),
+        "idle": idle,
+        "active": len(connections) - idle,
+        "waiting": sum(1 for request in requests if getattr(request, "connection", None) is None),
+    }
+
 class AIClient: 
     model : Model
     
-    def __init__(self , model , api_key):
+    def __init__(self , model , api_key , pool_settings: Optional[dict] = None , base_url: Optional[str] = None , resilience_settings: Optional[dict] = None , api_keys: Optional[List[str]] = None):
         self.model = model
         self.api_key = api_key
+        # None means the provider's default endpoint, set it to point at a proxy or a local stand-in
+        self.base_url = base_url
         openai.api_key = self.api_key
+        self.pool_settings = {**DEFAULT_POOL_SETTINGS, **(pool_settings or {})}
+        self.requests_sent = 0
+        # Retries, hedging and circuit breaking live here, so the SDK's own retries are turned off
+        self.resilience = Resilience(resilience_settings)
+        # Every key gets its own SDK client, all of them share one HTTP connection pool
+        self.providers = ProviderPool(api_keys or [api_key])
+        self._http_client = None
+        self._async_http_client = None
+        self._clients = {}
+        self._async_clients = {}
+        self._pid = None
 
     def set_model(self, model: Model): self.model = model
     def set_api_key(self, api_key) : 
         self.api_key = api_key
         openai.api_key = self.api_key
+        self.providers = ProviderPool([api_key])
+        self._reset_clients()
 
-    def chat(self , prompt: Prompt , function: Function , temperature=0.7 , max_tokens = 512): 
-        client = openai.OpenAI(
-            api_key=self.api_key
-        )
-        response = client.chat.completions.create(
-        model=self.model.name,
+    def _reset_clients(self):
+        self._http_client = None
+        self._async_http_client = None
+        self._clients = {}
+        self._async_clients = {}
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # Connections inherited across a fork belong to the parent, start a fresh pool in the child
+        if self._pid != os.getpid():
+            self._reset_clients()
+
+    def _count_request(self, request):
+        self.requests_sent += 1
+
+    async def _count_request_async(self, request):
+        self.requests_sent += 1
+
+    def _http_kwargs(self) -> dict:
+        settings = self.pool_settings
+        return {
+            "limits": httpx.Limits(
+                max_connections=settings["max_connections"],
+                max_keepalive_connections=settings["max_keepalive_connections"],
+                keepalive_expiry=settings["keepalive_expiry"],
+            ),
+            "timeout": httpx.Timeout(
+                connect=settings["connect_timeout"],
+                read=settings["read_timeout"],
+                write=settings["write_timeout"],
+                pool=settings["pool_timeout"],
+            ),
+            "http2": bool(settings["http2"]) and http2_available(),
+        }
+
+    def warm_up(self):
+        # Imports the SDK and the resources it loads on first use. No connection is opened, and a
+        # forked worker builds its own clients anyway (see _check_pid)
+        openai.AsyncOpenAI(api_key=self.api_key or "warm-up", base_url=self.base_url, max_retries=0).chat.completions
+
+    def get_client(self , key: Optional[ProviderKey] = None) -> "openai.OpenAI":
+        self._check_pid()
+        key = key or self.providers.keys[0]
+        client = self._clients.get(key.name)
+        if client is None:
+            if self._http_client is None:
+                self._http_client = httpx.Client(event_hooks={"request": [self._count_request]}, **self._http_kwargs())
+            client = self._clients[key.name] = openai.OpenAI(api_key=key.api_key, base_url=self.base_url, http_client=self._http_client, max_retries=0)
+        return client
+
+    def get_async_client(self , key: Optional[ProviderKey] = None) -> "openai.AsyncOpenAI":
+        self._check_pid()
+        key = key or self.providers.keys[0]
+        client = self._async_clients.get(key.name)
+        if client is None:
+            if self._async_http_client is None:
+                self._async_http_client = httpx.AsyncClient(event_hooks={"request": [self._count_request_async]}, **self._http_kwargs())
+            client = self._async_clients[key.name] = openai.AsyncOpenAI(api_key=key.api_key, base_url=self.base_url, http_client=self._async_http_client, max_retries=0)
+        return client
+
+    def pool_stats(self) -> Dict[str, Any]:
+        settings = self.pool_settings
+        stats = {
+            "max_connections": settings["max_connections"],
+            "max_keepalive_connections": settings["max_keepalive_connections"],
+            "http2": bool(settings["http2"]) and http2_available(),
+            "requests_sent": self.requests_sent,
+        }
+        if self._pid == os.getpid():
+            if self._http_client is not None:
+                stats["sync"] = pool_snapshot(self._http_client)
+            if self._async_http_client is not None:
+                stats["async"] = pool_snapshot(self._async_http_client)
+        return stats
+
+    def provider_stats(self) -> List[Dict[str, Any]]:
+        return self.providers.stats()
+
+    async def aclose(self):
+        if self._pid == os.getpid():
+            if self._async_http_client is not None:
+                await self._async_http_client.aclose()
+            if self._http_client is not None:
+                self._http_client.close()
+        self._reset_clients()
+
+    def _request(self , prompt: Prompt , function: Function , temperature , max_tokens , model: Model , **extra) -> dict: 
+        return dict(
+        model=model.name,
         messages=prompt.get_messages(),
         function_call= {"name": function.name} , 
-        functions=[function.get_dict()],
+        functions=[function.schema],
         temperature=temperature,
-        max_tokens=max_tokens
+        max_tokens=max_tokens,
+        **extra
         )
-        # print(response)        
-        return Response(self.model , response)
\ No newline at end of file
+
+    def _rate_limited(self , key: ProviderKey , error: Exception) -> bool:
+        # Park the key until its window resets, and move on if another key still has room
+        key.block(retry_after_seconds(error) or 1.0)
+        return self.providers.available()
+
+    def chat(self , prompt: Prompt , function: Function , temperature=0.7 , max_tokens = 512 , label: Optional[str] = None , model: Optional[Model] = None): 
+        model = model or self.model
+        request = self._request(prompt , function , temperature , max_tokens , model)
+
+        def attempt():
+            while True:
+                key = self.providers.choose()
+                key.in_flight += 1
+                key.sent += 1
+                try:
+                    raw = self.get_client(key).chat.completions.with_raw_response.create(**request)
+                except openai.RateLimitError as e:
+                    key.observe(e.response.headers)
+                    if self._rate_limited(key , e):
+                        continue
+                    raise
+                finally:
+                    key.in_flight -= 1
+                key.observe(raw.headers)
+                # print(response)        
+                return Response(model , raw.parse())
+        return self.resilience.call_sync(label or function.name , attempt)
+
+    async def chat_async(self , prompt: Prompt , function: Function , temperature=0.7 , max_tokens = 512 , label: Optional[str] = None , model: Optional[Model] = None): 
+        model = model or self.model
+        request = self._request(prompt , function , temperature , max_tokens , model)
+
+        async def attempt():
+            while True:
+                key = self.providers.choose()
+                key.in_flight += 1
+                key.sent += 1
+                try:
+                    raw = await self.get_async_client(key).chat.completions.with_raw_response.create(**request)
+                except openai.RateLimitError as e:
+                    key.observe(e.response.headers)
+                    if self._rate_limited(key , e):
+                        continue
+                    raise
+                finally:
+                    key.in_flight -= 1
+                key.observe(raw.headers)
+                return Response(model , raw.parse())
+        return await self.resilience.call(label or function.name , attempt)
+
+    async def chat_stream_async(self , prompt: Prompt , function: Function , temperature=0.7 , max_tokens = 512 , label: Optional[str] = None , model: Optional[Model] = None): 
+        # Yields ("arguments", fragment) as the function call streams in, then ("usage", usage).
+        # Streams are not retried once started, but still count towards the circuit breaker
+        breaker = self.resilience.breaker(label or function.name)
+        breaker.before_call()
+        ok = None
+        try:
+            async for event in self._stream(prompt , function , temperature , max_tokens , model or self.model):
+                yield event
+            ok = True
+        except Exception as e:
+            ok = not counts_against_budget(e)
+            raise
+        finally:
+            if ok is None:
+                breaker.release()
+            else:
+                breaker.record(ok)
+
+    async def _stream(self , prompt: Prompt , function: Function , temperature , max_tokens , model: Model): 
+        key = self.providers.choose()
+        key.in_flight += 1
+        key.sent += 1
+        try:
+            raw = await self.get_async_client(key).chat.completions.with_raw_response.create(
+                **self._request(prompt , function , temperature , max_tokens , model , stream=True , stream_options={"include_usage": True})
+            )
+            key.observe(raw.headers)
+            # with_raw_response hands back the legacy wrapper, whose parse() is synchronous
+            stream = raw.parse()
+            async for chunk in stream:
+                if chunk.choices:
+                    function_call = chunk.choices[0].delta.function_call
+                    if function_call is not None and function_call.arguments:
+                        yield "arguments", function_call.arguments
+                if chunk.usage is not None:
+                    yield "usage", chunk.usage
+        except openai.RateLimitError as e:
+            key.observe(e.response.headers)
+            key.block(retry_after_seconds(e) or 1.0)
+            raise
+        finally:
+            key.in_flight -= 1
@@ -0,0 +1,22 @@
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library, same output, only slower
+    orjson = None
+
+# Non-string keys (e.g. integer histogram buckets) are written as strings, as json.dumps does
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+def dumps(value: Any) -> bytes:
+    # Compact UTF-8 JSON, the form responses are sent and cached in
+    if orjson is not None:
+        return orjson.dumps(value, option=ORJSON_OPTIONS)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def loads(data: Union[bytes, str]) -> Any:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers catch either the same way
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -0,0 +1,111 @@
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+DURATION_PART = re.compile(r"([\d.]+)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    # OpenAI sends reset times as durations such as "20ms", "1s" or "6m0s"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+def parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+class RateLimit:
+    limit: Optional[int] = None
+    remaining: Optional[int] = None
+    reset_at: float = 0.0
+
+    def update(self, limit: Optional[int], remaining: Optional[int], reset: Optional[float], now: float):
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+        if reset is not None:
+            self.reset_at = now + reset
+
+    def share(self, now: float, in_flight: int) -> float:
+        # Unknown or already reset windows count as fully available
+        if not self.limit or self.remaining is None or now >= self.reset_at:
+            return 1.0
+        return max(0.0, self.remaining - in_flight) / self.limit
+
+class ProviderKey:
+    def __init__(self, api_key: str, name: str):
+        self.api_key = api_key
+        self.name = name
+        self.requests = RateLimit()
+        self.tokens = RateLimit()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.sent = 0
+        self.rate_limited = 0
+
+    def headroom(self, now: float) -> float:
+        if now < self.blocked_until:
+            return -1.0
+        # In-flight calls have not been reflected in the last headers yet
+        return min(self.requests.share(now, self.in_flight), self.tokens.share(now, self.in_flight))
+
+    def observe(self, headers, now: Optional[float] = None):
+        if not headers:
+            return
+        now = now if now is not None else time.monotonic()
+        self.requests.update(
+            parse_int(headers.get("x-ratelimit-limit-requests")),
+            parse_int(headers.get("x-ratelimit-remaining-requests")),
+            parse_reset(headers.get("x-ratelimit-reset-requests")),
+            now
+        )
+        self.tokens.update(
+            parse_int(headers.get("x-ratelimit-limit-tokens")),
+            parse_int(headers.get("x-ratelimit-remaining-tokens")),
+            parse_reset(headers.get("x-ratelimit-reset-tokens")),
+            now
+        )
+
+    def block(self, seconds: float):
+        self.rate_limited += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "headroom": round(self.headroom(now), 4),
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "rate_limited": self.rate_limited,
+            "remaining_requests": self.requests.remaining,
+            "remaining_tokens": self.tokens.remaining,
+            "blocked_for": max(0.0, self.blocked_until - now),
+        }
+
+class ProviderPool:
+    def __init__(self, api_keys: List[str]):
+        self.keys = [ProviderKey(api_key, f"key{index}") for index, api_key in enumerate(api_keys)]
+
+    def choose(self) -> ProviderKey:
+        # Most rate-limit headroom first, fewest in-flight calls to break ties
+        now = time.monotonic()
+        return max(self.keys, key=lambda key: (key.headroom(now), -key.in_flight))
+
+    def available(self) -> bool:
+        now = time.monotonic()
+        return any(key.headroom(now) > 0 for key in self.keys)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [key.stats(now) for key in self.keys]
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from .lazy import lazy_import
+
+openai = lazy_import("openai")
+
+DEFAULT_RESILIENCE_SETTINGS = {
+    "max_attempts": 3,
+    "base_delay": 0.25,
+    "max_delay": 8.0,
+    # Longest Retry-After we are willing to sleep through inside a request
+    "max_retry_after": 10.0,
+    "hedge_modules": ["LanguageDetection", "SentimentAnalysis", "EmotionRecognition", "GrammarAssistant"],
+    "hedge_percentile": 0.95,
+    "hedge_min_samples": 20,
+    "hedge_min_delay": 0.2,
+    "breaker_window_seconds": 30.0,
+    "breaker_min_requests": 20,
+    "breaker_cooldown_seconds": 15.0,
+    "error_budget": 0.5,
+    # Per-module overrides of error_budget, keyed by module class name
+    "error_budgets": {},
+}
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status_code: int = 502, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class CircuitOpenError(UpstreamError):
+    def __init__(self, label: str, retry_after: float):
+        super().__init__(f"Upstream circuit for {label} is open", 503, retry_after)
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409)
+    # A malformed function-call payload is usually fine on the next try
+    return isinstance(error, json.JSONDecodeError)
+
+def counts_against_budget(error: Exception) -> bool:
+    # Our own bad requests say nothing about upstream health
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return True
+
+def as_upstream_error(error: Exception) -> UpstreamError:
+    if isinstance(error, UpstreamError):
+        return error
+    if isinstance(error, openai.RateLimitError):
+        return UpstreamError("Upstream rate limit reached", 429, retry_after_seconds(error))
+    if isinstance(error, openai.APITimeoutError):
+        return UpstreamError("Upstream timed out", 504)
+    return UpstreamError(f"Upstream call failed: {type(error).__name__}", 502, retry_after_seconds(error))
+
+class LatencyTracker:
+    def __init__(self, size: int = 256):
+        self.samples = deque(maxlen=size)
+        self._sorted = None
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, share: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        return self._sorted[min(len(self._sorted) - 1, int(share * len(self._sorted)))]
+
+class CircuitBreaker:
+    def __init__(self, label: str, error_budget: float, window_seconds: float, min_requests: int, cooldown_seconds: float):
+        self.label = label
+        self.error_budget = error_budget
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.cooldown_seconds = cooldown_seconds
+        self.outcomes = deque()
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+
+    def before_call(self):
+        now = time.monotonic()
+        if self.state == "open":
+            waited = now - self.opened_at
+            if waited < self.cooldown_seconds:
+                raise CircuitOpenError(self.label, self.cooldown_seconds - waited)
+            self.state = "half_open"
+            self.trial_in_flight = False
+        if self.state == "half_open":
+            # One trial call decides whether the circuit closes again
+            if self.trial_in_flight:
+                raise CircuitOpenError(self.label, 1.0)
+            self.trial_in_flight = True
+
+    def record(self, ok: bool):
+        now = time.monotonic()
+        if self.state == "half_open":
+            self.trial_in_flight = False
+            if ok:
+                self.state = "closed"
+                self.outcomes.clear()
+                self.failures = 0
+            else:
+                self._open(now)
+            return
+        self.outcomes.append((now, not ok))
+        self.failures += 0 if ok else 1
+        while self.outcomes and self.outcomes[0][0] < now - self.window_seconds:
+            _, failed = self.outcomes.popleft()
+            self.failures -= 1 if failed else 0
+        if len(self.outcomes) >= self.min_requests and self.failures / len(self.outcomes) > self.error_budget:
+            self._open(now)
+
+    def release(self):
+        # The call was abandoned without an outcome, free the trial slot
+        if self.state == "half_open":
+            self.trial_in_flight = False
+
+    def _open(self, now: float):
+        self.state = "open"
+        self.opened_at = now
+        self.outcomes.clear()
+        self.failures = 0
+
+class Resilience:
+    def __init__(self, settings: Optional[dict] = None):
+        self.settings = {**DEFAULT_RESILIENCE_SETTINGS, **(settings or {})}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[str, LatencyTracker] = {}
+        self.counts = Counter()
+
+    def breaker(self, label: str) -> CircuitBreaker:
+        breaker = self.breakers.get(label)
+        if breaker is None:
+            settings = self.settings
+            breaker = self.breakers[label] = CircuitBreaker(
+                label,
+                settings["error_budgets"].get(label, settings["error_budget"]),
+                settings["breaker_window_seconds"],
+                settings["breaker_min_requests"],
+                settings["breaker_cooldown_seconds"],
+            )
+        return breaker
+
+    def tracker(self, label: str) -> LatencyTracker:
+        tracker = self.latencies.get(label)
+        if tracker is None:
+            tracker = self.latencies[label] = LatencyTracker()
+        return tracker
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.settings["base_delay"])
+        # Full jitter keeps retrying clients from synchronising
+        return random.uniform(0, min(self.settings["max_delay"], self.settings["base_delay"] * (2 ** attempt)))
+
+    def hedge_delay(self, label: str) -> Optional[float]:
+        if label not in self.settings["hedge_modules"]:
+            return None
+        tracker = self.tracker(label)
+        if len(tracker.samples) < self.settings["hedge_min_samples"]:
+            return None
+        return max(self.settings["hedge_min_delay"], tracker.percentile(self.settings["hedge_percentile"]))
+
+    def _give_up(self, attempt: int, retry_after: Optional[float]) -> bool:
+        if attempt + 1 >= self.settings["max_attempts"]:
+            return True
+        return retry_after is not None and retry_after > self.settings["max_retry_after"]
+
+    async def call(self, label: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        breaker = self.breaker(label)
+        attempt = 0
+        while True:
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                self.counts["short_circuited"] += 1
+                raise
+            started = time.monotonic()
+            try:
+                result = await self._hedged(label, factory)
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                breaker.record(not counts_against_budget(e))
+                retry_after = retry_after_seconds(e)
+                if not is_retryable(e) or self._give_up(attempt, retry_after):
+                    raise as_upstream_error(e) from e
+                self.counts["retries"] += 1
+                await asyncio.sleep(self.backoff(attempt, retry_after))
+                attempt += 1
+                continue
+            breaker.record(True)
+            self.tracker(label).observe(time.monotonic() - started)
+            return result
+
+    def call_sync(self, label: str, factory: Callable[[], Any]) -> Any:
+        breaker = self.breaker(label)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                result = factory()
+            except Exception as e:
+                breaker.record(not counts_against_budget(e))
+                retry_after = retry_after_seconds(e)
+                if not is_retryable(e) or self._give_up(attempt, retry_after):
+                    raise as_upstream_error(e) from e
+                self.counts["retries"] += 1
+                time.sleep(self.backoff(attempt, retry_after))
+                attempt += 1
+                continue
+            breaker.record(True)
+            return result
+
+    async def _hedged(self, label: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        delay = self.hedge_delay(label)
+        if delay is None:
+            return await factory()
+        tasks = [asyncio.ensure_future(factory())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # Past the module's p95, a second request usually beats the straggler
+                self.counts["hedged"] += 1
+                tasks.append(asyncio.ensure_future(factory()))
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.counts["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counts,
+            "breakers": {label: breaker.state for label, breaker in self.breakers.items()},
+            "p95_seconds": {label: tracker.percentile(0.95) for label, tracker in self.latencies.items()},
+        }
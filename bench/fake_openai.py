@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Local stand-in for the chat-completions API, tuned with environment variables:
+#   FAKE_LATENCY_MS     median upstream latency
+#   FAKE_LATENCY_SIGMA  log-normal spread of the latency (0 for a fixed latency)
+#   FAKE_ERROR_RATE     share of requests answered with FAKE_ERROR_STATUS
+#   FAKE_ERROR_STATUS   status code for injected errors (429 also sends Retry-After)
+#   FAKE_PROMPT_TOKENS  reported prompt tokens, 0 to estimate from the request
+#   FAKE_OUTPUT_TOKENS  approximate completion tokens per string field
+#   FAKE_STREAM_CHUNKS  number of argument fragments when streaming
+SETTINGS = {
+    "latency_ms": float(os.environ.get("FAKE_LATENCY_MS", "300")),
+    "latency_sigma": float(os.environ.get("FAKE_LATENCY_SIGMA", "0.5")),
+    "error_rate": float(os.environ.get("FAKE_ERROR_RATE", "0")),
+    "error_status": int(os.environ.get("FAKE_ERROR_STATUS", "500")),
+    "prompt_tokens": int(os.environ.get("FAKE_PROMPT_TOKENS", "0")),
+    "output_tokens": int(os.environ.get("FAKE_OUTPUT_TOKENS", "60")),
+    "stream_chunks": int(os.environ.get("FAKE_STREAM_CHUNKS", "20")),
+}
+
+WORDS = "the quick brown fox jumps over a lazy dog while writers revise every sentence with care".split()
+NUMBERED_TEXT = re.compile(r"^\[(\d+)\] ", re.MULTILINE)
+
+app = FastAPI()
+stats = {"requests": 0, "errors": 0, "streams": 0}
+
+def sample_latency() -> float:
+    median = SETTINGS["latency_ms"] / 1000
+    if SETTINGS["latency_sigma"] <= 0:
+        return median
+    return random.lognormvariate(0, SETTINGS["latency_sigma"]) * median
+
+def fake_value(spec: dict, texts: int):
+    kind = spec.get("type")
+    if kind == "integer":
+        return 0
+    if kind == "number":
+        return 0.5
+    if kind == "boolean":
+        return True
+    if kind == "array":
+        item = spec.get("items", {})
+        values = []
+        for index in range(max(texts, 1)):
+            value = fake_value(item, 1)
+            if isinstance(value, dict) and "index" in value:
+                value["index"] = index
+            values.append(value)
+        return values
+    if kind == "object":
+        return {name: fake_value(child, texts) for name, child in spec.get("properties", {}).items()}
+    return " ".join(random.choice(WORDS) for _ in range(SETTINGS["output_tokens"]))
+
+def fake_arguments(body: dict) -> str:
+    function = body["functions"][0]
+    prompt = "\n".join(message.get("content") or "" for message in body.get("messages", []))
+    texts = len(NUMBERED_TEXT.findall(prompt))
+    return json.dumps(fake_value(function["parameters"], texts))
+
+def usage(body: dict, arguments: str) -> dict:
+    prompt_tokens = SETTINGS["prompt_tokens"] or max(1, len(json.dumps(body)) // 4)
+    completion_tokens = max(1, len(arguments) // 4)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+def error_response():
+    stats["errors"] += 1
+    headers = {"retry-after": "1"} if SETTINGS["error_status"] == 429 else {}
+    return JSONResponse(
+        status_code=SETTINGS["error_status"],
+        content={"error": {"message": "Injected failure", "type": "fake_error", "code": None}},
+        headers=headers
+    )
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    latency = sample_latency()
+    if random.random() < SETTINGS["error_rate"]:
+        await asyncio.sleep(latency / 4)
+        return error_response()
+    function_name = body["functions"][0]["name"]
+    arguments = fake_arguments(body)
+    base = {"id": f"chatcmpl-fake-{stats['requests']}", "created": int(time.time()), "model": body.get("model", "fake")}
+    if body.get("stream"):
+        stats["streams"] += 1
+        return StreamingResponse(stream(body, base, function_name, arguments, latency), media_type="text/event-stream")
+    await asyncio.sleep(latency)
+    return {
+        **base,
+        "object": "chat.completion",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": None, "function_call": {"name": function_name, "arguments": arguments}},
+            "finish_reason": "function_call"
+        }],
+        "usage": usage(body, arguments),
+    }
+
+async def stream(body: dict, base: dict, function_name: str, arguments: str, latency: float):
+    # First fragment after a tenth of the latency, the rest spread over the remainder
+    pieces = max(1, SETTINGS["stream_chunks"])
+    size = max(1, -(-len(arguments) // pieces))
+    await asyncio.sleep(latency / 10)
+    for start in range(0, len(arguments), size):
+        delta = {"function_call": {"arguments": arguments[start:start + size]}}
+        if start == 0:
+            delta = {"role": "assistant", "function_call": {"name": function_name, "arguments": arguments[:size]}}
+        chunk = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        await asyncio.sleep(latency * 0.9 / pieces)
+    final = {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "function_call"}]}
+    yield f"data: {json.dumps(final)}\n\n"
+    if body.get("stream_options", {}).get("include_usage"):
+        yield f"data: {json.dumps({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage(body, arguments)})}\n\n"
+    yield "data: [DONE]\n\n"
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import glob
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+
+# Offline load test: starts bench/fake_openai.py and the API against it, drives every route at a
+# fixed concurrency and writes the results as JSON.
+#
+#   python -m bench.run --concurrency 64 --duration 20 --output bench_results.json
+#   python -m bench.run --baseline bench_results.json   (compare against an earlier run)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = (
+    "We has scheduled a meeting at 2 PM tomorow. Please ensure that you are their on time, "
+    "because the client will present there new roadmap and we need everyone in the room."
+)
+
+def text_payload(text):
+    return {"text": text}
+
+ROUTES = {
+    "/grammar_assistance": text_payload,
+    "/humanizer": text_payload,
+    "/summarizer": text_payload,
+    "/tonechange": lambda text: {"text": text, "target_tone": "formal"},
+    "/contentexpander": text_payload,
+    "/textrewriting": text_payload,
+    "/keywordoptimizer": text_payload,
+    "/textpersonalization": lambda text: {"text": text, "user": "Sam", "prefrence": "short sentences"},
+    "/languagedetection": text_payload,
+    "/sentimentanalysis": text_payload,
+    "/emotionrecognition": text_payload,
+    "/estimate": lambda text: {"module": "Summarizer", "params": {"text": text}},
+    "/batch": lambda text: {"items": [{"module": "SentimentAnalysis", "params": {"text": f"{text} #{index}"}} for index in range(20)]},
+    "/readability": lambda text: {"texts": [f"{text} #{index}" for index in range(20)]},
+    "/plagiarism": text_payload,
+    "/pipeline": lambda text: {"text": text, "steps": [{"module": "GrammarAssistant"}, {"module": "Summarizer"}]},
+    "/sessions": lambda text: {"module": "GrammarAssistant", "text": f"{text}\n\n{text}"},
+    "/jobs": lambda text: {"kind": "module", "payload": {"module": "SentimentAnalysis", "params": {"text": text}}},
+    "/humanizer?stream=true": text_payload,
+    "/summarizer?stream=true": text_payload,
+    "/contentexpander?stream=true": text_payload,
+    "/textrewriting?stream=true": text_payload,
+}
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": max(values) if values else None,
+        "mean_ms": sum(values) / len(values) if values else None,
+    }
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    for children in glob.glob(f"/proc/{pid}/task/*/children"):
+        try:
+            with open(children) as handle:
+                for child in handle.read().split():
+                    pids.extend(process_tree(int(child)))
+        except OSError:
+            continue
+    return pids
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start(command: List[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen(command, cwd=ROOT, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process for {url} exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not become ready in {timeout}s")
+
+def measure_cold_start(base_url: str, process: subprocess.Popen, started: float, target: Optional[float]) -> dict:
+    # Launch to /ready, then to the first answered module request, as a client arriving at launch sees it
+    wait_ready(f"{base_url}/ready", process)
+    ready = time.monotonic() - started
+    response = httpx.post(f"{base_url}/sentimentanalysis", json={"text": SAMPLE}, timeout=30)
+    first_response = time.monotonic() - started
+    result = {
+        "ready_s": round(ready, 3),
+        "first_response_s": round(first_response, 3),
+        "first_status": response.status_code,
+        "target_s": target,
+        "within_target": first_response <= target if target is not None else None,
+        "worker": httpx.get(f"{base_url}/ready", timeout=5).json(),
+    }
+    print(f"[bench] cold start: ready in {ready:.2f}s, first response in {first_response:.2f}s (target {target}s)", flush=True)
+    return result
+
+async def probe_lag(base_url: str, stop: asyncio.Event, samples: List[float]):
+    # /ping does no work, so its latency under load is dominated by how long the worker's event loop is blocked
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                await client.get("/ping")
+                samples.append((time.perf_counter() - started) * 1000)
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.05)
+
+async def sample_memory(pid: int, stop: asyncio.Event, peaks: Dict[int, float]):
+    while not stop.is_set():
+        for process_id in process_tree(pid):
+            rss = rss_mb(process_id)
+            if rss is not None:
+                peaks[process_id] = max(peaks.get(process_id, 0), rss)
+        await asyncio.sleep(0.5)
+
+async def drive(base_url: str, path: str, concurrency: int, duration: float, unique: bool) -> dict:
+    latencies, first_bytes = [], []
+    outcomes = Counter()
+    counter = 0
+    streaming = "stream=true" in path
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def worker():
+            nonlocal counter
+            while time.perf_counter() < deadline:
+                counter += 1
+                # Unique texts by default so the cache and request coalescing do not flatter the numbers
+                payload = ROUTES[path](f"{SAMPLE} ({counter})" if unique else SAMPLE)
+                started = time.perf_counter()
+                try:
+                    if streaming:
+                        async with client.stream("POST", path, json=payload) as response:
+                            first_byte = None
+                            async for _ in response.aiter_bytes():
+                                if first_byte is None:
+                                    first_byte = time.perf_counter() - started
+                            if first_byte is not None:
+                                first_bytes.append(first_byte * 1000)
+                    else:
+                        response = await client.post(path, json=payload)
+                    outcomes[str(response.status_code)] += 1
+                except httpx.HTTPError as e:
+                    outcomes[type(e).__name__] += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    result = {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed if elapsed else 0,
+        "outcomes": dict(outcomes),
+        "errors": sum(count for status, count in outcomes.items() if not status.startswith("2")),
+        "latency": summarize(latencies),
+    }
+    if streaming:
+        result["time_to_first_byte"] = summarize(first_bytes)
+    return result
+
+async def run_routes(args, base_url: str, app_pid: int) -> dict:
+    results = {}
+    lag = []
+    memory = {}
+    stop = asyncio.Event()
+    background = [
+        asyncio.ensure_future(probe_lag(base_url, stop, lag)),
+        asyncio.ensure_future(sample_memory(app_pid, stop, memory)),
+    ]
+    for path in args.routes or ROUTES:
+        print(f"[bench] {path} at concurrency {args.concurrency} for {args.duration}s", flush=True)
+        results[path] = await drive(base_url, path, args.concurrency, args.duration, not args.repeat_texts)
+    stop.set()
+    await asyncio.gather(*background)
+    return {
+        "routes": results,
+        "event_loop_lag": summarize(lag),
+        "memory_mb": {"per_process": {str(pid): round(rss, 1) for pid, rss in memory.items()}, "total": round(sum(memory.values()), 1)},
+    }
+
+def compare(current: dict, baseline: dict):
+    print(f"{'route':34} {'rps':>10} {'base rps':>10} {'p95 ms':>10} {'base p95':>10}")
+    for path, result in current["routes"].items():
+        base = baseline.get("routes", {}).get(path)
+        if base is None:
+            continue
+        print(
+            f"{path:34} {result['rps']:10.1f} {base['rps']:10.1f} "
+            f"{result['latency']['p95_ms'] or 0:10.1f} {base['latency']['p95_ms'] or 0:10.1f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake OpenAI server")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per route")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the API")
+    parser.add_argument("--routes", nargs="*", help="subset of routes to drive, default all")
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--output-tokens", type=int, default=60)
+    parser.add_argument("--repeat-texts", action="store_true", help="send identical texts to exercise the cache")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    fake_port, app_port = free_port(), free_port()
+    with open(os.path.join(ROOT, "config.json")) as handle:
+        config = json.load(handle)
+    config.update({"api_key": "bench", "base_url": f"http://127.0.0.1:{fake_port}/v1"})
+    # Every bench request comes from one consumer, rate limits would turn the run into a 429 count
+    config.setdefault("admission", {})["enabled"] = False
+    config_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(config, config_file)
+    config_file.close()
+
+    app = None
+    fake = start(
+        [sys.executable, "-m", "uvicorn", "bench.fake_openai:app", "--port", str(fake_port), "--log-level", "warning"],
+        {
+            "FAKE_LATENCY_MS": str(args.latency_ms),
+            "FAKE_LATENCY_SIGMA": str(args.latency_sigma),
+            "FAKE_ERROR_RATE": str(args.error_rate),
+            "FAKE_ERROR_STATUS": str(args.error_status),
+            "FAKE_OUTPUT_TOKENS": str(args.output_tokens),
+        }
+    )
+    try:
+        wait_ready(f"http://127.0.0.1:{fake_port}/stats", fake)
+        app_started = time.monotonic()
+        app = start(
+            [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(app_port), "--workers", str(args.workers)],
+            {"APP_CONFIG": config_file.name}
+        )
+        cold_start = measure_cold_start(f"http://127.0.0.1:{app_port}", app, app_started, config.get("server", {}).get("cold_start_target_seconds"))
+        report = asyncio.run(run_routes(args, f"http://127.0.0.1:{app_port}", app.pid))
+        report["cold_start"] = cold_start
+        report["upstream"] = httpx.get(f"http://127.0.0.1:{fake_port}/stats").json()
+    finally:
+        for process in (app, fake):
+            if process is None:
+                continue
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        os.unlink(config_file.name)
+
+    report["meta"] = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "settings": vars(args),
+    }
+    with open(args.output, "w") as handle:
+        json.dump(report, handle, indent=2)
+    print(f"[bench] results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as handle:
+            compare(report, json.load(handle))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from ai.resilience import UpstreamError
+from .metrics import ADMISSION
+
+# Admission control for upstream slots. Each tier has its own queue, served by stride
+# scheduling in proportion to its weight, and consumers take turns within a tier. Per-consumer
+# token buckets cap request rates. A request whose predicted wait exceeds its tier's deadline is
+# turned away at once instead of timing out later.
+
+DEFAULT_ADMISSION_SETTINGS = {
+    "enabled": True,
+    # Route tags to tiers, untagged or unknown routes fall back to default_tier
+    "tiers": {"Premium Modules": "premium", "Text Processing": "mvp", "Utility Modules": "utility", "Batch": "mvp"},
+    "default_tier": "mvp",
+    "weights": {"premium": 8, "mvp": 3, "utility": 1},
+    # Longest a request may wait for an upstream slot, in seconds
+    "deadlines": {"premium": 20, "mvp": 10, "utility": 10},
+    # Requests per second and burst per consumer, e.g. {"rate": 10, "burst": 20}, null for no limit
+    "rate_limits": {"premium": None, "mvp": None, "utility": None},
+}
+
+class Overloaded(UpstreamError):
+    pass
+
+class Ticket:
+    def __init__(self, tier: str, consumer: str, deadline: float):
+        self.tier = tier
+        self.consumer = consumer
+        self.deadline = deadline
+
+current_ticket: ContextVar[Optional[Ticket]] = ContextVar("current_ticket", default=None)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        # Takes a token and returns 0, or returns the seconds until one is available
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class AdmissionController:
+    def __init__(self, capacity: int, settings: Optional[dict] = None):
+        self.settings = {**DEFAULT_ADMISSION_SETTINGS, **(settings or {})}
+        self.capacity = capacity
+        self.in_use = 0
+        self.weights = self.settings["weights"]
+        self.queues: Dict[str, OrderedDict] = {tier: OrderedDict() for tier in self.weights}
+        self.queued = Counter()
+        self.passes = {tier: 0.0 for tier in self.weights}
+        self.virtual_time = 0.0
+        # Running average of how long a request holds a slot, for predicting waits
+        self.service_seconds = 1.0
+        self.buckets: Dict[tuple, TokenBucket] = {}
+        self.counts = Counter()
+
+    def tier_for(self, tags) -> str:
+        for tag in tags or ():
+            tier = self.settings["tiers"].get(tag)
+            if tier is not None:
+                return tier
+        return self.settings["default_tier"]
+
+    def predicted_wait(self, tier: str) -> float:
+        # Waiters that would be served before a new arrival: everyone in its own tier, plus the
+        # weighted share of the other tiers that gets interleaved with them
+        own = self.queued[tier] + 1
+        weight = self.weights[tier]
+        ahead = own + sum(
+            min(self.queued[other], own * self.weights[other] / weight) for other in self.weights if other != tier
+        )
+        free = self.capacity - self.in_use
+        if ahead <= free:
+            return 0.0
+        return (ahead - free) * self.service_seconds / self.capacity
+
+    def _reject(self, tier: str, status_code: int, retry_after: float, message: str):
+        self.counts[f"{tier}.rejected_{status_code}"] += 1
+        ADMISSION.inc(tier=tier, result=f"rejected_{status_code}")
+        raise Overloaded(message, status_code, retry_after)
+
+    def admit(self, tier: str, consumer: str) -> Ticket:
+        now = time.monotonic()
+        limit = self.settings["rate_limits"].get(tier)
+        if limit:
+            bucket = self.buckets.get((tier, consumer))
+            if bucket is None:
+                if len(self.buckets) > 100000:
+                    self.buckets.clear()
+                bucket = self.buckets[(tier, consumer)] = TokenBucket(limit["rate"], limit["burst"])
+            wait = bucket.take(now)
+            if wait > 0:
+                self._reject(tier, 429, wait, "Rate limit exceeded")
+        deadline = self.settings["deadlines"].get(tier, 10)
+        predicted = self.predicted_wait(tier)
+        if predicted > deadline:
+            self._reject(tier, 503, predicted - deadline, "Server is at capacity")
+        self.counts[f"{tier}.admitted"] += 1
+        ADMISSION.inc(tier=tier, result="admitted")
+        return Ticket(tier, consumer, now + deadline)
+
+    async def acquire(self, ticket: Optional[Ticket] = None) -> Callable[[], None]:
+        # Waits for an upstream slot and returns the function that gives it back
+        if ticket is None:
+            tier = self.settings["default_tier"]
+            ticket = Ticket(tier, "internal", time.monotonic() + self.settings["deadlines"].get(tier, 10))
+        if self.in_use < self.capacity and not sum(self.queued.values()):
+            self.in_use += 1
+            return self._releaser(time.monotonic())
+        waiter = asyncio.get_running_loop().create_future()
+        self._enqueue(ticket, waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), max(0.0, ticket.deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # Handed a slot just as the deadline passed, give it to the next in line
+                self._release()
+            else:
+                waiter.cancel()
+                self._discard(ticket, waiter)
+            self._reject(ticket.tier, 503, self.service_seconds, "Timed out waiting for capacity")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                waiter.cancel()
+                self._discard(ticket, waiter)
+            raise
+        return self._releaser(time.monotonic())
+
+    def _releaser(self, started: float) -> Callable[[], None]:
+        def release():
+            held = time.monotonic() - started
+            self.service_seconds += 0.05 * (held - self.service_seconds)
+            self._release()
+        return release
+
+    def _enqueue(self, ticket: Ticket, waiter: asyncio.Future):
+        queue = self.queues.setdefault(ticket.tier, OrderedDict())
+        self.weights.setdefault(ticket.tier, 1)
+        self.passes.setdefault(ticket.tier, 0.0)
+        if not self.queued[ticket.tier]:
+            # A tier that was idle starts level with the others instead of cashing in its idle time
+            self.passes[ticket.tier] = max(self.passes[ticket.tier], self.virtual_time)
+        queue.setdefault(ticket.consumer, deque()).append(waiter)
+        self.queued[ticket.tier] += 1
+
+    def _discard(self, ticket: Ticket, waiter: asyncio.Future):
+        waiters = self.queues[ticket.tier].get(ticket.consumer)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.queued[ticket.tier] -= 1
+            if not waiters:
+                del self.queues[ticket.tier][ticket.consumer]
+
+    def _release(self):
+        while True:
+            tiers = [tier for tier in self.queues if self.queued[tier]]
+            if not tiers:
+                self.in_use -= 1
+                return
+            tier = min(tiers, key=lambda name: self.passes[name])
+            self.virtual_time = self.passes[tier]
+            self.passes[tier] += 1 / self.weights[tier]
+            # Consumers within a tier take turns: serve the first, then move it to the back
+            queue = self.queues[tier]
+            consumer, waiters = next(iter(queue.items()))
+            waiter = waiters.popleft()
+            self.queued[tier] -= 1
+            if waiters:
+                queue.move_to_end(consumer)
+            else:
+                del queue[consumer]
+            if not waiter.done():
+                # The slot passes straight to the waiter, in_use stays the same
+                waiter.set_result(None)
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_use": self.in_use,
+            "capacity": self.capacity,
+            "queued": dict(self.queued),
+            "service_seconds": round(self.service_seconds, 4),
+            **self.counts,
+        }
+
+def build_admission(settings: Optional[dict], capacity: int) -> Optional[AdmissionController]:
+    settings = settings or {}
+    if not settings.get("enabled", False):
+        return None
+    return AdmissionController(capacity, settings)
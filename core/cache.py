@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set
+
+from .db import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+def make_cache_key(model_name: str, function_fingerprint: str, messages: list, params: dict) -> str:
+    # The function schema enters by its precompiled digest rather than being serialized again
+    payload = json.dumps(
+        [model_name, function_fingerprint, messages, params],
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class MemoryCache:
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class SQLiteCache:
+    # Shared by every uvicorn worker on the host, WAL keeps readers from blocking the writer
+    def __init__(self, path: str, max_entries: int = 100000, ttl_seconds: float = 86400):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.connection = SQLiteDatabase(path, [
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_used REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)",
+        ])
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        # Rows written before values were stored as bytes come back as text
+        return row[0].encode("utf-8") if isinstance(row[0], str) else row[0]
+
+    def set(self, key: str, value: bytes):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl_seconds, now)
+            )
+            self.writes += 1
+            # Trim periodically rather than on every write
+            if self.writes % 1000 == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        self.connection.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+        self.connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+class ResponseCache:
+    # In-process LRU in front of an optional SQLite tier. Values are the JSON-encoded results,
+    # so a hit can be sent to the client without decoding and encoding it again. On the event
+    # loop only the LRU is touched directly: SQLite reads run in a thread and writes go through
+    # to it in the background
+    def __init__(self, memory: MemoryCache, disk: Optional[SQLiteCache] = None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Background writes, held so they are not collected before they finish
+        self.writing: Set[asyncio.Task] = set()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.disk is not None:
+            value = await asyncio.to_thread(self.disk.get, key)
+            if value is not None:
+                self.hits += 1
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def set_in_background(self, key: str, value: Any):
+        # Called on the event loop: the LRU serves the next hit while SQLite catches up
+        self.memory.set(key, value)
+        if self.disk is not None:
+            task = asyncio.ensure_future(asyncio.to_thread(self.disk.set, key, value))
+            self.writing.add(task)
+            task.add_done_callback(self._written)
+
+    def _written(self, task: asyncio.Task):
+        self.writing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Response cache write failed: %s", task.exception())
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+        }
+
+def build_cache(settings: Optional[dict]) -> Optional[ResponseCache]:
+    settings = settings or {}
+    if not settings.get("enabled", False):
+        return None
+    memory = MemoryCache(settings.get("max_entries", 10000), settings.get("ttl_seconds", 3600))
+    disk = None
+    if settings.get("sqlite_path"):
+        disk = SQLiteCache(
+            settings["sqlite_path"],
+            settings.get("sqlite_max_entries", 100000),
+            settings.get("ttl_seconds", 3600)
+        )
+    return ResponseCache(memory, disk)
@@ -0,0 +1,57 @@
+import re
+from typing import Callable, List
+
+from .tokens import estimate_tokens
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+class Chunk:
+    text: str
+    separator: str
+
+    def __init__(self, text: str, separator: str):
+        self.text = text
+        # Whitespace that sat in front of this chunk in the original document
+        self.separator = separator
+
+def _units(text: str, max_tokens: int, count_tokens: Callable[[str], int]):
+    # Paragraphs, broken into sentences and then words only when they do not fit the budget
+    for paragraph_index, paragraph in enumerate(PARAGRAPH_BREAK.split(text.strip())):
+        separator = "\n\n" if paragraph_index else ""
+        if count_tokens(paragraph) <= max_tokens:
+            yield paragraph, separator
+            continue
+        for sentence in SENTENCE_BREAK.split(paragraph):
+            if count_tokens(sentence) <= max_tokens:
+                yield sentence, separator
+            else:
+                words = sentence.split(" ")
+                current = []
+                for word in words:
+                    if current and count_tokens(" ".join(current + [word])) > max_tokens:
+                        yield " ".join(current), separator
+                        separator = " "
+                        current = []
+                    current.append(word)
+                if current:
+                    yield " ".join(current), separator
+            separator = " "
+
+def split_text(text: str, max_tokens: int, count_tokens: Callable[[str], int] = estimate_tokens) -> List[Chunk]:
+    chunks = []
+    current = None
+    current_tokens = 0
+    for unit, separator in _units(text, max_tokens, count_tokens):
+        unit_tokens = count_tokens(unit)
+        if current is not None and current_tokens + unit_tokens <= max_tokens:
+            current.text += separator + unit
+            current_tokens += unit_tokens
+            continue
+        current = Chunk(unit, separator)
+        current_tokens = unit_tokens
+        chunks.append(current)
+    return chunks
+
+def stitch(chunks: List[Chunk], outputs: List[str]) -> str:
+    return "".join(chunk.separator + output.strip() for chunk, output in zip(chunks, outputs))
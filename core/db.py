@@ -0,0 +1,34 @@
+import os
+import sqlite3
+from typing import Iterable
+
+class SQLiteDatabase:
+    # A WAL connection that is opened again in a forked worker. SQLite connections must not be
+    # used across fork(), and the launcher builds every store in the parent before forking
+    def __init__(self, path: str, schema: Iterable[str] = ()):
+        self.path = path
+        self.schema = tuple(schema)
+        self._connection = None
+        self._pid = None
+        # The parent's connection is kept open, closing it in the child could reset the parent's locks
+        self._inherited = []
+        self.connection()
+
+    def connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            if self._connection is not None:
+                self._inherited.append(self._connection)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.schema:
+                connection.execute(statement)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def execute(self, *args) -> sqlite3.Cursor:
+        return self.connection().execute(*args)
+
+    def executemany(self, *args) -> sqlite3.Cursor:
+        return self.connection().executemany(*args)
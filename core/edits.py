@@ -0,0 +1,108 @@
+import difflib
+import re
+from typing import List, Optional
+
+# Edit lists for text-correcting modules: the model names the spans it changes instead of writing
+# the whole text out again, and the corrected text is rebuilt here.
+
+TOKEN = re.compile(r"\w+|\s+|[^\w\s]")
+# A sentence with the whitespace after it, every character of a text falls in exactly one
+SENTENCE = re.compile(r"[^.!?\n]*[.!?\n]+\s*|[^.!?\n]+")
+MAX_WORD_DIFF_TOKENS = 4000
+
+def _locate(text: str, start: int, original: str) -> Optional[int]:
+    # Model offsets drift, so an edit whose original text is not at its offset is moved to the
+    # nearest place it does occur
+    positions = []
+    position = text.find(original)
+    while position != -1:
+        positions.append(position)
+        position = text.find(original, position + 1)
+    if not positions:
+        return None
+    return min(positions, key=lambda position: abs(position - start))
+
+def resolve_edits(text: str, edits: list) -> Optional[List[dict]]:
+    # The edits in text order with offsets that match text, or None when they do not apply cleanly
+    spans = []
+    for edit in edits:
+        if not isinstance(edit, dict):
+            return None
+        start, end = edit.get("start"), edit.get("end")
+        original, replacement = edit.get("original"), edit.get("replacement")
+        if not isinstance(start, int) or not isinstance(end, int) or not isinstance(replacement, str):
+            return None
+        if isinstance(original, str) and text[start:end] != original:
+            if not original:
+                return None
+            start = _locate(text, start, original)
+            if start is None:
+                return None
+            end = start + len(original)
+        if not 0 <= start <= end <= len(text):
+            return None
+        spans.append((start, end, replacement))
+    spans.sort()
+    resolved = []
+    position = 0
+    for start, end, replacement in spans:
+        if start < position:
+            return None
+        resolved.append({"start": start, "end": end, "original": text[start:end], "replacement": replacement})
+        position = end
+    return resolved
+
+def apply_edits(text: str, edits: list) -> Optional[str]:
+    # The corrected text, or None when the edits do not apply cleanly to the original
+    resolved = resolve_edits(text, edits)
+    if resolved is None:
+        return None
+    pieces = []
+    position = 0
+    for edit in resolved:
+        pieces.append(text[position:edit["start"]])
+        pieces.append(edit["replacement"])
+        position = edit["end"]
+    pieces.append(text[position:])
+    return "".join(pieces)
+
+def _word_edits(original: str, corrected: str, offset: int) -> List[dict]:
+    before = TOKEN.findall(original)
+    after = TOKEN.findall(corrected)
+    if len(before) + len(after) > MAX_WORD_DIFF_TOKENS:
+        # A rewritten stretch this long is one edit, a word diff of it would cost more than it tells
+        return [{"start": offset, "end": offset + len(original), "original": original, "replacement": corrected}]
+    offsets = [offset]
+    for token in before:
+        offsets.append(offsets[-1] + len(token))
+    edits = []
+    matcher = difflib.SequenceMatcher(None, before, after)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        edits.append({
+            "start": offsets[old_start],
+            "end": offsets[old_end],
+            "original": "".join(before[old_start:old_end]),
+            "replacement": "".join(after[new_start:new_end]),
+        })
+    return edits
+
+def diff_edits(original: str, corrected: str) -> List[dict]:
+    # Edits that turn original into corrected, with character offsets into original. Sentences are
+    # matched first and only the sentences that differ are diffed word by word, so the cost follows
+    # the size of the changes rather than the square of the document's length
+    if original == corrected:
+        return []
+    before = SENTENCE.findall(original)
+    after = SENTENCE.findall(corrected)
+    offsets = [0]
+    for sentence in before:
+        offsets.append(offsets[-1] + len(sentence))
+    edits = []
+    matcher = difflib.SequenceMatcher(None, before, after)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == "equal":
+            continue
+        edits.extend(_word_edits("".join(before[old_start:old_end]), "".join(after[new_start:new_end]), offsets[old_start]))
+    return edits
@@ -1,22 +1,558 @@
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+
+from typing import Tuple
+
 from ai.aiclient import *
+from ai.codec import dumps
 from .modules import *
+from .cache import ResponseCache, make_cache_key
+from .singleflight import SingleFlight
+from .streaming import IncrementalFieldParser
+from .chunking import split_text, stitch
+from .tokens import TokenCounter, PromptTooLarge
+from .local import LocalClassifiers
+from .edits import resolve_edits, apply_edits, diff_edits
+from .ledger import record_usage
+from .admission import AdmissionController, current_ticket
+from .metrics import (
+    UPSTREAM_LATENCY, TOKENS, COST, ERRORS, UPSTREAM_IN_FLIGHT, UPSTREAM_QUEUED,
+    CACHE_EVENTS, COALESCED, EDIT_MODE, span, record_span, mark_validation
+)
+
+logger = logging.getLogger(__name__)
+
+# Background jobs run their upstream calls in a lane of their own, so bulk work never takes the
+# slots interactive requests wait for
+current_lane: ContextVar[str] = ContextVar("current_lane", default="interactive")
+
+def module_label(module: BaseModule) -> str:
+    # Packed and fused calls run as plain BaseModule instances, label those by their function
+    if type(module) is BaseModule:
+        return getattr(module, "label", module.function.name)
+    return type(module).__name__
 
 class Engine:
-    def __init__(self, ai_client: AIClient, model: Model):
+    def __init__(self, ai_client: AIClient, model: Model, max_concurrency: int = 200, cache: Optional[ResponseCache] = None, coalesce: bool = True, chunking: Optional[dict] = None, max_output_tokens: int = 4096, tokenizer_cache_dir: Optional[str] = None, module_models: Optional[Dict[str, Model]] = None, local: Optional[LocalClassifiers] = None, bulk_max_concurrency: int = 16, admission: Optional[AdmissionController] = None, edit_mode: Optional[dict] = None):
         self.ai_client = ai_client
         self.model = model
+        # Upper bound on upstream completions in flight for this worker
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.bulk_max_concurrency = bulk_max_concurrency
+        self.bulk_semaphore = asyncio.Semaphore(bulk_max_concurrency)
+        # Tiered, deadline-aware scheduling of the interactive slots, replaces the plain semaphore
+        self.admission = admission
+        self.in_flight = 0
+        self.waiting = 0
+        UPSTREAM_IN_FLIGHT.set_function(lambda: self.in_flight)
+        UPSTREAM_QUEUED.set_function(lambda: self.waiting)
+        self.cache = cache
+        # Identical requests already in flight share one upstream call
+        self.singleflight = SingleFlight() if coalesce else None
+        self.temperature = 0.7
+        # Per-call completion budgets come from the module and input length, capped here
+        self.max_output_tokens = max_output_tokens
+        self.tokenizer_cache_dir = tokenizer_cache_dir
+        self.tokens = TokenCounter(ai_client.model.name, tokenizer_cache_dir)
+        self._token_counters = {ai_client.model.name: self.tokens}
+        # Cheaper or faster models for individual modules, keyed by module class name
+        self.module_models = module_models or {}
+        # Answers classification modules without a completion when confident enough
+        self.local = local
+        self._packed_functions = {}
+        chunking = chunking or {}
+        self.chunk_tokens = chunking.get("chunk_tokens", 1200)
+        self.chunk_parallel = chunking.get("max_parallel", 8)
+        self.chunk_max_tokens = chunking.get("max_tokens", 2048)
+        self.reduce_depth = chunking.get("max_reduce_depth", 3)
+        # Inputs of at least this many tokens ask modules with an edit_module for an edit list
+        # instead of the whole corrected text, None turns edit mode off
+        edit_mode = edit_mode or {}
+        self.edit_min_tokens = edit_mode.get("min_tokens", 150) if edit_mode.get("enabled", False) else None
+
+    def model_for(self, label: str) -> Model:
+        return self.module_models.get(label, self.ai_client.model)
+
+    def token_counter(self, model: Model) -> TokenCounter:
+        counter = self._token_counters.get(model.name)
+        if counter is None:
+            counter = self._token_counters[model.name] = TokenCounter(model.name, self.tokenizer_cache_dir)
+        return counter
+
+    def warm_up(self):
+        # Loads every tokenizer the modules use and counts each schema once, so workers forked
+        # afterwards share them and their first requests do no tokenizer work
+        estimated = set()
+        for module_class in MODULES.values():
+            for cls in (module_class, module_class.edit_module):
+                if cls is not None:
+                    counter = self.token_counter(self.model_for(cls.__name__))
+                    counter.count_schema(cls.function.schema_json)
+                    if counter.encoding is None:
+                        estimated.add(counter.model_name)
+        if estimated:
+            logger.warning("tokenizer unavailable, token counts are estimated", extra={"fields": {"models": sorted(estimated)}})
+        return {"estimated_models": sorted(estimated)}
+
+    def cache_key(self, module: BaseModule, max_tokens: int) -> str:
+        return make_cache_key(
+            self.model_for(module_label(module)).name,
+            module.function.fingerprint,
+            module.prompt.messages,
+            {"temperature": self.temperature, "max_tokens": max_tokens}
+        )
+
+    def budget(self, module: BaseModule, max_tokens: Optional[int] = None) -> dict:
+        # Counted locally before the call, so oversized prompts never reach the provider
+        model = self.model_for(module_label(module))
+        tokens = self.token_counter(model)
+        prompt_tokens = tokens.count_prompt(module.prompt.messages, module.function.schema_json)
+        room = tokens.context_window - prompt_tokens
+        if room < module.output_floor:
+            raise PromptTooLarge(
+                f"Prompt needs {prompt_tokens} tokens, which leaves no room for a reply "
+                f"in the {tokens.context_window} token context window"
+            )
+        wanted = module.output_budget(tokens.count(module.prompt.user_content))
+        max_tokens = min(wanted, max_tokens or self.max_output_tokens, room)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "max_tokens": max_tokens,
+            "estimated_cost": CostCalculator.calculate_cost(prompt_tokens, max_tokens, model.cost_per_thousand_input, model.cost_per_thousand_output),
+        }
+
+    def estimate(self, module_class, params: dict) -> dict:
+        # Upper bound for a request, summed over chunks when the module would chunk the input
+        text = params.get("text", "")
+        if module_class.chunk_mode is not None:
+            chunks = split_text(text, self.chunk_tokens, self.tokens.count)
+            if len(chunks) > 1:
+                budgets = [self.budget(module_class(chunk.text), self.chunk_max_tokens) for chunk in chunks]
+                return {
+                    "calls": len(budgets),
+                    "prompt_tokens": sum(budget["prompt_tokens"] for budget in budgets),
+                    "max_tokens": sum(budget["max_tokens"] for budget in budgets),
+                    "estimated_cost": sum(budget["estimated_cost"] for budget in budgets),
+                }
+        return {"calls": 1, **self.budget(module_class(**params))}
+
+    def _local_response(self, module: BaseModule) -> Optional[Response]:
+        label = module_label(module)
+        if self.local is None or not self.local.handles(label) or not hasattr(module, "text"):
+            return None
+        with span("local"):
+            structured_arguments = self.local.classify(label, module.text)
+        if structured_arguments is None:
+            return None
+        return Response.from_local(self.model_for(label), structured_arguments)
+
+    def _use_cache(self, module: BaseModule) -> bool:
+        return self.cache is not None and module.cacheable
 
-    def run_module(self, module: BaseModule):
+    def _cached_response(self, module: BaseModule, key: str):
+        if not self._use_cache(module):
+            return None
+        return self._cache_result(module, self.cache.get(key))
+
+    async def _cached_response_async(self, module: BaseModule, key: str):
+        if not self._use_cache(module):
+            return None
+        return self._cache_result(module, await self.cache.get_async(key))
+
+    def _cache_result(self, module: BaseModule, raw_arguments):
+        if raw_arguments is None:
+            CACHE_EVENTS.inc(result="miss")
+            return None
+        CACHE_EVENTS.inc(result="hit")
+        return Response.from_cache(self.model_for(module_label(module)), raw_arguments=raw_arguments)
+
+    def _record_usage(self, module: BaseModule, response: Response, seconds: float):
+        label = module_label(module)
+        UPSTREAM_LATENCY.observe(seconds, module=label)
+        TOKENS.inc(response.input_tokens, module=label, direction="input")
+        TOKENS.inc(response.output_tokens, module=label, direction="output")
+        COST.inc(response.cost, module=label)
+        record_usage(label, response.input_tokens, response.output_tokens, response.cost)
+
+    def _store(self, module: BaseModule, key: str, response: Response, background: bool = False):
+        # Loosely typed output is coerced to the function's schema before anyone sees it
+        arguments = module.function.conform(response.structured_arguments)
+        if arguments is None:
+            # Output the response model would reject is never cached, the next call asks again
+            CACHE_EVENTS.inc(result="rejected")
+            logger.warning("%s returned arguments that do not match its schema, not caching them", module_label(module))
+            return
+        if arguments != response.structured_arguments:
+            response.structured_arguments = arguments
+            response.raw_arguments = None
+        if self._use_cache(module):
+            value = response.raw_arguments if response.raw_arguments is not None else dumps(response.structured_arguments)
+            if background:
+                self.cache.set_in_background(key, value)
+            else:
+                self.cache.set(key, value)
+
+    async def _acquire_slot(self):
+        # Returns the function that frees the slot again
+        if current_lane.get() == "bulk":
+            await self.bulk_semaphore.acquire()
+            return self.bulk_semaphore.release
+        if self.admission is not None:
+            return await self.admission.acquire(current_ticket.get())
+        await self.semaphore.acquire()
+        return self.semaphore.release
+
+    async def _call_upstream(self, module: BaseModule, key: str, max_tokens: int) -> Response:
+        self.waiting += 1
+        try:
+            release = await self._acquire_slot()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            label = module_label(module)
+            response = await self.ai_client.chat_async(module.prompt, module.function, self.temperature, max_tokens, label, self.model_for(label))
+        finally:
+            self.in_flight -= 1
+            release()
+        elapsed = time.perf_counter() - started
+        record_span("upstream", elapsed - response.parse_seconds)
+        record_span("parse", response.parse_seconds)
+        self._record_usage(module, response, elapsed)
+        self._store(module, key, response, background=True)
+        return response
+
+    def run_module(self, module: BaseModule, max_tokens: Optional[int] = None):
         if isinstance(module, BaseModule):
             if module.prompt and module.function:
+                local = self._local_response(module)
+                if local is not None:
+                    return local
+                max_tokens = self.budget(module, max_tokens)["max_tokens"]
                 try:
+                    key = self.cache_key(module, max_tokens) if self._use_cache(module) else None
+                    cached = self._cached_response(module, key)
+                    if cached is not None:
+                        return cached
                     # Run the module's function with the prompt and function
-                    response = self.ai_client.chat(module.prompt, module.function)
-                    response.log()  # Log the response
+                    label = module_label(module)
+                    response = self.ai_client.chat(module.prompt, module.function, self.temperature, max_tokens, label, self.model_for(label))
+                    self._store(module, key, response)
                     return response
                 except Exception as e:
-                    print(f"[Error] AI client failed: {e}")
+                    ERRORS.inc(where="engine", type=type(e).__name__)
+                    logger.error("AI client failed: %s", e)
+                    raise
+            else:
+                logger.error("Module prompt or function not set")
+        else:
+            logger.error("Invalid module type")
+
+    async def run_module_async(self, module: BaseModule, max_tokens: Optional[int] = None):
+        if isinstance(module, BaseModule):
+            if module.prompt and module.function:
+                mark_validation()
+                local = self._local_response(module)
+                if local is not None:
+                    return local
+                with span("prompt_build"):
+                    max_tokens = self.budget(module, max_tokens)["max_tokens"]
+                    key = self.cache_key(module, max_tokens)
+                try:
+                    cached = await self._cached_response_async(module, key)
+                    if cached is not None:
+                        return cached
+                    if self.singleflight is None:
+                        return await self._call_upstream(module, key, max_tokens)
+                    # Lanes never share a call, or an interactive request could wait on a bulk slot
+                    flight = key if current_lane.get() == "interactive" else f"{current_lane.get()}:{key}"
+                    if flight in self.singleflight.calls:
+                        COALESCED.inc(module=module_label(module))
+                    return await self.singleflight.do(flight, lambda: self._call_upstream(module, key, max_tokens))
+                except Exception as e:
+                    ERRORS.inc(where="engine", type=type(e).__name__)
+                    logger.error("AI client failed: %s", e)
+                    raise
             else:
-                print("[Error] Module prompt or function not set")
+                logger.error("Module prompt or function not set")
         else:
-            print("[Error] Invalid module type")
+            logger.error("Invalid module type")
+
+    def _uses_edits(self, module_class) -> bool:
+        return self.edit_min_tokens is not None and module_class.edit_module is not None
+
+    async def _run_edits_async(self, module_class, text: str) -> Optional[Response]:
+        # The corrected text rebuilt from the model's edit list, with the edits as applied, or None
+        # when the edits are unusable
+        label = module_class.__name__
+        try:
+            response = await self.run_module_async(module_class.edit_module(text))
+        except UpstreamError as e:
+            # Malformed output falls back to a full rewrite, capacity errors would only repeat
+            if e.status_code != 502:
+                raise
+            EDIT_MODE.inc(module=label, result="fallback")
+            return None
+        edits = response.structured_arguments.get("edits")
+        edits = resolve_edits(text, edits) if isinstance(edits, list) else None
+        if edits is None:
+            EDIT_MODE.inc(module=label, result="fallback")
+            return None
+        EDIT_MODE.inc(module=label, result="applied")
+        corrected = apply_edits(text, edits)
+        return Response.combine(self.model_for(label), {module_class.function.required[0]: corrected, "edits": edits}, [response])
+
+    async def _run_chunk_async(self, module_class, text: str) -> Response:
+        if self._uses_edits(module_class) and self.tokens.count(text) >= self.edit_min_tokens:
+            response = await self._run_edits_async(module_class, text)
+            if response is not None:
+                return response
+        return await self.run_module_async(module_class(text), self.chunk_max_tokens)
+
+    async def _with_edits(self, module_class, text: str, response: Response) -> Response:
+        # Edits the model produced for the whole text are returned as they are. Otherwise they are
+        # diffed from the final text, in a thread since a long document takes a while
+        if not self._uses_edits(module_class) or "edits" in response.structured_arguments:
+            return response
+        field = module_class.function.required[0]
+        corrected = response.structured_arguments[field]
+        edits = await asyncio.to_thread(diff_edits, text, corrected) if corrected != text else []
+        return Response.combine(response.model, {field: corrected, "edits": edits}, [response])
+
+    async def run_chunked_async(self, module_class, text: str, depth: int = 0):
+        # Long inputs are split on paragraph/sentence boundaries and the chunks run concurrently
+        chunks = split_text(text, self.chunk_tokens, self.tokens.count)
+        if module_class.chunk_mode is None or len(chunks) <= 1:
+            return await self._with_edits(module_class, text, await self._run_chunk_async(module_class, text))
+        limiter = asyncio.Semaphore(self.chunk_parallel)
+
+        async def run_chunk(chunk):
+            async with limiter:
+                return await self._run_chunk_async(module_class, chunk.text)
+
+        responses = await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+        field = module_class.function.required[0]
+        outputs = [response.structured_arguments[field] for response in responses]
+        if module_class.chunk_mode == "reduce" and depth < self.reduce_depth:
+            reduced = await self.run_chunked_async(module_class, "\n\n".join(outputs), depth + 1)
+            return Response.combine(self.model_for(module_class.__name__), reduced.structured_arguments, [*responses, reduced])
+        response = Response.combine(self.model_for(module_class.__name__), {field: stitch(chunks, outputs)}, responses)
+        return await self._with_edits(module_class, text, response)
+
+    async def run_packed_async(self, module_class, texts: List[str]):
+        # One completion for several texts of a packable module, results come back in input order
+        function = self._packed_functions.get(module_class)
+        if function is None:
+            function = self._packed_functions[module_class] = packed_function(module_class.function)
+        module = BaseModule()
+        module.label = module_class.__name__
+        module.function = function
+        module.prompt = packed_prompt(module_class.function, texts)
+        # Each packed result needs about as much room as a single call would
+        response = await self.run_module_async(module, module_class.output_budget(0) * len(texts) + 32)
+        results = [None] * len(texts)
+        required = module_class.function.required
+        for result in response.structured_arguments.get("results", []):
+            if not isinstance(result, dict):
+                continue
+            # The response may be shared with other single-flight callers, so it is copied, not popped
+            result = dict(result)
+            index = result.pop("index", None)
+            # A result missing a required field is left as None and retried on its own
+            if isinstance(index, int) and 0 <= index < len(texts) and all(result.get(name) is not None for name in required):
+                results[index] = result
+        return results, response
+
+    async def run_batch_async(self, items: List[Tuple[str, dict]], max_parallel: int = 16, pack_size: int = 20, pack: bool = True):
+        results = [None] * len(items)
+        responses = []
+        limiter = asyncio.Semaphore(max_parallel)
+        singles = []
+        packs = {}
+        for index, (name, params) in enumerate(items):
+            module_class = MODULES.get(name)
+            if module_class is None:
+                results[index] = {"module": name, "status": "fail", "message": f"Unknown module '{name}'"}
+            # Only plain text goes to the local and packed lanes, anything else fails on its own in run_single
+            elif pack and module_class.packable and set(params) == {"text"} and isinstance(params["text"], str):
+                packs.setdefault(module_class, []).append(index)
+            else:
+                singles.append(index)
+
+        async def run_single(index: int):
+            name, params = items[index]
+            try:
+                module = MODULES[name](**params)
+            except TypeError as e:
+                results[index] = {"module": name, "status": "fail", "message": f"Invalid params: {e}"}
+                return
+            try:
+                async with limiter:
+                    response = await self.run_module_async(module)
+            except (PromptTooLarge, UpstreamError) as e:
+                results[index] = {"module": name, "status": "fail", "message": str(e)}
+                return
+            except Exception:
+                results[index] = {"module": name, "status": "fail", "message": "Module failed"}
+                return
+            responses.append(response)
+            results[index] = {"module": name, "status": "success", "source": response.source, "data": response.structured_arguments}
+
+        async def run_pack(module_class, indices: List[int]):
+            try:
+                async with limiter:
+                    packed, response = await self.run_packed_async(module_class, [items[index][1]["text"] for index in indices])
+            except Exception:
+                packed, response = [None] * len(indices), None
+            if response is not None:
+                responses.append(response)
+            missing = []
+            for index, result in zip(indices, packed):
+                if result is None:
+                    missing.append(index)
+                else:
+                    results[index] = {"module": module_class.__name__, "status": "success", "source": "model", "data": result}
+            # Anything the packed completion dropped is retried on its own
+            await asyncio.gather(*(run_single(index) for index in missing))
+
+        if self.local is not None:
+            # Settle whatever the local classifiers are sure about before packing the rest
+            for module_class, indices in list(packs.items()):
+                label = module_class.__name__
+                if not self.local.handles(label):
+                    continue
+                answers = self.local.classify_many(label, [items[index][1]["text"] for index in indices])
+                for index, answer in zip(indices, answers):
+                    if answer is not None:
+                        results[index] = {"module": label, "status": "success", "source": "local", "data": answer}
+                packs[module_class] = [index for index, answer in zip(indices, answers) if answer is None]
+
+        tasks = [run_single(index) for index in singles]
+        for module_class, indices in packs.items():
+            for start in range(0, len(indices), pack_size):
+                tasks.append(run_pack(module_class, indices[start:start + pack_size]))
+        await asyncio.gather(*tasks)
+        usage = {
+            "input_tokens": sum(response.input_tokens for response in responses),
+            "output_tokens": sum(response.output_tokens for response in responses),
+            "cost_in_dollors": sum(response.cost for response in responses),
+        }
+        return results, usage
+
+    def plan_pipeline(self, modules: List[BaseModule], input_tokens: int, fuse: bool = True) -> List[List[int]]:
+        # Consecutive steps share a completion while their combined output budget fits, a step
+        # that has to chunk a long input runs on its own
+        groups = []
+        budget = 0
+        length = input_tokens
+        for index, module in enumerate(modules):
+            step_budget = type(module).output_budget(length)
+            chunked = module.chunk_mode is not None and length > self.chunk_tokens
+            if fuse and groups and not chunked and not groups[-1][1] and budget + step_budget <= self.max_output_tokens:
+                groups[-1][0].append(index)
+                budget += step_budget
+            else:
+                groups.append(([index], chunked))
+                budget = step_budget
+            if module.transforms_text:
+                length = int(module.output_ratio * length)
+        return [indices for indices, _ in groups]
+
+    async def run_pipeline_async(self, text: str, steps: List[Tuple[str, dict]], fuse: bool = True):
+        # Runs modules in order on the same text, each transforming step feeding the next
+        plan = self.plan_pipeline(
+            [MODULES[name](text, **params) for name, params in steps],
+            self.tokens.count(text),
+            fuse
+        )
+        results = [None] * len(steps)
+        responses = []
+        current = text
+
+        async def run_single(index: int, text: str) -> str:
+            name, params = steps[index]
+            module_class = MODULES[name]
+            if module_class.chunk_mode is not None:
+                response = await self.run_chunked_async(module_class, text)
+            else:
+                response = await self.run_module_async(module_class(text, **params))
+            responses.append(response)
+            results[index] = {"module": name, "source": response.source, "fused": False, "data": response.structured_arguments}
+            if module_class.transforms_text:
+                return response.structured_arguments[module_class.function.required[0]]
+            return text
+
+        for group in plan:
+            if len(group) == 1:
+                current = await run_single(group[0], current)
+                continue
+            pipeline = Pipeline([(index + 1, MODULES[steps[index][0]](current, **steps[index][1])) for index in group], current)
+            response = await self.run_module_async(pipeline)
+            responses.append(response)
+            remaining = []
+            for index, (_, module), result in zip(group, pipeline.steps, pipeline.split(response.structured_arguments)):
+                if result is None or remaining:
+                    # Anything after a step the fused completion left incomplete runs on its own
+                    remaining.append(index)
+                    continue
+                results[index] = {"module": steps[index][0], "source": response.source, "fused": True, "data": result}
+                if module.transforms_text:
+                    current = result[module.function.required[0]]
+            for index in remaining:
+                current = await run_single(index, current)
+        usage = {
+            "calls": sum(1 for response in responses if response.source == "model"),
+            "input_tokens": sum(response.input_tokens for response in responses),
+            "output_tokens": sum(response.output_tokens for response in responses),
+            "cost_in_dollors": sum(response.cost for response in responses),
+        }
+        return results, current, usage
+
+    async def stream_module(self, module: BaseModule, max_tokens: Optional[int] = None):
+        # Yields ("delta", {"field", "text"}) while the completion streams, then ("done", response)
+        fields = [name for name, spec in module.function.properties.items() if spec.get("type") == "string"]
+        parser = IncrementalFieldParser(fields)
+        arguments = []
+        usage = None
+        label = module_label(module)
+        model = self.model_for(label)
+        max_tokens = self.budget(module, max_tokens)["max_tokens"]
+        started = time.perf_counter()
+        release = await self._acquire_slot()
+        self.in_flight += 1
+        try:
+            async for kind, payload in self.ai_client.chat_stream_async(module.prompt, module.function, self.temperature, max_tokens, label, model):
+                if kind == "usage":
+                    usage = payload
+                    continue
+                arguments.append(payload)
+                for field, text in parser.feed(payload):
+                    yield "delta", {"field": field, "text": text}
+        finally:
+            self.in_flight -= 1
+            release()
+        prompt_tokens = usage.prompt_tokens if usage is not None else 0
+        completion_tokens = usage.completion_tokens if usage is not None else 0
+        response = Response.from_stream(model, "".join(arguments), prompt_tokens, completion_tokens)
+        conformed = module.function.conform(response.structured_arguments)
+        if conformed is not None:
+            response.structured_arguments = conformed
+        self._record_usage(module, response, time.perf_counter() - started)
+        yield "done", response
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "pool": self.ai_client.pool_stats(),
+            "resilience": self.ai_client.resilience.stats(),
+            "providers": self.ai_client.provider_stats(),
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "singleflight": self.singleflight.stats() if self.singleflight is not None else None,
+            "local": self.local.stats() if self.local is not None else None,
+            "admission": self.admission.stats() if self.admission is not None else None,
+        }
@@ -0,0 +1,439 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from ai.resilience import UpstreamError
+from .db import SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+# Background jobs for work too slow to hold an HTTP request open. Workers take jobs round-robin
+# across tenants, so one tenant's bulk upload cannot starve the others, and their upstream calls
+# go through the engine's bulk lane instead of the interactive one.
+
+DEFAULT_JOB_SETTINGS = {
+    "store": "sqlite",
+    "sqlite_path": "jobs.sqlite",
+    "workers": 4,
+    "max_attempts": 3,
+    # A running job whose worker has not finished it by then is handed out again
+    "lease_seconds": 900,
+    "poll_seconds": 1.0,
+    "result_ttl_seconds": 86400,
+    "webhook_timeout": 10,
+    "webhook_attempts": 3,
+    "webhook_secret": None,
+    # Hosts webhooks may be sent to, empty allows any host that resolves to public addresses only
+    "webhook_allowed_hosts": [],
+    # Seconds a stopping worker waits for running jobs before putting them back in the queue
+    "stop_grace_seconds": 10,
+}
+
+# Upstream failures worth another attempt later rather than failing the job
+RETRYABLE_STATUS = (429, 502, 503, 504)
+
+def new_job(tenant: str, kind: str, payload: dict, webhook_url: Optional[str]) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "tenant": tenant,
+        "kind": kind,
+        "payload": payload,
+        "webhook_url": webhook_url,
+        "status": "queued",
+        "result": None,
+        "error": None,
+        "attempts": 0,
+        "created_at": now,
+        "not_before": now,
+        "started_at": None,
+        "finished_at": None,
+        "lease_until": None,
+    }
+
+class InvalidWebhook(ValueError):
+    pass
+
+def check_webhook_url(url: str, allowed_hosts: List[str]):
+    # Webhooks go out from inside our network, so they may only reach public https endpoints
+    parts = urlsplit(url)
+    if parts.scheme != "https" or not parts.hostname:
+        raise InvalidWebhook("webhook_url must be an https URL")
+    host = parts.hostname.lower()
+    if allowed_hosts and host not in {allowed.lower() for allowed in allowed_hosts}:
+        raise InvalidWebhook(f"Webhooks to {host} are not allowed")
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise InvalidWebhook(f"webhook_url host {host} does not resolve")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        if not ip.is_global:
+            raise InvalidWebhook(f"webhook_url host {host} resolves to a non-public address")
+
+def public_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "result": job["result"],
+        "error": job["error"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+class MemoryJobStore:
+    # Lives and dies with the process, for development and tests
+    blocking = False
+
+    def __init__(self):
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.queues: Dict[str, deque] = {}
+
+    def add(self, job: Dict[str, Any]):
+        self.jobs[job["id"]] = job
+        self.queues.setdefault(job["tenant"], deque()).append(job["id"])
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def tenants(self, now: float) -> List[str]:
+        return sorted(tenant for tenant, queue in self.queues.items() if queue and self.jobs[queue[0]]["not_before"] <= now)
+
+    def claim(self, tenant: str, now: float, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        queue = self.queues.get(tenant)
+        if not queue or self.jobs[queue[0]]["not_before"] > now:
+            return None
+        job = self.jobs[queue.popleft()]
+        job.update(status="running", started_at=now, lease_until=now + lease_seconds, attempts=job["attempts"] + 1)
+        return dict(job)
+
+    def finish(self, job_id: str, status: str, result: Any = None, error: Optional[str] = None):
+        self.jobs[job_id].update(status=status, result=result, error=error, finished_at=time.time(), lease_until=None)
+
+    def retry(self, job_id: str, not_before: float, error: str):
+        job = self.jobs[job_id]
+        job.update(status="queued", error=error, not_before=not_before, lease_until=None)
+        self.queues.setdefault(job["tenant"], deque()).append(job_id)
+
+    def release(self, job_id: str):
+        # A job a stopping worker did not finish, queued again without counting the attempt
+        job = self.jobs[job_id]
+        if job["status"] == "running":
+            job["attempts"] -= 1
+            self.retry(job_id, time.time(), "Worker stopped")
+
+    def requeue_expired(self, now: float, max_attempts: int) -> int:
+        # A job that keeps outliving its lease (killing its worker, say) fails once out of attempts
+        expired = [job for job in self.jobs.values() if job["status"] == "running" and job["lease_until"] < now]
+        requeued = 0
+        for job in expired:
+            if job["attempts"] >= max_attempts:
+                self.finish(job["id"], "failed", error="Lease expired")
+            else:
+                self.retry(job["id"], now, "Lease expired")
+                requeued += 1
+        return requeued
+
+    def purge(self, before: float):
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["finished_at"] and job["finished_at"] < before]:
+            del self.jobs[job_id]
+
+    def counts(self) -> Dict[str, int]:
+        return dict(Counter(job["status"] for job in self.jobs.values()))
+
+class SQLiteJobStore:
+    # Shared by every worker process on the host and kept across restarts. Calls can wait on
+    # another process's write lock, so the queue makes them from a thread
+    blocking = True
+    COLUMNS = (
+        "id", "tenant", "kind", "payload", "webhook_url", "status", "result", "error", "attempts",
+        "created_at", "not_before", "started_at", "finished_at", "lease_until"
+    )
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.connection = SQLiteDatabase(path, [
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, tenant TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL, webhook_url TEXT, "
+            "status TEXT NOT NULL, result TEXT, error TEXT, attempts INTEGER NOT NULL, created_at REAL NOT NULL, "
+            "not_before REAL NOT NULL, started_at REAL, finished_at REAL, lease_until REAL)",
+            "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, tenant, created_at)",
+        ])
+
+    def _row(self, row) -> Dict[str, Any]:
+        job = dict(zip(self.COLUMNS, row))
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def add(self, job: Dict[str, Any]):
+        values = {**job, "payload": json.dumps(job["payload"]), "result": None}
+        with self.lock:
+            self.connection.execute(
+                f"INSERT INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                [values[column] for column in self.COLUMNS]
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.connection.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row is not None else None
+
+    def tenants(self, now: float) -> List[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT tenant FROM jobs WHERE status = 'queued' AND not_before <= ? ORDER BY tenant", (now,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def claim(self, tenant: str, now: float, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so two processes cannot claim the same job
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status = 'queued' AND tenant = ? AND not_before <= ? "
+                    "ORDER BY created_at LIMIT 1",
+                    (tenant, now)
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET status = 'running', started_at = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                        (now, now + lease_seconds, row[0])
+                    )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._row(row)
+        job.update(status="running", started_at=now, lease_until=now + lease_seconds, attempts=job["attempts"] + 1)
+        return job
+
+    def finish(self, job_id: str, status: str, result: Any = None, error: Optional[str] = None):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+
+    def retry(self, job_id: str, not_before: float, error: str):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'queued', error = ?, not_before = ?, lease_until = NULL WHERE id = ?",
+                (error, not_before, job_id)
+            )
+
+    def release(self, job_id: str):
+        # A job a stopping worker did not finish, queued again without counting the attempt
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'queued', error = 'Worker stopped', not_before = ?, lease_until = NULL, "
+                "attempts = attempts - 1 WHERE id = ? AND status = 'running'",
+                (time.time(), job_id)
+            )
+
+    def requeue_expired(self, now: float, max_attempts: int) -> int:
+        # A job that keeps outliving its lease (killing its worker, say) fails once out of attempts
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Lease expired', finished_at = ?, lease_until = NULL "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, max_attempts)
+            )
+            cursor = self.connection.execute(
+                "UPDATE jobs SET status = 'queued', error = 'Lease expired', not_before = ?, lease_until = NULL "
+                "WHERE status = 'running' AND lease_until < ?",
+                (now, now)
+            )
+        return cursor.rowcount
+
+    def purge(self, before: float):
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (before,))
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+class JobQueue:
+    def __init__(self, store, settings: Optional[dict] = None):
+        self.store = store
+        self.settings = {**DEFAULT_JOB_SETTINGS, **(settings or {})}
+        self.workers: List[asyncio.Task] = []
+        self.wakeup: Optional[asyncio.Event] = None
+        self.stopping = False
+        # Jobs claimed by this process and not finished yet, put back in the queue on stop
+        self.active: Dict[str, Dict[str, Any]] = {}
+        self.last_tenant: Optional[str] = None
+        self.running = 0
+        self.webhooks = Counter()
+        self.http: Optional[httpx.AsyncClient] = None
+
+    async def _offload(self, function: Callable, *args):
+        # Blocking store calls run in a thread, so the event loop keeps serving requests
+        if self.store.blocking:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    async def check_webhook(self, url: str):
+        # Raises InvalidWebhook
+        await asyncio.to_thread(check_webhook_url, url, self.settings["webhook_allowed_hosts"])
+
+    async def submit(self, tenant: str, kind: str, payload: dict, webhook_url: Optional[str] = None) -> Dict[str, Any]:
+        if webhook_url:
+            await self.check_webhook(webhook_url)
+        job = new_job(tenant, kind, payload, webhook_url)
+        await self._offload(self.store.add, job)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._offload(self.store.get, job_id)
+
+    def start(self, runner: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.http = httpx.AsyncClient(timeout=self.settings["webhook_timeout"])
+        # Jobs a crashed or restarted worker was holding go back in the queue
+        self.store.requeue_expired(time.time(), self.settings["max_attempts"])
+        self.workers = [asyncio.ensure_future(self._work(runner)) for _ in range(self.settings["workers"])]
+
+    async def stop(self):
+        # Workers stop claiming and get a grace period to finish what they hold, jobs still running
+        # after it go back in the queue for another process instead of waiting out their lease
+        self.stopping = True
+        if self.wakeup is not None:
+            self.wakeup.set()
+        if self.workers:
+            await asyncio.wait(self.workers, timeout=self.settings["stop_grace_seconds"])
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for job_id in list(self.active):
+            await self._offload(self.store.release, job_id)
+        self.active.clear()
+        if self.http is not None:
+            await self.http.aclose()
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        # Round-robin over tenants with runnable jobs, starting after the one served last
+        now = time.time()
+        tenants = self.store.tenants(now)
+        if not tenants:
+            return None
+        start = next((index for index, tenant in enumerate(tenants) if self.last_tenant is None or tenant > self.last_tenant), 0)
+        for tenant in tenants[start:] + tenants[:start]:
+            job = self.store.claim(tenant, now, self.settings["lease_seconds"])
+            if job is not None:
+                self.last_tenant = tenant
+                return job
+        return None
+
+    async def _work(self, runner: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        polls = 0
+        while not self.stopping:
+            job = await self._offload(self._claim)
+            if job is None:
+                polls += 1
+                if polls % 60 == 0:
+                    now = time.time()
+                    await self._offload(self.store.requeue_expired, now, self.settings["max_attempts"])
+                    await self._offload(self.store.purge, now - self.settings["result_ttl_seconds"])
+                if self.stopping:
+                    break
+                self.wakeup.clear()
+                try:
+                    # Other processes add jobs too, so wake up on a timer as well as on submit
+                    await asyncio.wait_for(self.wakeup.wait(), self.settings["poll_seconds"])
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if self.stopping:
+                # Claimed while stop() was starting, left for another process
+                await self._offload(self.store.release, job["id"])
+                break
+            await self._run(job, runner)
+
+    async def _run(self, job: Dict[str, Any], runner: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        self.running += 1
+        self.active[job["id"]] = job
+        try:
+            result = await runner(job)
+        except UpstreamError as e:
+            self.active.pop(job["id"], None)
+            if e.status_code in RETRYABLE_STATUS and job["attempts"] < self.settings["max_attempts"]:
+                delay = e.retry_after if e.retry_after is not None else 2 ** job["attempts"]
+                await self._offload(self.store.retry, job["id"], time.time() + delay, str(e))
+                return
+            await self._offload(self.store.finish, job["id"], "failed", None, str(e))
+        except Exception as e:
+            self.active.pop(job["id"], None)
+            logger.error("Job %s failed: %s", job["id"], e)
+            await self._offload(self.store.finish, job["id"], "failed", None, str(e) if isinstance(e, (TypeError, ValueError)) else "Job failed")
+        else:
+            self.active.pop(job["id"], None)
+            await self._offload(self.store.finish, job["id"], "succeeded", result)
+        finally:
+            self.running -= 1
+        if job["webhook_url"]:
+            await self._deliver(await self._offload(self.store.get, job["id"]))
+
+    async def _deliver(self, job: Dict[str, Any]):
+        body = json.dumps(public_view(job)).encode("utf-8")
+        try:
+            # Checked again at delivery, the host may resolve differently by now
+            await self.check_webhook(job["webhook_url"])
+        except InvalidWebhook as e:
+            self.webhooks["refused"] += 1
+            logger.warning("Webhook for job %s refused: %s", job["id"], e)
+            return
+        headers = {"Content-Type": "application/json"}
+        if self.settings["webhook_secret"]:
+            digest = hmac.new(self.settings["webhook_secret"].encode("utf-8"), body, hashlib.sha256).hexdigest()
+            headers["X-Signature"] = f"sha256={digest}"
+        for attempt in range(self.settings["webhook_attempts"]):
+            try:
+                response = await self.http.post(job["webhook_url"], content=body, headers=headers)
+                if response.status_code < 500:
+                    self.webhooks["delivered" if response.status_code < 400 else "rejected"] += 1
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(2 ** attempt)
+        self.webhooks["failed"] += 1
+        logger.warning("Webhook for job %s could not be delivered", job["id"])
+
+    async def stats(self) -> Dict[str, Any]:
+        return {"jobs": await self._offload(self.store.counts), "running": self.running, "workers": len(self.workers), "webhooks": dict(self.webhooks)}
+
+def build_jobs(settings: Optional[dict]) -> JobQueue:
+    settings = {**DEFAULT_JOB_SETTINGS, **(settings or {})}
+    if settings["store"] == "sqlite" and settings.get("sqlite_path"):
+        directory = os.path.dirname(settings["sqlite_path"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return JobQueue(SQLiteJobStore(settings["sqlite_path"]), settings)
+    return JobQueue(MemoryJobStore(), settings)
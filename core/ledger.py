@@ -0,0 +1,141 @@
+import os
+import queue
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from .db import SQLiteDatabase
+
+# Per-request cost ledger. The engine adds every completion's tokens and cost to the current
+# request's tally, and when the request finishes its tally is appended, one row per module, to a
+# SQLite table that a writer thread fills in batches. Rows are never updated, billing reads them
+# back through query().
+
+DEFAULT_LEDGER_SETTINGS = {
+    "enabled": True,
+    "sqlite_path": "ledger.sqlite",
+    "flush_seconds": 1.0,
+    # Token allowed to read every consumer's usage, unset lets consumers read only their own
+    "admin_token": None,
+}
+
+BUCKETS = {"minute": 60, "hour": 3600, "day": 86400}
+GROUP_COLUMNS = ("module", "consumer", "route")
+
+class UsageTally:
+    def __init__(self, request_id: Optional[str] = None, consumer: str = "anonymous", route: str = "unmatched"):
+        self.request_id = request_id
+        self.consumer = consumer
+        self.route = route
+        # module -> [calls, input tokens, output tokens, cost]
+        self.modules: Dict[str, List[float]] = {}
+
+    def add(self, module: str, input_tokens: int, output_tokens: int, cost: float):
+        entry = self.modules.get(module)
+        if entry is None:
+            entry = self.modules[module] = [0, 0, 0, 0.0]
+        entry[0] += 1
+        entry[1] += input_tokens
+        entry[2] += output_tokens
+        entry[3] += cost
+
+    def cost(self) -> float:
+        return sum(entry[3] for entry in self.modules.values())
+
+    def tokens(self) -> Tuple[int, int]:
+        return sum(entry[1] for entry in self.modules.values()), sum(entry[2] for entry in self.modules.values())
+
+current_tally: ContextVar[Optional[UsageTally]] = ContextVar("current_tally", default=None)
+
+def record_usage(module: str, input_tokens: int, output_tokens: int, cost: float):
+    tally = current_tally.get()
+    if tally is not None:
+        tally.add(module, input_tokens, output_tokens, cost)
+
+class CostLedger:
+    def __init__(self, path: str, flush_seconds: float = 1.0):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.pending: queue.SimpleQueue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.connection = SQLiteDatabase(path, [
+            "CREATE TABLE IF NOT EXISTS usage ("
+            "ts REAL NOT NULL, request_id TEXT, consumer TEXT NOT NULL, route TEXT NOT NULL, module TEXT NOT NULL, "
+            "calls INTEGER NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, cost REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts)",
+            "CREATE INDEX IF NOT EXISTS usage_consumer_ts ON usage (consumer, ts)",
+        ])
+        self.rows = 0
+        self.stopping = threading.Event()
+        self.writer = None
+
+    def start(self):
+        if self.writer is None:
+            self.stopping.clear()
+            self.writer = threading.Thread(target=self._write_loop, name="cost-ledger", daemon=True)
+            self.writer.start()
+
+    def stop(self):
+        if self.writer is not None:
+            self.stopping.set()
+            self.writer.join()
+            self.writer = None
+        self.flush()
+
+    def settle(self, tally: UsageTally):
+        # Queues the tally's rows and empties it. Called on the event loop, so nothing is written here
+        now = time.time()
+        for module, (calls, input_tokens, output_tokens, cost) in tally.modules.items():
+            self.pending.put((now, tally.request_id, tally.consumer, tally.route, module, calls, input_tokens, output_tokens, cost))
+        tally.modules = {}
+
+    def _write_loop(self):
+        while not self.stopping.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return
+        with self.lock:
+            self.connection.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.rows += len(rows)
+
+    def query(self, start: float, end: float, bucket: str = "hour", group_by: List[str] = (), consumer: Optional[str] = None) -> List[Dict[str, Any]]:
+        # Totals per time bucket and per value of each group_by column
+        seconds = BUCKETS[bucket]
+        columns = [column for column in GROUP_COLUMNS if column in group_by]
+        selected = "".join(f", {column}" for column in columns)
+        where = "ts >= ? AND ts < ?"
+        params: list = [start, end]
+        if consumer is not None:
+            where += " AND consumer = ?"
+            params.append(consumer)
+        with self.lock:
+            cursor = self.connection.execute(
+                f"SELECT CAST(ts / {seconds} AS INTEGER) * {seconds} AS bucket{selected}, "
+                "COUNT(DISTINCT request_id), SUM(calls), SUM(input_tokens), SUM(output_tokens), SUM(cost) "
+                f"FROM usage WHERE {where} GROUP BY bucket{selected} ORDER BY bucket{selected}",
+                params
+            )
+            rows = cursor.fetchall()
+        keys = ["bucket", *columns, "requests", "calls", "input_tokens", "output_tokens", "cost_in_dollors"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rows_written": self.rows, "pending": self.pending.qsize()}
+
+def build_ledger(settings: Optional[dict]) -> Optional[CostLedger]:
+    settings = {**DEFAULT_LEDGER_SETTINGS, **(settings or {})}
+    if not settings.get("enabled", False) or not settings.get("sqlite_path"):
+        return None
+    directory = os.path.dirname(settings["sqlite_path"])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return CostLedger(settings["sqlite_path"], settings["flush_seconds"])
@@ -0,0 +1,106 @@
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+from .metrics import COLD_START
+
+logger = logging.getLogger(__name__)
+
+# Readiness of one worker: what warm-up did and how long it took, whether the worker is draining,
+# and how long after process start it answered its first request. serve.py stamps the start time
+# in APP_STARTED_AT before importing anything, so imports count towards cold start.
+
+DEFAULT_SERVER_SETTINGS = {
+    "host": "0.0.0.0",
+    "port": 8000,
+    # Unset runs one worker per CPU
+    "workers": 1,
+    "backlog": 2048,
+    # Seconds a worker keeps serving in-flight requests after SIGTERM before closing them
+    "graceful_timeout": 30,
+    "cold_start_target_seconds": 5.0,
+}
+
+STARTED_AT_ENV = "APP_STARTED_AT"
+
+def process_started_at() -> float:
+    # Stamped by the launcher, otherwise the moment this module is first imported
+    try:
+        return float(os.environ[STARTED_AT_ENV])
+    except (KeyError, ValueError):
+        return time.time()
+
+class Lifecycle:
+    def __init__(self, cold_start_target: float):
+        self.started_at = process_started_at()
+        self.cold_start_target = cold_start_target
+        self.warm_steps: Dict[str, float] = {}
+        # What the warm-up steps reported, such as a tokenizer falling back to estimates
+        self.warm_results: Dict[str, Any] = {}
+        self.warmed_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.cold_start: Optional[float] = None
+        self.draining = False
+
+    @property
+    def warm(self) -> bool:
+        return self.warmed_at is not None
+
+    def warm_up(self, steps: Dict[str, Callable[[], Any]]):
+        # Run once, before forking when started by serve.py, so every worker inherits the result
+        for name, step in steps.items():
+            started = time.perf_counter()
+            result = step()
+            self.warm_steps[name] = round(time.perf_counter() - started, 4)
+            if result is not None:
+                self.warm_results[name] = result
+        self.warmed_at = time.time()
+        COLD_START.set(self.warmed_at - self.started_at, phase="warm")
+
+    def serving(self):
+        # Called in each worker once its startup hooks have run
+        self.ready_at = time.time()
+        self.draining = False
+        COLD_START.set(self.ready_at - self.started_at, phase="ready")
+
+    def served(self, seconds: float):
+        # Cold start is what a request sent the moment the process started would have waited: the
+        # time until the worker was ready plus how long its first request took. Time spent idle
+        # waiting for that request does not count
+        if self.cold_start is not None or self.ready_at is None:
+            return
+        self.cold_start = self.ready_at - self.started_at + seconds
+        COLD_START.set(self.cold_start, phase="first_request")
+        fields = {
+            "cold_start_seconds": round(self.cold_start, 3),
+            "target_seconds": self.cold_start_target,
+            "warm_steps": self.warm_steps,
+        }
+        if self.cold_start > self.cold_start_target:
+            logger.warning("cold start over target", extra={"fields": fields})
+        else:
+            logger.info("cold start", extra={"keep": True, "fields": fields})
+
+    def ready(self) -> bool:
+        return self.warm and self.ready_at is not None and not self.draining
+
+    def view(self) -> Dict[str, Any]:
+        if self.draining:
+            status = "draining"
+        elif self.ready():
+            status = "ready"
+        else:
+            status = "starting"
+        return {
+            "status": status,
+            "pid": os.getpid(),
+            "started_at": self.started_at,
+            "warm_steps": self.warm_steps,
+            "warm_results": self.warm_results,
+            "warm_seconds": self.warmed_at - self.started_at if self.warm else None,
+            "ready_seconds": self.ready_at - self.started_at if self.ready_at is not None else None,
+            "cold_start_seconds": self.cold_start,
+            "cold_start_target_seconds": self.cold_start_target,
+            "within_target": self.cold_start <= self.cold_start_target if self.cold_start is not None else None,
+        }
@@ -0,0 +1,366 @@
+import logging
+import re
+from bisect import bisect_right
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # Without numpy the local fast path is off and every call goes to the model
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Local classifiers that answer LanguageDetection and SentimentAnalysis without a completion when
+# they are confident enough, the model still handles everything below the thresholds
+
+DEFAULT_LOCAL_SETTINGS = {
+    "enabled": True,
+    "language_threshold": 0.8,
+    # Lead the best language's posterior needs over the runner-up's
+    "language_margin": 0.9,
+    # Share of the text's trigrams the best language's reference text contains. Languages outside
+    # the trained set score low here even when the posterior is confident
+    "language_min_coverage": 0.4,
+    "sentiment_threshold": 0.5,
+}
+
+# Scripts written by essentially one language are decided by their code points alone. Cyrillic,
+# Devanagari and the like serve many languages and are left to the model
+SCRIPT_RANGES = [
+    (0x0370, 0x03FF, "Greek"),
+    (0x0400, 0x04FF, "Cyrillic"),
+    (0x0590, 0x05FF, "Hebrew"),
+    (0x0600, 0x06FF, "Arabic"),
+    (0x0750, 0x077F, "Arabic"),
+    (0x0900, 0x097F, "Devanagari"),
+    (0x0E00, 0x0E7F, "Thai"),
+    (0x1100, 0x11FF, "Hangul"),
+    (0x3040, 0x30FF, "Kana"),
+    (0x4E00, 0x9FFF, "Han"),
+    (0xAC00, 0xD7AF, "Hangul"),
+    (0xFB50, 0xFDFF, "Arabic"),
+    (0xFE70, 0xFEFF, "Arabic"),
+]
+SCRIPT_STARTS = [start for start, _, _ in SCRIPT_RANGES]
+SCRIPT_LANGUAGES = {
+    "Greek": "Greek",
+    "Hebrew": "Hebrew",
+    "Thai": "Thai",
+    "Hangul": "Korean",
+    "Kana": "Japanese",
+    "Han": "Chinese",
+}
+
+# Reference text per language for the character n-gram profiles, grouped by script
+LANGUAGE_SAMPLES = {
+    "Latin": {
+        "English": (
+            "The quick brown fox jumps over the lazy dog. We have scheduled the meeting for tomorrow "
+            "and everyone should be there on time, because the client will present their new roadmap. "
+            "This is one of the things that I would like to talk about with you when we are together. "
+            "It was the best of times, it was the worst of times, and they were not sure what would happen "
+            "next. Please let me know whether you have any questions about the report or the budget."
+        ),
+        "Spanish": (
+            "El rápido zorro marrón salta sobre el perro perezoso. Hemos programado la reunión para mañana "
+            "y todos deben estar allí a tiempo, porque el cliente presentará su nueva hoja de ruta. "
+            "Esta es una de las cosas que me gustaría hablar contigo cuando estemos juntos. Fue el mejor "
+            "de los tiempos y también el peor, y no sabían qué iba a pasar después. Por favor, avísame si "
+            "tienes alguna pregunta sobre el informe o el presupuesto de este año."
+        ),
+        "French": (
+            "Le rapide renard brun saute par-dessus le chien paresseux. Nous avons prévu la réunion pour "
+            "demain et tout le monde doit être là à l'heure, parce que le client va présenter sa nouvelle "
+            "feuille de route. C'est une des choses dont je voudrais parler avec vous quand nous serons "
+            "ensemble. C'était le meilleur des temps et aussi le pire, et ils ne savaient pas ce qui allait "
+            "se passer ensuite. Merci de me dire si vous avez des questions sur le rapport ou le budget."
+        ),
+        "German": (
+            "Der schnelle braune Fuchs springt über den faulen Hund. Wir haben das Treffen für morgen "
+            "angesetzt und alle sollten pünktlich da sein, weil der Kunde seinen neuen Fahrplan vorstellen "
+            "wird. Das ist eines der Dinge, über die ich mit dir sprechen möchte, wenn wir zusammen sind. "
+            "Es war die beste und auch die schlimmste Zeit, und sie wussten nicht, was als Nächstes "
+            "passieren würde. Bitte sag mir, ob du noch Fragen zu dem Bericht oder dem Budget hast."
+        ),
+        "Italian": (
+            "La veloce volpe marrone salta sopra il cane pigro. Abbiamo fissato la riunione per domani e "
+            "tutti dovrebbero essere lì in orario, perché il cliente presenterà la sua nuova tabella di "
+            "marcia. Questa è una delle cose di cui vorrei parlare con te quando saremo insieme. Era il "
+            "migliore dei tempi e anche il peggiore, e non sapevano che cosa sarebbe successo dopo. Per "
+            "favore fammi sapere se hai delle domande sul rapporto o sul bilancio di quest'anno."
+        ),
+        "Portuguese": (
+            "A rápida raposa marrom pula sobre o cão preguiçoso. Marcamos a reunião para amanhã e todos "
+            "devem estar lá a tempo, porque o cliente vai apresentar o seu novo roteiro. Esta é uma das "
+            "coisas sobre as quais eu gostaria de falar com você quando estivermos juntos. Foi o melhor "
+            "dos tempos e também o pior, e eles não sabiam o que ia acontecer depois. Por favor, me avise "
+            "se você tiver alguma pergunta sobre o relatório ou o orçamento deste ano."
+        ),
+        "Dutch": (
+            "De snelle bruine vos springt over de luie hond. We hebben de vergadering voor morgen gepland "
+            "en iedereen moet op tijd aanwezig zijn, omdat de klant zijn nieuwe routekaart zal presenteren. "
+            "Dit is een van de dingen waarover ik met je wil praten als we samen zijn. Het was de beste "
+            "tijd en ook de slechtste, en ze wisten niet wat er daarna zou gebeuren. Laat me alsjeblieft "
+            "weten of je nog vragen hebt over het verslag of het budget van dit jaar."
+        ),
+        "Turkish": (
+            "Hızlı kahverengi tilki tembel köpeğin üzerinden atlar. Toplantıyı yarın için planladık ve "
+            "herkesin zamanında orada olması gerekiyor, çünkü müşteri yeni yol haritasını sunacak. Bu, "
+            "birlikte olduğumuzda seninle konuşmak istediğim şeylerden biri. Zamanların en iyisiydi ve "
+            "aynı zamanda en kötüsüydü, ve bundan sonra ne olacağını bilmiyorlardı. Rapor ya da bu yılın "
+            "bütçesi hakkında bir sorunuz varsa lütfen bana haber verin."
+        ),
+        "Indonesian": (
+            "Rubah cokelat yang cepat melompati anjing yang malas. Kami sudah menjadwalkan rapat untuk "
+            "besok dan semua orang harus datang tepat waktu, karena klien akan mempresentasikan peta jalan "
+            "barunya. Ini adalah salah satu hal yang ingin saya bicarakan dengan kamu ketika kita bersama. "
+            "Itu adalah masa terbaik dan juga masa terburuk, dan mereka tidak tahu apa yang akan terjadi "
+            "selanjutnya. Tolong beri tahu saya jika ada pertanyaan tentang laporan atau anggaran tahun ini."
+        ),
+    },
+    "Arabic": {
+        "Persian": (
+            "روباه قهوه‌ای سریع از روی سگ تنبل می‌پرد. ما جلسه را برای فردا برنامه‌ریزی کرده‌ایم و همه "
+            "باید سر وقت آنجا باشند، چون مشتری نقشه راه جدید خود را ارائه می‌کند. این یکی از چیزهایی است "
+            "که می‌خواهم وقتی با هم هستیم درباره آن با تو صحبت کنم. بهترین روزگار بود و بدترین روزگار هم "
+            "بود، و آنها نمی‌دانستند بعد از این چه اتفاقی می‌افتد. لطفا اگر درباره گزارش یا بودجه امسال "
+            "سوالی دارید به من بگویید."
+        ),
+        "Arabic": (
+            "الثعلب البني السريع يقفز فوق الكلب الكسول. لقد حددنا موعد الاجتماع غدا ويجب أن يكون الجميع "
+            "هناك في الوقت المحدد، لأن العميل سيقدم خارطة الطريق الجديدة الخاصة به. هذا واحد من الأشياء "
+            "التي أود أن أتحدث عنها معك عندما نكون معا. كان أفضل الأوقات وكان أسوأ الأوقات أيضا، ولم "
+            "يعرفوا ماذا سيحدث بعد ذلك. من فضلك أخبرني إذا كان لديك أي سؤال حول التقرير أو ميزانية هذا العام."
+        ),
+    },
+}
+
+NGRAM_SIZES = (1, 2, 3)
+# Most frequent n-grams kept per language profile
+PROFILE_FEATURES = 300
+# Texts with fewer letters than this get proportionally less confident answers
+MIN_LETTERS = 30
+NON_LETTERS = re.compile(r"[\W\d_]+")
+
+def script_of(char: str) -> str:
+    code = ord(char)
+    if code < 0x0370:
+        return "Latin"
+    index = bisect_right(SCRIPT_STARTS, code) - 1
+    if index >= 0 and code <= SCRIPT_RANGES[index][1]:
+        return SCRIPT_RANGES[index][2]
+    return "Other"
+
+def ngrams(text: str) -> List[str]:
+    text = " " + NON_LETTERS.sub(" ", text.lower()).strip() + " "
+    grams = []
+    for size in NGRAM_SIZES:
+        for start in range(len(text) - size + 1):
+            gram = text[start:start + size]
+            if gram.strip():
+                grams.append(gram)
+    return grams
+
+class LanguageIdentifier:
+    # classify() answers (None, 0.0) for texts it cannot place in its trained set, which the
+    # caller hands to the model
+    def __init__(self, samples: Dict[str, Dict[str, str]] = LANGUAGE_SAMPLES, min_margin: float = 0.9, min_coverage: float = 0.4):
+        self.min_margin = min_margin
+        self.min_coverage = min_coverage
+        self.languages = []
+        self.scripts = []
+        # Letters seen per script, a text using any other letter of that script is from another language
+        self.alphabets: Dict[str, set] = {}
+        self.trigrams = []
+        counts = []
+        for script, languages in samples.items():
+            for language, text in languages.items():
+                self.languages.append(language)
+                self.scripts.append(script)
+                grams = ngrams(text)
+                counts.append(Counter(grams))
+                self.trigrams.append({gram for gram in grams if len(gram) == 3})
+                self.alphabets.setdefault(script, set()).update(char for char in text.lower() if char.isalpha())
+        vocabulary = sorted({gram for count in counts for gram, _ in count.most_common(PROFILE_FEATURES)})
+        self.vocabulary = {gram: index for index, gram in enumerate(vocabulary)}
+        frequencies = np.zeros((len(counts), len(vocabulary)), dtype=np.float32)
+        for row, count in enumerate(counts):
+            for gram, frequency in count.items():
+                column = self.vocabulary.get(gram)
+                if column is not None:
+                    frequencies[row, column] = frequency
+        # Naive Bayes log-probabilities with add-one smoothing
+        smoothed = frequencies + 1
+        self.profiles = np.log(smoothed / smoothed.sum(axis=1, keepdims=True))
+        self.script_masks = {script: np.array([tag == script for tag in self.scripts]) for script in samples}
+
+    def vectorize(self, texts: List[str]):
+        vectors = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram in ngrams(text):
+                column = self.vocabulary.get(gram)
+                if column is not None:
+                    vectors[row, column] += 1
+        return vectors
+
+    def classify_many(self, texts: List[str]) -> List[Tuple[Optional[str], float]]:
+        results: List[Tuple[Optional[str], float]] = [(None, 0.0)] * len(texts)
+        pending = []
+        for index, text in enumerate(texts):
+            scripts = Counter(script_of(char) for char in text if char.isalpha())
+            letters = sum(scripts.values())
+            if not letters:
+                continue
+            script, count = scripts.most_common(1)[0]
+            if script == "Han" and scripts["Kana"]:
+                # Japanese mixes kanji with kana, Chinese never uses kana
+                script, count = "Kana", count + scripts["Kana"]
+            if script in SCRIPT_LANGUAGES:
+                results[index] = (SCRIPT_LANGUAGES[script], count / letters)
+            elif script in self.script_masks:
+                alphabet = self.alphabets[script]
+                if any(char not in alphabet and script_of(char) == script for char in text.lower() if char.isalpha()):
+                    continue
+                pending.append((index, script, count / letters, letters))
+        if not pending:
+            return results
+        # One matrix product scores every pending text against every profile
+        vectors = self.vectorize([texts[index] for index, _, _, _ in pending])
+        likelihoods = vectors @ self.profiles.T
+        for row, (index, script, share, letters) in enumerate(pending):
+            if not vectors[row].any():
+                continue
+            scores = np.where(self.script_masks[script], likelihoods[row], -np.inf)
+            posterior = np.exp(scores - scores.max())
+            posterior /= posterior.sum()
+            second, best = np.argsort(posterior)[-2:]
+            if posterior[best] - posterior[second] < self.min_margin:
+                continue
+            trigrams = [gram for gram in ngrams(texts[index]) if len(gram) == 3]
+            if not trigrams or sum(gram in self.trigrams[best] for gram in trigrams) / len(trigrams) < self.min_coverage:
+                continue
+            confidence = float(posterior[best]) * share * min(1.0, letters / MIN_LETTERS)
+            results[index] = (self.languages[best], confidence)
+        return results
+
+    def classify(self, text: str) -> Tuple[Optional[str], float]:
+        return self.classify_many([text])[0]
+
+# Valence per word on a -4..4 scale, in the style of the VADER lexicon
+SENTIMENT_LEXICON = {
+    "good": 1.9, "great": 3.1, "excellent": 3.2, "amazing": 2.8, "awesome": 3.1, "fantastic": 2.6,
+    "wonderful": 2.7, "love": 3.2, "loved": 2.9, "loves": 2.7, "like": 1.5, "liked": 1.8, "enjoy": 2.2,
+    "enjoyed": 2.3, "happy": 2.7, "glad": 2.0, "pleased": 1.9, "nice": 1.8, "best": 3.2, "better": 1.9,
+    "perfect": 2.7, "beautiful": 2.9, "brilliant": 2.8, "superb": 3.1, "outstanding": 3.0, "helpful": 1.9,
+    "recommend": 1.5, "recommended": 1.6, "satisfied": 1.8, "impressed": 2.1, "impressive": 2.3,
+    "fast": 1.0, "easy": 1.9, "friendly": 2.2, "thanks": 1.9, "thank": 1.5, "delighted": 2.9,
+    "exciting": 2.2, "excited": 1.9, "fun": 2.3, "favorite": 2.0, "reliable": 1.9, "smooth": 1.2,
+    "win": 2.8, "success": 2.7, "successful": 2.8, "positive": 2.3, "incredible": 2.2, "worth": 0.9,
+    "bad": -2.5, "terrible": -2.1, "awful": -2.0, "horrible": -2.5, "worst": -3.1, "worse": -2.1,
+    "hate": -2.7, "hated": -3.2, "hates": -1.9, "dislike": -1.6, "poor": -2.1, "disappointed": -1.9,
+    "disappointing": -2.2, "sad": -2.1, "angry": -2.3, "annoying": -1.7, "annoyed": -1.6, "useless": -1.8,
+    "broken": -1.6, "slow": -0.8, "ugly": -2.3, "boring": -1.3, "problem": -1.7, "problems": -1.7,
+    "fail": -2.5, "failed": -2.3, "failure": -2.3, "wrong": -2.1, "waste": -1.8, "wasted": -2.2,
+    "expensive": -0.8, "difficult": -1.5, "hard": -0.4, "unhappy": -1.8, "upset": -1.6, "frustrating": -1.9,
+    "frustrated": -1.5, "refund": -0.8, "rude": -2.0, "dirty": -1.9, "crash": -1.7, "crashes": -1.7,
+    "bug": -1.2, "bugs": -1.2, "never": -0.5, "negative": -2.7, "unfortunately": -1.5, "sorry": -0.3,
+    "mediocre": -1.0, "pathetic": -2.4, "garbage": -2.3, "scam": -2.7, "lost": -1.3, "late": -0.8,
+}
+NEGATIONS = {"not", "no", "never", "none", "nobody", "nothing", "neither", "nor", "without", "cannot", "hardly"}
+BOOSTERS = {
+    "very": 0.293, "really": 0.293, "extremely": 0.293, "so": 0.293, "incredibly": 0.293, "absolutely": 0.293,
+    "totally": 0.293, "completely": 0.293, "highly": 0.293, "super": 0.293,
+    "slightly": -0.293, "somewhat": -0.293, "barely": -0.293, "kind": -0.293, "little": -0.293,
+}
+NEGATION_SCALAR = -0.74
+# How far back a negation reaches, in words
+NEGATION_WINDOW = 3
+WORDS = re.compile(r"[a-z]+(?:'[a-z]+)?")
+
+class LexiconSentiment:
+    def __init__(self, lexicon: Dict[str, float] = SENTIMENT_LEXICON):
+        self.lexicon = lexicon
+
+    def score(self, text: str) -> Tuple[float, int]:
+        # Returns a compound score in -1..1 and the number of words the lexicon knew
+        words = WORDS.findall(text.lower())
+        if not words:
+            return 0.0, 0
+        valence = np.array([self.lexicon.get(word, 0.0) for word in words], dtype=np.float32)
+        hits = int(np.count_nonzero(valence))
+        if not hits:
+            return 0.0, 0
+        negated = np.array([word in NEGATIONS or word.endswith("n't") for word in words], dtype=np.float32)
+        boost = np.array([BOOSTERS.get(word, 0.0) for word in words], dtype=np.float32)
+        # Any negation in the preceding window flips and damps a word, a booster right before it scales it
+        window = np.convolve(negated, np.ones(NEGATION_WINDOW, dtype=np.float32))[:len(words)]
+        window = np.concatenate(([0.0], window[:-1]))
+        valence = np.where(window > 0, valence * NEGATION_SCALAR, valence)
+        valence = valence + np.sign(valence) * np.concatenate(([0.0], boost[:-1])) * (valence != 0)
+        if "but" in words:
+            # The clause after "but" carries the writer's actual view
+            pivot = words.index("but")
+            valence[:pivot] *= 0.5
+            valence[pivot + 1:] *= 1.5
+        total = float(valence.sum()) + 0.292 * min(text.count("!"), 4) * np.sign(valence.sum())
+        return float(total / (total * total + 15) ** 0.5), hits
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        compound, hits = self.score(text)
+        if compound >= 0.05:
+            return "positive", abs(compound)
+        if compound <= -0.05:
+            return "negative", abs(compound)
+        # Too little signal to call it neutral with any certainty
+        return "neutral", 0.0
+
+class LocalClassifiers:
+    def __init__(self, settings: Optional[dict] = None):
+        settings = {**DEFAULT_LOCAL_SETTINGS, **(settings or {})}
+        self.thresholds = {
+            "LanguageDetection": settings["language_threshold"],
+            "SentimentAnalysis": settings["sentiment_threshold"],
+        }
+        self.language = LanguageIdentifier(min_margin=settings["language_margin"], min_coverage=settings["language_min_coverage"])
+        self.sentiment = LexiconSentiment()
+        self.counts = Counter()
+
+    def handles(self, label: str) -> bool:
+        return label in self.thresholds
+
+    def classify_many(self, label: str, texts: List[str]) -> List[Optional[dict]]:
+        # Structured arguments in the module's own schema, None where the model should decide
+        if label == "LanguageDetection":
+            answers = [({"language": language}, confidence) for language, confidence in self.language.classify_many(texts)]
+        elif label == "SentimentAnalysis":
+            answers = []
+            for text in texts:
+                sentiment, confidence = self.sentiment.classify(text)
+                answers.append(({"sentiment": sentiment, "confidence": str(max(1, round(confidence * 10)))}, confidence))
+        else:
+            return [None] * len(texts)
+        results = []
+        for arguments, confidence in answers:
+            if confidence >= self.thresholds[label]:
+                self.counts[f"{label}.local"] += 1
+                results.append(arguments)
+            else:
+                self.counts[f"{label}.fallback"] += 1
+                results.append(None)
+        return results
+
+    def classify(self, label: str, text: str) -> Optional[dict]:
+        return self.classify_many(label, [text])[0]
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.counts)
+
+def build_local(settings: Optional[dict]) -> Optional[LocalClassifiers]:
+    settings = settings or {}
+    if not settings.get("enabled", False):
+        return None
+    if np is None:
+        logger.error("numpy is not installed, local classifiers are disabled")
+        return None
+    return LocalClassifiers(settings)
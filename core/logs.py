@@ -0,0 +1,121 @@
+import logging
+import os
+import queue
+import random
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+from ai.codec import dumps
+
+# Logging off the event loop: handlers on the request path only put records on a queue, and a
+# listener thread formats them as JSON lines and writes them to the rotating file.
+
+DEFAULT_LOG_SETTINGS = {
+    "path": "app.log",
+    "max_bytes": 5 * 1024 * 1024,
+    "backup_count": 5,
+    "level": "INFO",
+    # Share of successful requests whose info lines are written, warnings and errors always are
+    "success_sample_rate": 0.1,
+    "queue_size": 10000,
+}
+
+current_request_id: ContextVar[Optional[str]] = ContextVar("current_request_id", default=None)
+# Whether this request's info lines are kept, decided once per request so its lines stay together
+current_sampled: ContextVar[bool] = ContextVar("current_sampled", default=True)
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+def start_request(request_id: Optional[str], sample_rate: float) -> str:
+    request_id = request_id or new_request_id()
+    current_request_id.set(request_id)
+    current_sampled.set(random.random() < sample_rate)
+    return request_id
+
+class ContextFilter(logging.Filter):
+    # Runs in the caller before the record is queued, where the request's context is visible
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current_request_id.get()
+        if record.levelno < logging.WARNING and not getattr(record, "keep", False):
+            return current_sampled.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        # Structured fields passed as extra={"fields": {...}}
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return dumps(entry).decode("utf-8")
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the listener, only the message is resolved here
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # A full queue drops the record rather than stalling the request
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class LogPipeline:
+    # The queue and listener thread of one process. A forked worker inherits neither a running
+    # listener nor a queue it can safely use, so it starts its own, writing to the same file
+    def __init__(self, settings: dict):
+        directory = os.path.dirname(settings["path"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.queue_size = settings["queue_size"]
+        self.file_handler = RotatingFileHandler(settings["path"], maxBytes=settings["max_bytes"], backupCount=settings["backup_count"])
+        self.file_handler.setFormatter(JsonFormatter())
+        self.queue_handler = DroppingQueueHandler(queue.Queue(self.queue_size))
+        self.queue_handler.addFilter(ContextFilter())
+        self.listener = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def start(self):
+        if self.listener is None:
+            self.listener = QueueListener(self.queue_handler.queue, self.file_handler, respect_handler_level=True)
+            self.listener.start()
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _after_fork(self):
+        running = self.listener is not None
+        self.queue_handler.queue = queue.Queue(self.queue_size)
+        self.listener = None
+        if running:
+            self.start()
+
+def setup_logging(settings: Optional[dict]) -> LogPipeline:
+    settings = {**DEFAULT_LOG_SETTINGS, **(settings or {})}
+    pipeline = LogPipeline(settings)
+    root = logging.getLogger()
+    root.addHandler(pipeline.queue_handler)
+    root.setLevel(settings["level"])
+    pipeline.start()
+    return pipeline
@@ -0,0 +1,162 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Minimal Prometheus text-format metrics, kept in-process so the hot path stays dependency free
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Gauge(Metric):
+    kind = "gauge"
+    function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        # Read at scrape time, for values another component already tracks
+        self.function = function
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        if self.function is not None:
+            lines.append(f"{self.name} {self.function()}")
+        lines.extend(f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in self.values.items())
+        return lines
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            labels = _format_labels(self.labels, key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labels, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+HTTP_LATENCY = REGISTRY.register(Histogram("http_request_duration_seconds", "End-to-end request latency", ("route", "method", "status")))
+UPSTREAM_LATENCY = REGISTRY.register(Histogram("upstream_request_duration_seconds", "Latency of upstream completions", ("module",)))
+SPAN_LATENCY = REGISTRY.register(Histogram("request_span_duration_seconds", "Time spent per request phase", ("span",)))
+TOKENS = REGISTRY.register(Counter("upstream_tokens_total", "Tokens billed by the provider", ("module", "direction")))
+COST = REGISTRY.register(Counter("upstream_cost_dollars_total", "Dollar cost of upstream completions", ("module",)))
+ERRORS = REGISTRY.register(Counter("errors_total", "Errors by where they happened and exception type", ("where", "type")))
+UPSTREAM_IN_FLIGHT = REGISTRY.register(Gauge("upstream_in_flight", "Upstream completions currently running"))
+UPSTREAM_QUEUED = REGISTRY.register(Gauge("upstream_queue_depth", "Calls waiting for an upstream concurrency slot"))
+CACHE_EVENTS = REGISTRY.register(Counter("response_cache_events_total", "Response cache lookups by result", ("result",)))
+COALESCED = REGISTRY.register(Counter("coalesced_requests_total", "Requests answered by an identical call already in flight", ("module",)))
+EDIT_MODE = REGISTRY.register(Counter("edit_mode_total", "Edit-list completions by whether their edits applied", ("module", "result")))
+ADMISSION = REGISTRY.register(Counter("admission_decisions_total", "Admission decisions for upstream capacity by tier", ("tier", "result")))
+COLD_START = REGISTRY.register(Gauge("cold_start_seconds", "Seconds from process start until warm, ready to serve and first request answered", ("phase",)))
+
+class RequestSpans:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last_end = self.started
+        self.durations: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        self.last_end = time.perf_counter()
+        SPAN_LATENCY.observe(seconds, span=name)
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.durations.items())
+
+current_spans: ContextVar[Optional[RequestSpans]] = ContextVar("current_spans", default=None)
+
+@contextmanager
+def span(name: str):
+    spans = current_spans.get()
+    if spans is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans.add(name, time.perf_counter() - started)
+
+def record_span(name: str, seconds: float):
+    spans = current_spans.get()
+    if spans is not None:
+        spans.add(name, seconds)
+
+def mark_validation():
+    # Everything between the request arriving and the engine being entered: body parsing,
+    # pydantic validation, dependencies and building the module
+    spans = current_spans.get()
+    if spans is not None and "validation" not in spans.durations:
+        spans.add("validation", time.perf_counter() - spans.started)
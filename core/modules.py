@@ -1,16 +1,133 @@
+from typing import Tuple
+
 from ai.aiclient import *
+from .readability import analyze_texts
+from .plagiarism import PlagiarismIndex
 
 GLOBAL_SYSTEM_MESSAGE = "You are an expert writing assistant"
 
+# Module lookup by class name, used by the batch endpoint and the generated routes. Every
+# BaseModule subclass that declares a function registers itself here
+MODULES = {}
+
+class Route: 
+    # How a module is served over HTTP, main.py generates one POST route per declaration
+    def __init__(self, path: str, summary: str, tag: str, message: str, fields: Optional[Dict[str, str]] = None, stream: bool = False, with_source: bool = False):
+        self.path = path
+        self.summary = summary
+        self.tag = tag
+        self.message = message
+        # Request body field names that differ from the module's constructor parameter names
+        self.fields = fields or {}
+        # Whether the route accepts ?stream=true
+        self.stream = stream
+        # Whether the response data says which path answered: model, cache or local
+        self.with_source = with_source
+
+    def extract(self, response: Response) -> dict:
+        if self.with_source:
+            return {**response.structured_arguments, "source": response.source}
+        return response.structured_arguments
+
 # Base Module
 
 class BaseModule:  
     prompt : Prompt = None
     function : Function = None
+    # Prompt template: the instruction, formatted with the module's params, then the quoted text
+    instruction : str = None
+    # Constructor parameters after text, in order, each filled into the instruction
+    params : Tuple[str, ...] = ()
+    route : Route = None
+    # Opt in to the engine's response cache, only for modules whose output is safe to reuse
+    cacheable : bool = False
+    # Short classification modules whose texts can share one completion in /batch
+    packable : bool = False
+    # How the engine handles inputs over the chunk budget: "stitch" joins per-chunk outputs,
+    # "reduce" runs the module again over the joined outputs, None sends the text as is
+    chunk_mode : str = None
+    # Completion budget: a fixed allowance for the function-call wrapper plus a share of the input
+    output_floor : int = 256
+    output_ratio : float = 1.0
+    # Whether the module's first required field is a new version of the text, which a
+    # pipeline hands to the next step; analysis modules leave the text as it was
+    transforms_text : bool = True
+    # Module that returns an edit list instead of the whole text, used for long inputs when the
+    # engine's edit mode is on
+    edit_module : type = None
+    # Whether the module is offered by name: in MODULES, /batch, pipelines and the generated routes
+    listed : bool = True
+    _prompt_prefix : str = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Compiled once per module: the prompt up to the text when the instruction has no params
+        if cls.instruction is not None and not cls.params:
+            cls._prompt_prefix = f"{cls.instruction}: '"
+        if cls.function is not None and cls.listed:
+            MODULES[cls.__name__] = cls
+
+    def __init__(self, text: Optional[str] = None, **params):
+        # Packed and fused calls set their own prompt and function
+        if self.instruction is None:
+            return
+        if text is None or params.keys() != set(self.params):
+            expected = ", ".join(("text", *self.params))
+            raise TypeError(f"{type(self).__name__} takes {expected}")
+        self.text = str(text)
+        prefix = self._prompt_prefix
+        if prefix is None:
+            self.instruction = self.instruction.format(**params)
+            prefix = f"{self.instruction}: '"
+        self.prompt = Prompt(GLOBAL_SYSTEM_MESSAGE, prefix + self.text + "'")
+
+    @classmethod
+    def output_budget(cls, input_tokens: int) -> int:
+        return int(cls.output_floor + cls.output_ratio * input_tokens)
     
 # MVP
 
+class GrammarEdits(BaseModule): 
+    # Edit-list variant of GrammarAssistant, only the corrected spans are generated
+    listed = False
+    transforms_text = False
+    cacheable = True
+    output_floor = 64
+    output_ratio = 0.5
+    instruction = (
+        "List the edits that fix this text's grammar and misspellings. start and end are character "
+        "offsets into the text between the quotes, end exclusive, and original is the text they span"
+    )
+    function = Function(
+        "grammar_edits" , 
+        "Edits that fix the grammar mistakes and misspellings in the text, in order" , 
+        {
+            "edits": {
+              "type": "array",
+              "items": {
+                "type": "object",
+                "properties": {
+                  "start": {"type": "integer"},
+                  "end": {"type": "integer"},
+                  "original": {"type": "string"},
+                  "replacement": {"type": "string"}
+                },
+                "required": ["start", "end", "original", "replacement"],
+                "additionalProperties": False
+              }
+            }
+        } , 
+        ["edits"]
+    )
+
 class GrammarAssistant(BaseModule): 
+    instruction = "Fix thix text's grammar and misspellings"
+    edit_module = GrammarEdits
+    route = Route("/grammar_assistance", "Fix grammar issues in text", "Text Processing", "Grammar fixed successfully")
+    chunk_mode = "stitch"
+    cacheable = True
+    output_floor = 64
+    output_ratio = 1.3
     function = Function(
         "grammar_fix" , 
         "Fix any grammar mistakes and misspellings in the text" , 
@@ -22,14 +139,13 @@ class GrammarAssistant(BaseModule):
         } , 
         ["corrected_text"]
     )
-    
-    def __init__(self , text):
-        super().__init__()
-        self.prompt = Prompt(GLOBAL_SYSTEM_MESSAGE , f"Fix thix text's grammar and misspellings: '{str(text)}'")
-    
-    
 
 class Summarizer(BaseModule):  # Inheriting from BaseModule
+    instruction = "Summarize this text"
+    route = Route("/summarizer", "Summarize a given text", "Text Processing", "Text summarized successfully", stream=True)
+    chunk_mode = "reduce"
+    output_floor = 128
+    output_ratio = 0.35
     function = Function(
         "summarize_text", 
         "Summarize the provided text", 
@@ -41,16 +157,13 @@ class Summarizer(BaseModule):  # Inheriting from BaseModule
         }, 
         ["summarized_text"]
     )
-    
-    def __init__(self, text: str):
-        # Ensure prompt and function are set for the module
-        super().__init__()  # Calls the BaseModule's __init__
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,  # This should be your system-wide message/context
-            f"Summarize this text: '{text}'"
-        )
 
 class Humanizer(BaseModule):
+    instruction = "Make the following text sound more human-like and natural"
+    route = Route("/humanizer", "Make text sound more human-like", "Text Processing", "Text humanized successfully", stream=True)
+    chunk_mode = "stitch"
+    output_floor = 64
+    output_ratio = 1.5
     function = Function(
         "humanize_text", 
         "Humanize the provided text", 
@@ -63,14 +176,12 @@ class Humanizer(BaseModule):
         ["humanized_text"]
     )
 
-    def __init__(self, text: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Make the following text sound more human-like and natural: '{text}'"
-        )
-
 class ToneChange(BaseModule):
+    instruction = "Change the tone of the following text to {tone}"
+    params = ("tone",)
+    route = Route("/tonechange", "Change the tone of a given text", "Text Processing", "Tone changed successfully", fields={"target_tone": "tone"})
+    output_floor = 64
+    output_ratio = 1.5
     function = Function(
         "change_tone", 
         "Change the tone of the provided text", 
@@ -83,16 +194,13 @@ class ToneChange(BaseModule):
         ["modified_text"]
     )
 
-    def __init__(self, text: str, tone: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Change the tone of the following text to {tone}: '{text}'"
-        )
-
 # Premium
 
 class ContentExpander(BaseModule):
+    instruction = "Expand the following text with more details and examples"
+    route = Route("/contentexpander", "Expand the content of a text", "Premium Modules", "Content expanded successfully", stream=True)
+    output_floor = 512
+    output_ratio = 4.0
     function = Function(
         "expand_content", 
         "Expand the provided text into a more detailed version", 
@@ -105,14 +213,12 @@ class ContentExpander(BaseModule):
         ["expanded_text"]
     )
 
-    def __init__(self, text: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Expand the following text with more details and examples: '{text}'"
-        )
-        
 class TextRewriting(BaseModule):
+    instruction = "Rewrite the following text with different wording"
+    route = Route("/textrewriting", "Rewrite a given text", "Premium Modules", "Text rewritten successfully", stream=True)
+    chunk_mode = "stitch"
+    output_floor = 64
+    output_ratio = 1.5
     function = Function(
         "rewrite_text", 
         "Rewrite the provided text while keeping its meaning intact", 
@@ -125,14 +231,11 @@ class TextRewriting(BaseModule):
         ["rewritten_text"]
     )
 
-    def __init__(self, text: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Rewrite the following text with different wording: '{text}'"
-        )
-
 class KeywordOptimizer(BaseModule):
+    instruction = "Optimize the following text for SEO by improving keyword usage"
+    route = Route("/keywordoptimizer", "Optimize keywords in a given text", "Premium Modules", "Keywords optimized successfully")
+    output_floor = 64
+    output_ratio = 1.5
     function = Function(
         "optimize_keywords", 
         "Optimize keywords in the provided text", 
@@ -145,14 +248,12 @@ class KeywordOptimizer(BaseModule):
         ["optimized_text"]
     )
 
-    def __init__(self, text: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Optimize the following text for SEO by improving keyword usage: '{text}'"
-        )
-
 class TextPersonalization(BaseModule):
+    instruction = "Personalize the following text for {user_name} who prefers {user_preference}"
+    params = ("user_name", "user_preference")
+    route = Route("/textpersonalization", "Personalize text for a user", "Premium Modules", "Text personalized successfully", fields={"user": "user_name", "prefrence": "user_preference"})
+    output_floor = 64
+    output_ratio = 1.5
     function = Function(
         "personalize_text", 
         "Personalize the provided text for the user", 
@@ -165,21 +266,35 @@ class TextPersonalization(BaseModule):
         ["personalized_text"]
     )
 
-    def __init__(self, text: str, user_name: str, user_preference: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Personalize the following text for {user_name} who prefers {user_preference}: '{text}'"
-        )
-
 # Utility
 class PlagiarismChecker: 
-    pass
+    # Matched locally against the indexed reference corpus, never sent to the model
+    def __init__(self, text: str):
+        self.text = text
+
+    def run(self, index: PlagiarismIndex, max_results: Optional[int] = None) -> dict:
+        return index.search(self.text, max_results)
 
 class ReadabilityAnalyzer: 
-    pass
+    # Scored locally from word, sentence and syllable counts, never sent to the model
+    def __init__(self, text: str):
+        self.text = text
+
+    def run(self) -> dict:
+        return analyze_texts([self.text])[0]
+
+    @staticmethod
+    def run_many(texts: List[str]) -> List[dict]:
+        return analyze_texts(texts)
 
 class LanguageDetection(BaseModule):
+    instruction = "Detect the language of the following text"
+    route = Route("/languagedetection", "Detect the language of a given text", "Utility Modules", "Language detected successfully", with_source=True)
+    transforms_text = False
+    cacheable = True
+    packable = True
+    output_floor = 24
+    output_ratio = 0
     function = Function(
         "detect_language", 
         "Detect the language of the provided text", 
@@ -192,14 +307,14 @@ class LanguageDetection(BaseModule):
         ["language"]
     )
 
-    def __init__(self, text: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Detect the language of the following text: '{text}'"
-        )
-
 class SentimentAnalysis(BaseModule):
+    instruction = "Analyze the sentiment of the following text and classify it as positive, negative, or neutral"
+    route = Route("/sentimentanalysis", "Analyze the sentiment of a text", "Utility Modules", "Sentiment analysis completed", with_source=True)
+    transforms_text = False
+    cacheable = True
+    packable = True
+    output_floor = 48
+    output_ratio = 0
     function = Function(
         "analyze_sentiment", 
         "Analyze the sentiment of the provided text", 
@@ -216,14 +331,14 @@ class SentimentAnalysis(BaseModule):
         ["sentiment", "confidence"]
     )
 
-    def __init__(self, text: str):
-        super().__init__()
-        self.prompt = Prompt(
-            GLOBAL_SYSTEM_MESSAGE,
-            f"Analyze the sentiment of the following text and classify it as positive, negative, or neutral: '{text}'"
-        )
-
 class EmotionRecognition(BaseModule):
+    instruction = "Recognize the emotion expressed in this text and provide the confidence score"
+    route = Route("/emotionrecognition", "Recognize emotions from text", "Utility Modules", "Emotion recognized successfully")
+    transforms_text = False
+    cacheable = True
+    packable = True
+    output_floor = 48
+    output_ratio = 0
     function = Function(
         "recognize_emotion", 
         "Recognize the emotion expressed in the provided text", 
@@ -240,9 +355,83 @@ class EmotionRecognition(BaseModule):
         ["emotion", "confidence"]
     )
 
-    def __init__(self, text: str):
+def packed_function(function: Function) -> Function:
+    # Array-valued variant of a classification schema, one result object per numbered text
+    item_properties = {
+        "index": {
+            "type": "integer",
+            "description": "Index of the text this result belongs to"
+        },
+        **function.properties
+    }
+    return Function(
+        f"{function.name}_batch",
+        f"{function.description}, once for each numbered text",
+        {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": item_properties,
+                    "required": ["index", *function.required],
+                    "additionalProperties": False
+                }
+            }
+        },
+        ["results"]
+    )
+
+def packed_prompt(function: Function, texts: List[str]) -> Prompt:
+    numbered = "\n".join(f"[{index}] {json.dumps(text, ensure_ascii=False)}" for index, text in enumerate(texts))
+    return Prompt(
+        GLOBAL_SYSTEM_MESSAGE,
+        f"{function.description} for each of the following texts. Return exactly one result per text, with its index:\n{numbered}"
+    )
+
+class Pipeline(BaseModule):
+    # Several steps fused into one completion. Fields are prefixed with the step number, so
+    # each step's result can be read back out, and the model fills them in step order
+    def __init__(self, steps: List[Tuple[int, BaseModule]], text: str):
         super().__init__()
+        self.steps = steps
+        self.text = text
+        self.cacheable = all(module.cacheable for _, module in steps)
+        properties = {}
+        lines = []
+        current = "the original text"
+        for number, module in steps:
+            fields = [f"step{number}_{name}" for name in module.function.properties]
+            for name, spec in module.function.properties.items():
+                properties[f"step{number}_{name}"] = {**spec, "description": f"Step {number}: {spec.get('description', name)}"}
+            lines.append(f"{number}. {module.instruction}, applied to {current}. Answer in {', '.join(fields)}.")
+            if module.transforms_text:
+                current = f"step{number}_{module.function.required[0]}"
+        self.function = Function(
+            "run_pipeline",
+            "Results of each pipeline step, in step order",
+            properties,
+            list(properties)
+        )
+        steps_text = "\n".join(lines)
         self.prompt = Prompt(
             GLOBAL_SYSTEM_MESSAGE,
-            f"Recognize the emotion expressed in this text and provide the confidence score: '{text}'"
+            f"Carry out these steps in order, each on the text named in it:\n{steps_text}\nThe original text: '{text}'"
         )
+
+    def output_budget(self, input_tokens: int) -> int:
+        # Each step gets its own allowance, sized by the text it receives from the step before
+        total = 0
+        length = input_tokens
+        for _, module in self.steps:
+            total += type(module).output_budget(length)
+            if module.transforms_text:
+                length = int(module.output_ratio * length)
+        return total
+
+    def split(self, structured_arguments: dict) -> List[Optional[dict]]:
+        # Per-step results in step order, None for a step the completion left incomplete
+        results = []
+        for number, module in self.steps:
+            result = {name: structured_arguments.get(f"step{number}_{name}") for name in module.function.properties}
+            results.append(result if all(result.get(name) is not None for name in module.function.required) else None)
+        return results
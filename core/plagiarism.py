@@ -0,0 +1,421 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from .db import SQLiteDatabase
+
+try:
+    import numpy as np
+except ImportError:  # The plagiarism index needs numpy, without it the endpoints report unavailable
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Near-duplicate search over a local reference corpus: word shingles, MinHash signatures and
+# LSH bands. Signed documents live in SQLite, which every worker reads. Compaction folds them
+# into an immutable segment of memory-mapped arrays: the signatures, plus one sorted band-key
+# column per band, searched with binary search. Documents added since the last compaction are
+# kept in a small in-memory delta.
+
+DEFAULT_PLAGIARISM_SETTINGS = {
+    "enabled": True,
+    "path": "plagiarism_index",
+    "shingle_size": 5,
+    "num_perm": 128,
+    "bands": 32,
+    "min_similarity": 0.1,
+    "max_results": 10,
+    "max_spans": 20,
+    # Delta size that triggers folding new documents into the memory-mapped segment
+    "compact_after": 20000,
+    # How often a worker looks for documents ingested by its siblings
+    "refresh_seconds": 1.0,
+}
+
+WORD = re.compile(r"\w+")
+SHINGLE_MIX = 0x100000001B3
+BAND_MIX = 0x9E3779B97F4A7C15
+EMPTY_HASH = 0xFFFFFFFF
+# Shingles hashed per step when signing, bounds memory for very long documents
+SIGN_BLOCK = 4096
+SEGMENT_META = "segment.json"
+
+@lru_cache(maxsize=262144)
+def token_hash(token: str) -> int:
+    return zlib.crc32(token.encode("utf-8"))
+
+def tokenize(text: str) -> Tuple[Any, List[Tuple[int, int]]]:
+    matches = list(WORD.finditer(text))
+    hashes = np.fromiter((token_hash(match.group().lower()) for match in matches), dtype=np.uint64, count=len(matches))
+    return hashes, [match.span() for match in matches]
+
+def shingle(hashes, size: int):
+    # 32-bit hash per window of `size` consecutive tokens, a text shorter than that is one shingle
+    size = min(size, len(hashes))
+    if not size:
+        return np.zeros(0, dtype=np.uint64)
+    count = len(hashes) - size + 1
+    combined = np.zeros(count, dtype=np.uint64)
+    for offset in range(size):
+        combined = combined * np.uint64(SHINGLE_MIX) + hashes[offset:offset + count]
+    return (combined ^ (combined >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+
+class MinHasher:
+    def __init__(self, num_perm: int, bands: int, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        rng = np.random.default_rng(seed)
+        # Multiply-add-shift hashing, one odd multiplier per permutation
+        self.multipliers = rng.integers(1, np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64) | np.uint64(1)
+        self.increments = rng.integers(0, np.iinfo(np.uint64).max, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+
+    def signature(self, shingles):
+        signature = np.full(self.num_perm, EMPTY_HASH, dtype=np.uint64)
+        for start in range(0, len(shingles), SIGN_BLOCK):
+            block = shingles[start:start + SIGN_BLOCK, None]
+            values = (block * self.multipliers + self.increments) >> np.uint64(32)
+            np.minimum(signature, values.min(axis=0), out=signature)
+        return signature.astype(np.uint32)
+
+    def band_keys(self, signatures, band: Optional[int] = None):
+        # Folds each band's rows into one 64-bit key, for every band or a single one
+        signatures = np.atleast_2d(signatures)
+        if band is not None:
+            parts = signatures[:, band * self.rows:(band + 1) * self.rows].astype(np.uint64)[:, None, :]
+        else:
+            parts = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        keys = np.zeros(parts.shape[:2], dtype=np.uint64)
+        for row in range(self.rows):
+            keys = (keys ^ parts[:, :, row]) * np.uint64(BAND_MIX)
+        return keys
+
+class Segment:
+    # Immutable, memory mapped, so every worker on the host shares the same pages
+    def __init__(self, directory: Optional[str], meta: dict):
+        self.directory = directory
+        self.version = meta.get("version", 0)
+        self.last_id = meta.get("last_id", 0)
+        if directory is None:
+            self.doc_ids = np.zeros(0, dtype=np.int64)
+            self.signatures = None
+            self.keys = self.rows = None
+            return
+        self.doc_ids = np.load(os.path.join(directory, "doc_ids.npy"), mmap_mode="r")
+        self.signatures = np.load(os.path.join(directory, "signatures.npy"), mmap_mode="r")
+        self.keys = np.load(os.path.join(directory, "band_keys.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(directory, "band_rows.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def candidates(self, keys) -> List[Any]:
+        if not len(self):
+            return []
+        found = []
+        for band, key in enumerate(keys):
+            column = self.keys[band]
+            start = np.searchsorted(column, key, side="left")
+            end = np.searchsorted(column, key, side="right")
+            if end > start:
+                found.append(self.rows[band, start:end])
+        return found
+
+class PlagiarismIndex:
+    def __init__(self, path: str, settings: Optional[dict] = None):
+        self.settings = {**DEFAULT_PLAGIARISM_SETTINGS, **(settings or {})}
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.hasher = MinHasher(self.settings["num_perm"], self.settings["bands"])
+        self.lock = threading.Lock()
+        self.compacting = False
+        self.connection = SQLiteDatabase(os.path.join(path, "documents.sqlite"), [
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "id INTEGER PRIMARY KEY, external_id TEXT UNIQUE, title TEXT, text TEXT NOT NULL, "
+            "signature BLOB NOT NULL, created_at REAL NOT NULL)",
+            "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        ])
+        self._check_settings()
+        self.segment = Segment(None, {})
+        self.delta_signatures: Dict[int, Any] = {}
+        self.delta_bands: Dict[Tuple[int, int], List[int]] = {}
+        self.last_seen = 0
+        self.refreshed_at = 0.0
+        self._load_segment()
+        self.refresh(force=True)
+
+    def _check_settings(self):
+        # Signatures on disk are only comparable with the same shingling and hash functions
+        wanted = {name: str(self.settings[name]) for name in ("shingle_size", "num_perm", "bands")}
+        stored = dict(self.connection.execute("SELECT name, value FROM settings").fetchall())
+        if not stored:
+            self.connection.executemany("INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)", wanted.items())
+        elif stored != wanted:
+            raise ValueError(f"Plagiarism index at {self.path} was built with {stored}, config asks for {wanted}")
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(os.path.join(self.path, SEGMENT_META)) as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return {}
+
+    def _load_segment(self) -> bool:
+        meta = self._read_meta()
+        if meta.get("version", 0) == self.segment.version:
+            return False
+        segment = Segment(os.path.join(self.path, meta["directory"]), meta)
+        with self.lock:
+            self.segment = segment
+            # Everything the new segment covers leaves the delta
+            stale = [doc_id for doc_id in self.delta_signatures if doc_id <= segment.last_id]
+            for doc_id in stale:
+                del self.delta_signatures[doc_id]
+            if stale:
+                self._rebuild_delta_bands()
+            self.last_seen = max(self.last_seen, segment.last_id)
+        return True
+
+    def _rebuild_delta_bands(self):
+        self.delta_bands = {}
+        for doc_id, signature in self.delta_signatures.items():
+            self._add_bands(doc_id, signature)
+
+    def _add_bands(self, doc_id: int, signature):
+        for band, key in enumerate(self.hasher.band_keys(signature)[0]):
+            self.delta_bands.setdefault((band, int(key)), []).append(doc_id)
+
+    def _add_delta(self, doc_id: int, signature):
+        self.delta_signatures[doc_id] = signature
+        self._add_bands(doc_id, signature)
+        self.last_seen = max(self.last_seen, doc_id)
+
+    def _read_new(self):
+        # Loads every row past last_seen, so it only ever moves over ids that were actually read.
+        # Called with the lock held
+        rows = self.connection.execute(
+            "SELECT id, signature FROM documents WHERE id > ? ORDER BY id", (self.last_seen,)
+        ).fetchall()
+        for doc_id, blob in rows:
+            self._add_delta(doc_id, np.frombuffer(blob, dtype=np.uint32))
+
+    def refresh(self, force: bool = False):
+        # Picks up a newer segment and documents other workers ingested
+        now = time.monotonic()
+        if not force and now - self.refreshed_at < self.settings["refresh_seconds"]:
+            return
+        self.refreshed_at = now
+        self._load_segment()
+        with self.lock:
+            self._read_new()
+        self._maybe_compact()
+
+    def sign(self, text: str):
+        hashes, spans = tokenize(text)
+        shingles = shingle(hashes, self.settings["shingle_size"])
+        return self.hasher.signature(shingles), shingles, spans
+
+    def add(self, documents: List[dict]) -> List[Dict[str, Any]]:
+        signed = [(document, self.sign(document["text"])[0]) for document in documents]
+        results = []
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                # Rows other workers committed before this write lock get lower ids than ours,
+                # they are read first so last_seen does not skip over them
+                self._read_new()
+                for document, signature in signed:
+                    cursor = self.connection.execute(
+                        "INSERT OR IGNORE INTO documents (external_id, title, text, signature, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (document.get("id"), document.get("title"), document["text"], signature.tobytes(), now)
+                    )
+                    if cursor.rowcount:
+                        results.append({"id": document.get("id") or str(cursor.lastrowid), "status": "indexed"})
+                        self._add_delta(cursor.lastrowid, signature)
+                    else:
+                        results.append({"id": document.get("id"), "status": "duplicate"})
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        self._maybe_compact()
+        return results
+
+    def _maybe_compact(self):
+        if len(self.delta_signatures) < self.settings["compact_after"] or self.compacting:
+            return
+        self.compacting = True
+        threading.Thread(target=self._compact_in_background, daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"Plagiarism index compaction failed: {e}")
+        finally:
+            self.compacting = False
+
+    def compact(self):
+        # One worker at a time; the others keep serving from their current segment and delta
+        with open(os.path.join(self.path, "compact.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            self._load_segment()
+            base = self.segment
+            # Built from SQLite rather than this worker's delta, so documents it has not read yet
+            # are not skipped over by the new segment's last_id
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT id, signature FROM documents WHERE id > ? ORDER BY id", (base.last_id,)
+                ).fetchall()
+            if not rows:
+                return
+            delta_ids = [doc_id for doc_id, _ in rows]
+            delta = np.stack([np.frombuffer(blob, dtype=np.uint32) for _, blob in rows])
+            del rows
+            version = base.version + 1
+            directory = f"segment-{version}"
+            target = os.path.join(self.path, directory)
+            os.makedirs(target, exist_ok=True)
+            total = len(base) + len(delta_ids)
+            doc_ids = np.lib.format.open_memmap(os.path.join(target, "doc_ids.npy"), mode="w+", dtype=np.int64, shape=(total,))
+            signatures = np.lib.format.open_memmap(
+                os.path.join(target, "signatures.npy"), mode="w+", dtype=np.uint32, shape=(total, self.hasher.num_perm)
+            )
+            if len(base):
+                doc_ids[:len(base)] = base.doc_ids
+                signatures[:len(base)] = base.signatures
+            doc_ids[len(base):] = delta_ids
+            signatures[len(base):] = delta
+            keys = np.lib.format.open_memmap(os.path.join(target, "band_keys.npy"), mode="w+", dtype=np.uint64, shape=(self.hasher.bands, total))
+            rows = np.lib.format.open_memmap(os.path.join(target, "band_rows.npy"), mode="w+", dtype=np.uint32, shape=(self.hasher.bands, total))
+            # Band by band, so memory stays at one column however large the corpus gets
+            for band in range(self.hasher.bands):
+                column = self.hasher.band_keys(signatures, band)[:, 0]
+                order = np.argsort(column, kind="stable")
+                keys[band] = column[order]
+                rows[band] = order
+            for array in (doc_ids, signatures, keys, rows):
+                array.flush()
+            del doc_ids, signatures, keys, rows
+            meta = {"version": version, "directory": directory, "last_id": int(delta_ids[-1]), "documents": total}
+            with open(os.path.join(self.path, SEGMENT_META + ".tmp"), "w") as handle:
+                json.dump(meta, handle)
+            os.replace(os.path.join(self.path, SEGMENT_META + ".tmp"), os.path.join(self.path, SEGMENT_META))
+            # Workers still mapping the previous segment keep it until they reload, older ones go
+            for name in os.listdir(self.path):
+                if name.startswith("segment-") and name not in (directory, base.directory and os.path.basename(base.directory)):
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            self._load_segment()
+
+    def _candidates(self, signature) -> Dict[int, float]:
+        keys = self.hasher.band_keys(signature)[0]
+        segment = self.segment
+        scores = {}
+        found = segment.candidates(keys)
+        if found:
+            rows = np.unique(np.concatenate(found))
+            similarities = (segment.signatures[rows] == signature).mean(axis=1)
+            for row, similarity in zip(rows, similarities):
+                scores[int(segment.doc_ids[row])] = float(similarity)
+        with self.lock:
+            delta_ids = {doc_id for band, key in enumerate(keys) for doc_id in self.delta_bands.get((band, int(key)), ())}
+            for doc_id in delta_ids:
+                scores[doc_id] = float((self.delta_signatures[doc_id] == signature).mean())
+        return scores
+
+    def search(self, text: str, max_results: Optional[int] = None) -> Dict[str, Any]:
+        self.refresh()
+        signature, shingles, spans = self.sign(text)
+        if not len(shingles):
+            return {"score": 0.0, "matches": []}
+        scores = self._candidates(signature)
+        ranked = sorted(
+            ((doc_id, similarity) for doc_id, similarity in scores.items() if similarity >= self.settings["min_similarity"]),
+            key=lambda item: item[1], reverse=True
+        )[:max_results or self.settings["max_results"]]
+        if not ranked:
+            return {"score": 0.0, "matches": []}
+        placeholders = ",".join("?" * len(ranked))
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT id, external_id, title, text FROM documents WHERE id IN ({placeholders})", [doc_id for doc_id, _ in ranked]
+            ).fetchall()
+        documents = {row[0]: row[1:] for row in rows}
+        matches = []
+        for doc_id, similarity in ranked:
+            external_id, title, source = documents[doc_id]
+            containment, overlaps = self.overlaps(text, shingles, spans, source)
+            matches.append({
+                "document_id": external_id or str(doc_id),
+                "title": title,
+                "similarity": round(similarity, 4),
+                "containment": round(containment, 4),
+                "spans": overlaps,
+            })
+        matches.sort(key=lambda match: (match["containment"], match["similarity"]), reverse=True)
+        return {"score": matches[0]["containment"], "matches": matches}
+
+    def overlaps(self, text: str, shingles, spans: List[Tuple[int, int]], source: str) -> Tuple[float, List[Dict[str, Any]]]:
+        # Exact shared shingles, grown into aligned runs and reported as character spans on both sides
+        size = min(self.settings["shingle_size"], len(spans))
+        source_hashes, source_spans = tokenize(source)
+        source_shingles = shingle(source_hashes, self.settings["shingle_size"])
+        positions = {}
+        for position, value in enumerate(source_shingles.tolist()):
+            positions.setdefault(value, position)
+        query = shingles.tolist()
+        source_list = source_shingles.tolist()
+        shared = sum(1 for value in query if value in positions)
+        results = []
+        position = 0
+        while position < len(query) and len(results) < self.settings["max_spans"]:
+            start = positions.get(query[position])
+            if start is None:
+                position += 1
+                continue
+            length = 1
+            while (position + length < len(query) and start + length < len(source_list)
+                   and query[position + length] == source_list[start + length]):
+                length += 1
+            first, last = position, position + length - 1 + size - 1
+            source_first, source_last = start, start + length - 1 + size - 1
+            results.append({
+                "start": spans[first][0],
+                "end": spans[last][1],
+                "source_start": source_spans[source_first][0],
+                "source_end": source_spans[source_last][1],
+                "text": text[spans[first][0]:spans[last][1]],
+            })
+            position += length
+        return shared / len(query), results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "segment_documents": len(self.segment),
+            "delta_documents": len(self.delta_signatures),
+            "segment_version": self.segment.version,
+            "compacting": self.compacting,
+        }
+
+def build_plagiarism(settings: Optional[dict]) -> Optional[PlagiarismIndex]:
+    settings = settings or {}
+    if not settings.get("enabled", False) or not settings.get("path"):
+        return None
+    if np is None:
+        logger.error("numpy is not installed, the plagiarism index is disabled")
+        return None
+    return PlagiarismIndex(settings["path"], settings)
@@ -0,0 +1,171 @@
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List
+
+try:
+    import numpy as np
+except ImportError:  # Scores are then computed text by text in plain Python
+    np = None
+
+# Readability scores computed locally, English syllable rules throughout
+
+TOKEN = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*|[.!?]+")
+VOWEL_GROUPS = re.compile(r"[aeiouy]+")
+# Endings that add or drop a syllable compared to counting vowel groups
+SUBTRACT = re.compile(r"(?:[^laeiouysxzh]es|[^laeiouytd]ed|[^laeiouy]e)$")
+ADD = re.compile(r"(?:ia|ism|ii|uo|[^aeiou]y[aeiou])$")
+# Suffixes Gunning Fog does not count towards a complex word
+FOG_SUFFIXES = ("es", "ed", "ing")
+# Sentence-length histogram bounds in words, the last bucket is open ended
+SENTENCE_BUCKETS = (5, 10, 15, 20, 30, 40)
+WORDS_PER_MINUTE = 238
+
+@lru_cache(maxsize=65536)
+def count_syllables(word: str) -> int:
+    word = word.lower().replace("’", "'").split("'")[0]
+    if len(word) <= 3:
+        return 1
+    count = len(VOWEL_GROUPS.findall(word))
+    if SUBTRACT.search(word):
+        count -= 1
+    if ADD.search(word):
+        count += 1
+    return max(1, count)
+
+@lru_cache(maxsize=65536)
+def is_complex(word: str) -> bool:
+    if count_syllables(word) < 3:
+        return False
+    lowered = word.lower()
+    for suffix in FOG_SUFFIXES:
+        if lowered.endswith(suffix):
+            return count_syllables(word[:-len(suffix)]) >= 3
+    return True
+
+class TextCounter:
+    # Feeds text in pieces, so a large document never has to be held or tokenized at once
+    def __init__(self):
+        self.tail = ""
+        self.sentence_words = 0
+        self.words = 0
+        self.sentences = 0
+        self.syllables = 0
+        self.letters = 0
+        self.polysyllables = 0
+        self.complex_words = 0
+        self.long_words = 0
+        self.sentence_lengths = Counter()
+
+    def feed(self, text: str):
+        text = self.tail + text
+        # Hold back the last partial word, it may continue in the next piece
+        cut = max(text.rfind(" "), text.rfind("\n"), text.rfind("\t")) + 1
+        self.tail = text[cut:]
+        self._count(text[:cut])
+
+    def close(self) -> "TextCounter":
+        self._count(self.tail)
+        self.tail = ""
+        self._end_sentence()
+        return self
+
+    def _count(self, text: str):
+        for token in TOKEN.findall(text):
+            if token[0] in ".!?":
+                self._end_sentence()
+                continue
+            syllables = count_syllables(token)
+            self.words += 1
+            self.sentence_words += 1
+            self.syllables += syllables
+            self.letters += len(token)
+            self.polysyllables += syllables >= 3
+            self.complex_words += is_complex(token)
+            self.long_words += len(token) > 6
+
+    def _end_sentence(self):
+        if self.sentence_words:
+            self.sentences += 1
+            self.sentence_lengths[self.sentence_words] += 1
+            self.sentence_words = 0
+
+def count_text(text: str) -> TextCounter:
+    counter = TextCounter()
+    counter.feed(text)
+    return counter.close()
+
+def count_stream(pieces: Iterable[str]) -> TextCounter:
+    counter = TextCounter()
+    for piece in pieces:
+        counter.feed(piece)
+    return counter.close()
+
+def _scores(words, sentences, syllables, letters, polysyllables, complex_words, long_words, maximum) -> Dict[str, Any]:
+    # Plain arithmetic, so the same formulas run on numpy arrays and on single numbers
+    words = maximum(words, 1)
+    sentences = maximum(sentences, 1)
+    words_per_sentence = words / sentences
+    syllables_per_word = syllables / words
+    return {
+        "flesch_reading_ease": 206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word,
+        "flesch_kincaid_grade": 0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59,
+        "gunning_fog": 0.4 * (words_per_sentence + 100 * complex_words / words),
+        "smog_index": 1.043 * (polysyllables * 30 / sentences) ** 0.5 + 3.1291,
+        "coleman_liau_index": 0.0588 * (100 * letters / words) - 0.296 * (100 * sentences / words) - 15.8,
+        "automated_readability_index": 4.71 * letters / words + 0.5 * words_per_sentence - 21.43,
+        "lix": words_per_sentence + 100 * long_words / words,
+        "words_per_sentence": words_per_sentence,
+        "syllables_per_word": syllables_per_word,
+    }
+
+def sentence_distribution(lengths: Counter) -> Dict[str, Any]:
+    total = sum(lengths.values())
+    if not total:
+        return {"buckets": {}, "mean": 0, "median": 0, "p90": 0, "max": 0}
+    ordered = sorted(lengths.items())
+
+    def percentile(share: float) -> int:
+        seen = 0
+        for length, count in ordered:
+            seen += count
+            if seen >= share * total:
+                return length
+        return ordered[-1][0]
+
+    buckets = Counter()
+    for length, count in ordered:
+        bound = next((bound for bound in SENTENCE_BUCKETS if length <= bound), None)
+        buckets[f"<={bound}" if bound else f">{SENTENCE_BUCKETS[-1]}"] += count
+    return {
+        "buckets": dict(buckets),
+        "mean": sum(length * count for length, count in ordered) / total,
+        "median": percentile(0.5),
+        "p90": percentile(0.9),
+        "max": ordered[-1][0],
+    }
+
+COUNT_FIELDS = ("words", "sentences", "syllables", "letters", "polysyllables", "complex_words", "long_words")
+
+def score_counters(counters: List[TextCounter]) -> List[Dict[str, Any]]:
+    if not counters:
+        return []
+    if np is not None:
+        # One vectorized pass over the whole batch
+        columns = {field: np.array([getattr(counter, field) for counter in counters], dtype=np.float64) for field in COUNT_FIELDS}
+        batch = _scores(*(columns[field] for field in COUNT_FIELDS), np.maximum)
+        scores = [{name: float(values[row]) for name, values in batch.items()} for row in range(len(counters))]
+    else:
+        scores = [_scores(*(getattr(counter, field) for field in COUNT_FIELDS), max) for counter in counters]
+    results = []
+    for counter, score in zip(counters, scores):
+        results.append({
+            "scores": {name: round(value, 2) for name, value in score.items()},
+            "counts": {field: getattr(counter, field) for field in COUNT_FIELDS},
+            "sentence_lengths": sentence_distribution(counter.sentence_lengths),
+            "reading_time_seconds": round(counter.words / WORDS_PER_MINUTE * 60, 1),
+        })
+    return results
+
+def analyze_texts(texts: List[str]) -> List[Dict[str, Any]]:
+    return score_counters([count_text(text) for text in texts])
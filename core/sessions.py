@@ -0,0 +1,300 @@
+import asyncio
+import difflib
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from ai.codec import dumps, loads
+from .db import SQLiteDatabase
+
+# Editor sessions: a document is kept as content-hashed paragraphs with the module's last output
+# for each. A new revision is diffed against the stored one and only paragraphs whose text is new
+# go through the engine, so the cost of a save follows the size of the edit.
+
+DEFAULT_SESSION_SETTINGS = {
+    "enabled": True,
+    # Unset keeps sessions in the worker's memory, set it to share them between uvicorn workers
+    "sqlite_path": None,
+    "max_sessions": 10000,
+    "ttl_seconds": 86400,
+    "max_paragraphs": 2000,
+    "max_parallel": 8,
+}
+
+PARAGRAPH_SPLIT = re.compile(r"(\n\s*\n)")
+
+def split_paragraphs(text: str) -> List[Tuple[str, str]]:
+    # (separator, paragraph) pairs, the separator being the whitespace in front of the paragraph
+    parts = PARAGRAPH_SPLIT.split(text)
+    paragraphs = []
+    separator = ""
+    for index, part in enumerate(parts):
+        if index % 2:
+            separator = part
+            continue
+        if part.strip():
+            paragraphs.append((separator, part))
+        separator = ""
+    return paragraphs
+
+def paragraph_hash(paragraph: str) -> str:
+    return hashlib.sha256(paragraph.strip().encode("utf-8")).hexdigest()
+
+def new_session(tenant: str, module: str) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "tenant": tenant,
+        "module": module,
+        "revision": 0,
+        # Paragraph hashes of the current revision, in order, and the output for each hash
+        "hashes": [],
+        "outputs": {},
+        "text": "",
+        "created_at": now,
+        "updated_at": now,
+    }
+
+def session_view(session: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": session["id"],
+        "module": session["module"],
+        "revision": session["revision"],
+        "paragraphs": len(session["hashes"]),
+        "text": session["text"],
+        "created_at": session["created_at"],
+        "updated_at": session["updated_at"],
+    }
+
+class MemorySessionStore:
+    blocking = False
+
+    def __init__(self, max_sessions: int, ttl_seconds: float):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.sessions = OrderedDict()
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        if session["updated_at"] + self.ttl_seconds < time.time():
+            del self.sessions[session_id]
+            return None
+        self.sessions.move_to_end(session_id)
+        return session
+
+    def put(self, session: Dict[str, Any], revision: int) -> bool:
+        # Saved only over the revision it was built from, False when another save got there first
+        current = self.sessions.get(session["id"])
+        if (current["revision"] if current is not None else 0) != revision:
+            return False
+        self.sessions[session["id"]] = session
+        self.sessions.move_to_end(session["id"])
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return True
+
+    def delete(self, session_id: str) -> bool:
+        return self.sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+class SQLiteSessionStore:
+    # One row per session, shared by every worker on the host. Calls can wait on another
+    # process's write lock, so the manager makes them from a thread
+    blocking = True
+
+    def __init__(self, path: str, max_sessions: int, ttl_seconds: float):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.connection = SQLiteDatabase(path, [
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, value BLOB NOT NULL, updated_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)",
+        ])
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, updated_at FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None or row[1] + self.ttl_seconds < time.time():
+            return None
+        return loads(row[0])
+
+    def put(self, session: Dict[str, Any], revision: int) -> bool:
+        # Saved only over the revision it was built from, False when a save in another worker got
+        # there first. IMMEDIATE holds the write lock from the check to the write
+        value = dumps(session)
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT value FROM sessions WHERE id = ?", (session["id"],)).fetchone()
+                if (loads(row[0])["revision"] if row is not None else 0) != revision:
+                    self.connection.execute("ROLLBACK")
+                    return False
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO sessions (id, value, updated_at) VALUES (?, ?, ?)",
+                    (session["id"], value, session["updated_at"])
+                )
+                self.writes += 1
+                if self.writes % 1000 == 0:
+                    self._evict()
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return True
+
+    def _evict(self):
+        self.connection.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl_seconds,))
+        self.connection.execute(
+            "DELETE FROM sessions WHERE id IN ("
+            "SELECT id FROM sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,)
+        )
+
+    def delete(self, session_id: str) -> bool:
+        with self.lock:
+            return self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+class TooManyParagraphs(Exception):
+    pass
+
+class SessionConflict(Exception):
+    pass
+
+class SessionManager:
+    def __init__(self, store, settings: dict):
+        self.store = store
+        self.settings = settings
+        # Saves to one session run one at a time within a worker. Across workers sharing
+        # sqlite_path, a save built on an outdated revision is refused by the store instead.
+        # A lock lives only as long as a save holds or waits on it
+        self.locks = weakref.WeakValueDictionary()
+        self.revisions = 0
+        self.paragraphs_seen = 0
+        self.paragraphs_processed = 0
+
+    def create(self, tenant: str, module: str) -> Dict[str, Any]:
+        return new_session(tenant, module)
+
+    async def _offload(self, function, *args):
+        if self.store.blocking:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return await self._offload(self.store.get, session_id)
+
+    async def delete(self, session_id: str) -> bool:
+        return await self._offload(self.store.delete, session_id)
+
+    async def revise(self, session: Dict[str, Any], text: str, process: Callable[[str], Awaitable[Tuple[str, Any]]]) -> Dict[str, Any]:
+        # process(paragraph) returns the module output for that paragraph and the engine response
+        lock = self.locks.get(session["id"])
+        if lock is None:
+            lock = self.locks[session["id"]] = asyncio.Lock()
+        async with lock:
+            paragraphs = split_paragraphs(text)
+            if len(paragraphs) > self.settings["max_paragraphs"]:
+                raise TooManyParagraphs(f"Documents are limited to {self.settings['max_paragraphs']} paragraphs")
+            stored = await self.get(session["id"]) or session
+            hashes = [paragraph_hash(paragraph) for _, paragraph in paragraphs]
+            outputs = stored["outputs"]
+
+            changes = ["unchanged"] * len(paragraphs)
+            removed = []
+            matcher = difflib.SequenceMatcher(None, stored["hashes"], hashes, autojunk=False)
+            for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+                if tag in ("delete", "replace"):
+                    removed.extend(range(old_start, old_end))
+                for index in range(new_start, new_end):
+                    if tag == "equal":
+                        continue
+                    # A paragraph moved from elsewhere in the document keeps its output
+                    if hashes[index] in outputs:
+                        changes[index] = "moved"
+                    # A replace pairs old and new paragraphs one to one, new ones past the old count were added
+                    elif tag == "replace" and index < new_start + (old_end - old_start):
+                        changes[index] = "changed"
+                    else:
+                        changes[index] = "added"
+
+            pending = {}
+            for index, digest in enumerate(hashes):
+                if digest not in outputs and digest not in pending:
+                    pending[digest] = paragraphs[index][1]
+            limiter = asyncio.Semaphore(self.settings["max_parallel"])
+
+            async def run(paragraph: str):
+                async with limiter:
+                    return await process(paragraph)
+
+            results = await asyncio.gather(*(run(paragraph) for paragraph in pending.values()))
+            # Only outputs the new revision still uses are kept
+            new_outputs = {digest: outputs[digest] for digest in hashes if digest in outputs}
+            responses = []
+            for digest, (output, response) in zip(pending, results):
+                new_outputs[digest] = output
+                responses.append(response)
+
+            merged = "".join(separator + new_outputs[digest].strip() for (separator, _), digest in zip(paragraphs, hashes))
+            updated = {
+                **stored,
+                "revision": stored["revision"] + 1,
+                "hashes": hashes,
+                "outputs": new_outputs,
+                "text": merged,
+                "updated_at": time.time(),
+            }
+            if not await self._offload(self.store.put, updated, stored["revision"]):
+                raise SessionConflict("The session was changed or closed by another save, send the revision again")
+            self.revisions += 1
+            self.paragraphs_seen += len(paragraphs)
+            self.paragraphs_processed += len(pending)
+            return {
+                **session_view(updated),
+                "changes": [{"index": index, "status": status} for index, status in enumerate(changes)],
+                "removed": removed,
+                "processed": len(pending),
+                "usage": {
+                    "input_tokens": sum(response.input_tokens for response in responses),
+                    "output_tokens": sum(response.output_tokens for response in responses),
+                    "cost_in_dollors": sum(response.cost for response in responses),
+                },
+            }
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": await self._offload(len, self.store),
+            "revisions": self.revisions,
+            "paragraphs_seen": self.paragraphs_seen,
+            "paragraphs_processed": self.paragraphs_processed,
+        }
+
+def build_sessions(settings: Optional[dict]) -> Optional[SessionManager]:
+    settings = {**DEFAULT_SESSION_SETTINGS, **(settings or {})}
+    if not settings.get("enabled", False):
+        return None
+    if settings.get("sqlite_path"):
+        directory = os.path.dirname(settings["sqlite_path"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        store = SQLiteSessionStore(settings["sqlite_path"], settings["max_sessions"], settings["ttl_seconds"])
+    else:
+        store = MemorySessionStore(settings["max_sessions"], settings["ttl_seconds"])
+    return SessionManager(store, settings)
@@ -0,0 +1,41 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+class SingleFlight:
+    # Collapses concurrent calls that share a key onto one upstream call
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.waiters = 0
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            # The call runs as its own task so a disconnecting caller does not cancel it for everyone else
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            self.leaders += 1
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+            return await asyncio.shield(task)
+        self.coalesced += 1
+        self.waiters += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters -= 1
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Mark the exception as retrieved even if every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight_keys": len(self.calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "waiters": self.waiters,
+        }
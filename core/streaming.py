@@ -0,0 +1,137 @@
+from typing import Iterable, List, Tuple
+
+from ai.codec import dumps
+
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class IncrementalFieldParser:
+    # Reads a function-call argument object as it streams in and reports the new characters
+    # of the top-level string fields it was asked to watch
+    def __init__(self, fields: Iterable[str]):
+        self.fields = set(fields)
+        self.buffer = ""
+        self.pos = 0
+        self.state = "start"
+        self.key = None
+        self.key_chars = []
+        self.depth = 0
+        self.nested_in_string = False
+        self.nested_escape = False
+        self.values = {}
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        self.buffer += text
+        deltas = []
+        while self.pos < len(self.buffer) and self.state != "done":
+            if self.state in ("key", "string"):
+                if not self._read_string(deltas):
+                    break
+                continue
+            char = self.buffer[self.pos]
+            self.pos += 1
+            if self.state == "start":
+                if char == "{":
+                    self.state = "key_or_end"
+            elif self.state == "key_or_end":
+                if char == '"':
+                    self.state = "key"
+                    self.key_chars = []
+                elif char == "}":
+                    self.state = "done"
+            elif self.state == "colon":
+                if char == ":":
+                    self.state = "value"
+            elif self.state == "value":
+                if char == '"':
+                    self.state = "string"
+                    if self.key in self.fields:
+                        self.values.setdefault(self.key, "")
+                elif char in "{[":
+                    self.state = "nested"
+                    self.depth = 1
+                elif not char.isspace():
+                    self.state = "scalar"
+            elif self.state == "scalar":
+                if char == ",":
+                    self.state = "key_or_end"
+                elif char == "}":
+                    self.state = "done"
+            elif self.state == "nested":
+                self._skip_nested(char)
+        # Drop what has been consumed so the buffer stays small on long outputs
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        return deltas
+
+    def _read_string(self, deltas: List[Tuple[str, str]]) -> bool:
+        chunk = []
+        complete = True
+        while self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if char == '"':
+                self.pos += 1
+                break
+            if char == "\\":
+                decoded, consumed = self._decode_escape(self.pos)
+                if decoded is None:
+                    complete = False
+                    break
+                chunk.append(decoded)
+                self.pos += consumed
+            else:
+                chunk.append(char)
+                self.pos += 1
+        else:
+            complete = False
+        text = "".join(chunk)
+        if self.state == "key":
+            self.key_chars.append(text)
+        elif text and self.key in self.fields:
+            self.values[self.key] += text
+            deltas.append((self.key, text))
+        if not complete:
+            return False
+        if self.state == "key":
+            self.key = "".join(self.key_chars)
+            self.state = "colon"
+        else:
+            self.state = "key_or_end"
+        return True
+
+    def _decode_escape(self, start: int):
+        if start + 1 >= len(self.buffer):
+            return None, 0
+        kind = self.buffer[start + 1]
+        if kind != "u":
+            return ESCAPES.get(kind, kind), 2
+        if start + 6 > len(self.buffer):
+            return None, 0
+        code = int(self.buffer[start + 2:start + 6], 16)
+        if 0xD800 <= code <= 0xDBFF:
+            # High surrogate, wait for its pair
+            if start + 12 > len(self.buffer):
+                return None, 0
+            if self.buffer[start + 6:start + 8] == "\\u":
+                low = int(self.buffer[start + 8:start + 12], 16)
+                return chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)), 12
+        return chr(code), 6
+
+    def _skip_nested(self, char: str):
+        if self.nested_in_string:
+            if self.nested_escape:
+                self.nested_escape = False
+            elif char == "\\":
+                self.nested_escape = True
+            elif char == '"':
+                self.nested_in_string = False
+        elif char == '"':
+            self.nested_in_string = True
+        elif char in "{[":
+            self.depth += 1
+        elif char in "}]":
+            self.depth -= 1
+            if self.depth == 0:
+                self.state = "key_or_end"
+
+def format_sse(event: str, data) -> bytes:
+    return b"event: " + event.encode("ascii") + b"\ndata: " + dumps(data) + b"\n\n"
@@ -0,0 +1,88 @@
+import logging
+import os
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to a character estimate when the tokenizer is not installed
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Context windows by model prefix, longest prefix wins
+CONTEXT_WINDOWS = {
+    "gpt-4.1": 1047576,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o3": 200000,
+    "o4": 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 128000
+
+# Chat formatting overhead per message and for priming the reply, as documented by OpenAI
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+class PromptTooLarge(Exception):
+    pass
+
+def estimate_tokens(text: str) -> int:
+    # Rough English average of four characters per token
+    return max(1, len(text) // 4)
+
+def context_window(model_name: str) -> int:
+    matches = [prefix for prefix in CONTEXT_WINDOWS if model_name.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return CONTEXT_WINDOWS[max(matches, key=len)]
+
+@lru_cache(maxsize=None)
+def load_encoding(model_name: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # No cached BPE file and no network, among others. Counting falls back to the estimate
+        logger.error(f"Could not load the tokenizer for {model_name}, token counts are estimated: {e}")
+        return None
+
+class TokenCounter:
+    def __init__(self, model_name: str, cache_dir: Optional[str] = None):
+        if cache_dir:
+            # tiktoken reads its BPE files from here, so it never has to download at request time
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", cache_dir)
+        self.model_name = model_name
+        self.encoding = load_encoding(model_name)
+        self.context_window = context_window(model_name)
+        # Function schemas are fixed per module, so each one is only tokenized once
+        self._schema_tokens = {}
+
+    def count(self, text: str) -> int:
+        if self.encoding is None:
+            return estimate_tokens(text)
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_schema(self, schema_json: str) -> int:
+        tokens = self._schema_tokens.get(schema_json)
+        if tokens is None:
+            if len(self._schema_tokens) > 4096:
+                # Fused pipeline schemas are built per request, keep them from piling up
+                self._schema_tokens.clear()
+            tokens = self._schema_tokens[schema_json] = self.count(schema_json)
+        return tokens
+
+    def count_prompt(self, messages: list, schema_json: Optional[str] = None) -> int:
+        total = TOKENS_PER_REPLY
+        for message in messages:
+            total += TOKENS_PER_MESSAGE + self.count(message["content"])
+        if schema_json is not None:
+            total += self.count_schema(schema_json)
+        return total
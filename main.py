@@ -1,51 +1,141 @@
 from fastapi import FastAPI 
-from pydantic import BaseModel
+from pydantic import BaseModel, create_model
 from ai.aiclient import *
+from ai.codec import dumps
 from core.modules import *
 from core.engine import *
+from core.cache import build_cache
+from core.local import build_local
+from core.readability import TextCounter, score_counters
+from core.plagiarism import build_plagiarism
+from core.jobs import build_jobs, public_view, InvalidWebhook
+from core.sessions import build_sessions, session_view, SessionConflict, TooManyParagraphs
+from core.admission import build_admission, current_ticket, Overloaded
+from core.streaming import format_sse
+from core.logs import DEFAULT_LOG_SETTINGS, setup_logging, start_request
+from core.ledger import BUCKETS, UsageTally, current_tally, build_ledger
+from core.lifecycle import DEFAULT_SERVER_SETTINGS, Lifecycle
+from core.tokens import PromptTooLarge
+from core.metrics import REGISTRY, HTTP_LATENCY, ERRORS, RequestSpans, current_spans
 from fastapi import Request, HTTPException , Depends
-from typing import Any
-from fastapi.responses import JSONResponse
+from typing import Any, List, Optional
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response as HTTPResponse
+import os
+import time
+import asyncio
+import codecs
 import logging
-from logging.handlers import RotatingFileHandler
 
-# Set up logging with rotation
-log_handler = RotatingFileHandler("app.log", maxBytes=5*1024*1024, backupCount=5)  # 5MB max size, 5 backup files
-log_handler.setLevel(logging.INFO)
-log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-log_handler.setFormatter(log_formatter)
+config = load_config(os.environ.get("APP_CONFIG", "config.json"))
+server_settings = {**DEFAULT_SERVER_SETTINGS, **config.get("server", {})}
+lifecycle = Lifecycle(server_settings["cold_start_target_seconds"])
+
+# JSON lines to a rotating app.log, written by a listener thread so logging never blocks a request
+log_settings = {**DEFAULT_LOG_SETTINGS, **config.get("logging", {})}
+log_pipeline = setup_logging(log_settings)
 logger = logging.getLogger(__name__)
-logger.addHandler(log_handler)
 
-app = FastAPI()
+class FastJSONResponse(JSONResponse):
+    # Rendered with orjson when it is installed, the stdlib encoder otherwise
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
 
-config = load_config('config.json')
+app = FastAPI(default_response_class=FastJSONResponse)
 
 model_name = config.get("model_name")
 open_ai_api_key =  config.get("api_key") # Fetch API key from environment variable
-cost_per_thousand_input = 0.0004
-cost_per_thousand_output = 0.0016
+cost_per_thousand_input = config.get("input_cost_per_1000", 0.0004)
+cost_per_thousand_output = config.get("output_cost_per_1000", 0.0016)
 
 model = Model(model_name, cost_per_thousand_input, cost_per_thousand_output)
-client = AIClient(model, open_ai_api_key)
+# Extra models with their own prices, and which modules should use them instead of the default
+models = {model_name: model}
+for name, costs in config.get("models", {}).items():
+    models[name] = Model(name, costs["input_cost_per_1000"], costs["output_cost_per_1000"])
+module_models = {module: models[name] for module, name in config.get("module_models", {}).items()}
+# Every key is load balanced by the rate-limit headroom the provider reports for it
+api_keys = config.get("api_keys") or [open_ai_api_key]
+client = AIClient(model, open_ai_api_key, config.get("http_pool"), config.get("base_url"), config.get("resilience"), api_keys)
+
+engine = Engine(
+    client,
+    model,
+    max_concurrency=config.get("max_concurrency", 200),
+    cache=build_cache(config.get("cache")),
+    coalesce=config.get("coalesce_requests", True),
+    chunking=config.get("chunking"),
+    max_output_tokens=config.get("max_output_tokens", 4096),
+    tokenizer_cache_dir=config.get("tokenizer_cache_dir"),
+    module_models=module_models,
+    local=build_local(config.get("local_models")),
+    bulk_max_concurrency=config.get("jobs", {}).get("bulk_max_concurrency", 16),
+    admission=build_admission(config.get("admission"), config.get("max_concurrency", 200)),
+    edit_mode=config.get("edit_mode")
+)
+jobs = build_jobs(config.get("jobs"))
+plagiarism_index = build_plagiarism(config.get("plagiarism"))
+sessions = build_sessions(config.get("sessions"))
+ledger = build_ledger(config.get("ledger"))
 
-engine = Engine(client, model)
+def warm_up():
+    # serve.py runs this before forking its workers, so they share what it loads
+    lifecycle.warm_up({
+        "sdk": client.warm_up,
+        "tokenizers": engine.warm_up,
+    })
 
 class TextRequest(BaseModel):
     text: str
     
-class ToneChangeRequest(BaseModel):
-    text: str
-    target_tone: str
-    
 class StyleTransferRequest(BaseModel):
     text: str
     style: str
 
-class TextPersonalizationRequest(BaseModel): 
+class BatchItem(BaseModel):
+    module: str
+    params: dict
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    pack: bool = True
+
+class ReadabilityRequest(BaseModel):
+    text: Optional[str] = None
+    texts: Optional[List[str]] = None
+
+class PlagiarismRequest(BaseModel):
+    text: str
+    max_results: Optional[int] = None
+
+class ReferenceDocument(BaseModel):
+    id: Optional[str] = None
+    title: Optional[str] = None
+    text: str
+
+class ReferenceDocumentsRequest(BaseModel):
+    documents: List[ReferenceDocument]
+
+class PipelineStep(BaseModel):
+    module: str
+    params: dict = {}
+
+class PipelineRequest(BaseModel):
+    text: str
+    steps: List[PipelineStep]
+    fuse: bool = True
+
+class SessionRequest(BaseModel):
+    module: str
     text: str
-    user: str
-    prefrence: str
+
+class RevisionRequest(BaseModel):
+    text: str
+
+class JobRequest(BaseModel):
+    # kind is "module", "batch" or "pipeline", payload is that endpoint's request body
+    kind: str = "module"
+    payload: dict
+    webhook_url: Optional[str] = None
 
 class ResponseModel(BaseModel):
     status: str
@@ -57,140 +147,488 @@ async def check_custom_header(request: Request):
     custom_header = request.headers.get("X-RapidAPI-Proxy-Secret")
     return custom_header    
 
+def tenant_of(request: Request) -> str:
+    # The RapidAPI proxy names the subscriber making the call
+    return request.headers.get("X-RapidAPI-User") or "anonymous"
+
+async def check_admission(request: Request, custom_header: str = Depends(check_custom_header)):
+    # Only on routes that call upstream: admit against the route's tier before any work is done,
+    # so overload is a fast 429/503. Local routes never wait for an upstream slot
+    if engine.admission is not None:
+        route = request.scope.get("route")
+        try:
+            current_ticket.set(engine.admission.admit(engine.admission.tier_for(getattr(route, "tags", None)), tenant_of(request)))
+        except Overloaded as e:
+            raise upstream_http_error(e)
+    return custom_header
+
+def upstream_http_error(e: UpstreamError) -> HTTPException:
+    # 429/503 carry Retry-After so well-behaved clients back off instead of hammering a degraded upstream
+    headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after is not None else None
+    return HTTPException(status_code=e.status_code, detail=str(e), headers=headers)
 
+async def sse_events(module: BaseModule, max_tokens: int):
+    try:
+        async for kind, payload in engine.stream_module(module, max_tokens):
+            if kind == "delta":
+                yield format_sse("delta", payload)
+            else:
+                yield format_sse("done", payload.get_dict())
+    except Exception as e:
+        logger.error(f"Error occurred while streaming: {str(e)}")
+        yield format_sse("error", {"status": "fail", "message": "Internal Server Error"})
+    finally:
+        # The stream outlives the middleware, so its usage is settled once the completion is done
+        tally = current_tally.get()
+        if ledger is not None and tally is not None:
+            ledger.settle(tally)
+
+def stream_response(module: BaseModule):
+    try:
+        max_tokens = engine.budget(module)["max_tokens"]
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    # Server-Sent Events, with proxy buffering disabled so the first tokens reach the client right away
+    return StreamingResponse(
+        sse_events(module, max_tokens),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    spans = RequestSpans()
+    current_spans.set(spans)
+    request_id = start_request(request.headers.get("X-Request-ID"), log_settings["success_sample_rate"])
+    tally = UsageTally(request_id, tenant_of(request))
+    current_tally.set(tally)
+    try:
+        response = await call_next(request)
+    except Exception as e:
+        ERRORS.inc(where="http", type=type(e).__name__)
+        raise
+    finally:
+        # Label by route template rather than raw path to keep the series count bounded
+        tally.route = getattr(request.scope.get("route"), "path", "unmatched")
+        # Totals are read before settling empties the tally, and a request that raised is still billed
+        cost = tally.cost()
+        input_tokens, output_tokens = tally.tokens()
+        if ledger is not None:
+            ledger.settle(tally)
+    if spans.durations:
+        spans.add("serialization", time.perf_counter() - spans.last_end)
+        response.headers["Server-Timing"] = spans.server_timing()
+    response.headers["X-Request-ID"] = request_id
+    route = tally.route
+    elapsed = time.perf_counter() - spans.started
+    HTTP_LATENCY.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    # Only API routes count as the first request served, not health checks and scrapes
+    if getattr(request.scope.get("route"), "tags", None):
+        lifecycle.served(elapsed)
+    # Successful requests are sampled, failures are always logged
+    logger.info("request", extra={"keep": response.status_code >= 400, "fields": {
+        "method": request.method,
+        "route": route,
+        "status": response.status_code,
+        "duration_ms": round(elapsed * 1000, 2),
+        "consumer": tally.consumer,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_in_dollors": cost,
+    }})
+    return response
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
+    ERRORS.inc(where="http", type=f"http_{exc.status_code}")
     logger.error(f"HTTP error: {exc.detail} | Path: {request.url.path}")
     return JSONResponse(
         status_code=exc.status_code,
-        content={"status": "fail", "message": exc.detail}
+        content={"status": "fail", "message": exc.detail},
+        headers=exc.headers
     )
     
+@app.on_event("startup")
+async def start_jobs():
+    if not lifecycle.warm:
+        # Started without serve.py, warm up before the first request is accepted
+        warm_up()
+    jobs.start(run_job)
+    if ledger is not None:
+        ledger.start()
+    lifecycle.serving()
+
+@app.on_event("shutdown")
+async def close_ai_client():
+    lifecycle.draining = True
+    await jobs.stop()
+    await client.aclose()
+    if ledger is not None:
+        ledger.stop()
+    log_pipeline.stop()
+
 @app.get("/ping")
 async def ping(): 
     return JSONResponse(content={"status": "healthy"}, status_code=200)
+
+@app.get("/ready")
+async def ready():
+    # Readiness for load balancers: 503 until warm-up is done and while draining. /ping stays the liveness check
+    return JSONResponse(content=lifecycle.view(), status_code=200 if lifecycle.ready() else 503)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    return JSONResponse(content={
+        **engine.stats(),
+        "jobs": await jobs.stats(),
+        "sessions": await sessions.stats() if sessions is not None else None,
+        "ledger": ledger.stats() if ledger is not None else None,
+    }, status_code=200)
+
+@app.get("/usage", summary="Tokens and cost from the ledger, by time bucket, module and consumer", tags=["Utility Modules"])
+async def usage(http_request: Request, start: Optional[float] = None, end: Optional[float] = None, bucket: str = "hour", group_by: str = "module", consumer: Optional[str] = None, custom_header: str = Depends(check_custom_header)):
+    if ledger is None:
+        raise HTTPException(status_code=503, detail="Cost ledger is not enabled")
+    if bucket not in BUCKETS:
+        raise HTTPException(status_code=422, detail=f"bucket must be one of {', '.join(BUCKETS)}")
+    # Consumers see their own usage, the admin token sees everyone's
+    admin_token = config.get("ledger", {}).get("admin_token")
+    if not admin_token or http_request.headers.get("X-Admin-Token") != admin_token:
+        consumer = tenant_of(http_request)
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 86400
+    rows = await asyncio.to_thread(ledger.query, start, end, bucket, group_by.split(","), consumer)
+    return FastJSONResponse({"status": "success", "message": "Usage computed", "data": {"start": start, "end": end, "bucket": bucket, "rows": rows}})
     
-# MVP modules with ResponseModel
-@app.post("/grammar_assistance", summary="Fix grammar issues in text", tags=["Text Processing"])
-async def grammar_fix(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received grammar fix request.")
-    try:
-        response = engine.run_module(GrammarAssistant(request.text))
-        logger.info(f"Grammar fixed successfully.")
-        return ResponseModel(status="success", message="Grammar fixed successfully", data=response.structured_arguments)
-    except Exception as e:
-        logger.error(f"Error occurred in grammar fix: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+SCHEMA_TYPES = {"string": str, "integer": int, "number": float, "boolean": bool, "array": list, "object": dict}
+
+def module_response_model(module_class):
+    # Typed data for each module, so responses are validated against its function's fields.
+    # The engine coerces model output to these types before it is returned or cached
+    route = module_class.route
+    function = module_class.function
+    fields = {
+        name: (SCHEMA_TYPES.get(spec.get("type"), Any), ...) if name in function.required
+        else (Optional[SCHEMA_TYPES.get(spec.get("type"), Any)], None)
+        for name, spec in function.properties.items()
+    }
+    if route.with_source:
+        fields["source"] = (str, ...)
+    if module_class.edit_module is not None:
+        # Filled in when edit mode is on, the spans of the original text that were changed
+        fields["edits"] = (Optional[List[dict]], None)
+    data_model = create_model(f"{module_class.__name__}Data", **fields)
+    return create_model(f"{module_class.__name__}Response", __base__=ResponseModel, data=(data_model, ...))
+
+def module_request_model(module_class):
+    # Text-only modules share TextRequest, the rest get a body with their extra fields
+    if not module_class.params:
+        return TextRequest
+    names = {param: field for field, param in module_class.route.fields.items()}
+    fields = {names.get(name, name): (str, ...) for name in ("text", *module_class.params)}
+    return create_model(f"{module_class.__name__}Request", **fields)
 
-@app.post("/humanizer", summary="Make text sound more human-like", tags=["Text Processing"])
-async def humanizer(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received humanizer request.")
+def module_endpoint(module_class):
+    # One generic handler per registered module, the body is mapped straight onto its params
+    route = module_class.route
+    name = module_class.__name__
+    field_names = {param: field for field, param in route.fields.items()}
+    fields = [(field_names.get(param, param), param) for param in ("text", *module_class.params)]
+    chunked = module_class.chunk_mode is not None and not module_class.params
+    # Everything in the reply but the data, encoded once, so a cache hit's bytes can be sent as they are
+    envelope = dumps({"status": "success", "message": route.message})[:-1] + b',"data":'
+    passthrough = not route.with_source
+
+    async def run(request, stream: bool = False):
+        logger.info(f"Received {name} request.")
+        params = {param: getattr(request, field) for field, param in fields}
+        if stream:
+            return stream_response(module_class(**params))
+        try:
+            if chunked:
+                response = await engine.run_chunked_async(module_class, params["text"])
+            else:
+                response = await engine.run_module_async(module_class(**params))
+            logger.info(f"{route.message}.")
+            if passthrough and response.cached and response.raw_arguments is not None:
+                return HTTPResponse(envelope + response.raw_arguments + b"}", media_type="application/json")
+            return {"status": "success", "message": route.message, "data": route.extract(response)}
+        except PromptTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except UpstreamError as e:
+            raise upstream_http_error(e)
+        except Exception as e:
+            logger.error(f"Error occurred in {name}: {str(e)}")
+            raise HTTPException(status_code=500, detail="Internal Server Error")
+
+    request_model = module_request_model(module_class)
+    if route.stream:
+        async def endpoint(request: request_model, stream: bool = False, custom_header: str = Depends(check_admission)):
+            return await run(request, stream)
+    else:
+        async def endpoint(request: request_model, custom_header: str = Depends(check_admission)):
+            return await run(request)
+    endpoint.__name__ = name
+    return endpoint
+
+# Module routes (MVP, premium and utility), generated from the module registry
+for module_class in MODULES.values():
+    if module_class.route is not None:
+        route = module_class.route
+        app.post(route.path, summary=route.summary, tags=[route.tag], response_model=module_response_model(module_class))(module_endpoint(module_class))
+
+@app.post("/readability", summary="Score the readability of one text or a batch of texts", tags=["Utility Modules"])
+async def readability(request: ReadabilityRequest, custom_header: str = Depends(check_custom_header)):
+    logger.info(f"Received readability request.")
+    if request.texts is None and request.text is None:
+        raise HTTPException(status_code=422, detail="Either text or texts is required")
+    if request.texts is not None and len(request.texts) > config.get("batch_max_items", 1000):
+        raise HTTPException(status_code=413, detail="Too many texts")
     try:
-        response = engine.run_module(Humanizer(request.text))
-        logger.info(f"Text humanized successfully.")
-        return ResponseModel(status="success", message="Text humanized successfully", data=response.structured_arguments)
+        # Scored locally, off the event loop since large batches are CPU bound
+        if request.texts is not None:
+            data = await asyncio.to_thread(ReadabilityAnalyzer.run_many, request.texts)
+        else:
+            data = await asyncio.to_thread(ReadabilityAnalyzer(request.text).run)
+        logger.info(f"Readability analyzed successfully.")
+        return FastJSONResponse({"status": "success", "message": "Readability analyzed successfully", "data": data})
     except Exception as e:
-        logger.error(f"Error occurred in humanizer: {str(e)}")
+        logger.error(f"Error occurred in readability analysis: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-@app.post("/summarizer", summary="Summarize a given text", tags=["Text Processing"])
-async def summarizer(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received summarizer request.")
+@app.post("/readability/stream", summary="Score the readability of a large plain-text body as it uploads", tags=["Utility Modules"])
+async def readability_stream(request: Request, custom_header: str = Depends(check_custom_header)):
+    logger.info(f"Received streaming readability request.")
+    counter = TextCounter()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
     try:
-        response = engine.run_module(Summarizer(request.text))
-        logger.info(f"Text summarized successfully.")
-        return ResponseModel(status="success", message="Text summarized successfully", data=response.structured_arguments)
+        async for chunk in request.stream():
+            counter.feed(decoder.decode(chunk))
+        counter.feed(decoder.decode(b"", final=True))
+        data = score_counters([counter.close()])[0]
+        logger.info(f"Readability analyzed successfully.")
+        return ResponseModel(status="success", message="Readability analyzed successfully", data=data)
     except Exception as e:
-        logger.error(f"Error occurred in summarizer: {str(e)}")
+        logger.error(f"Error occurred in readability analysis: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-@app.post("/tonechange", summary="Change the tone of a given text", tags=["Text Processing"])
-async def tone_change(request: ToneChangeRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received tone change request.")
+@app.post("/plagiarism", summary="Find indexed reference documents that overlap a text", tags=["Utility Modules"])
+async def plagiarism(request: PlagiarismRequest, custom_header: str = Depends(check_custom_header)):
+    logger.info(f"Received plagiarism check request.")
+    if plagiarism_index is None:
+        raise HTTPException(status_code=503, detail="Plagiarism index is not configured")
     try:
-        response = engine.run_module(ToneChange(request.text , request.target_tone))
-        logger.info(f"Tone changed successfully.")
-        return ResponseModel(status="success", message="Tone changed successfully", data=response.structured_arguments)
+        data = await asyncio.to_thread(PlagiarismChecker(request.text).run, plagiarism_index, request.max_results)
+        logger.info(f"Plagiarism check completed.")
+        return ResponseModel(status="success", message="Plagiarism check completed", data=data)
     except Exception as e:
-        logger.error(f"Error occurred in tone change: {str(e)}")
+        logger.error(f"Error occurred in plagiarism check: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-# Premium Modules with ResponseModel
-@app.post("/contentexpander", summary="Expand the content of a text", tags=["Premium Modules"])
-async def content_expander(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received content expander request.")
+@app.post("/plagiarism/documents", summary="Add reference documents to the plagiarism index", tags=["Utility Modules"])
+async def plagiarism_documents(request: ReferenceDocumentsRequest, custom_header: str = Depends(check_custom_header)):
+    logger.info(f"Received {len(request.documents)} reference documents.")
+    if plagiarism_index is None:
+        raise HTTPException(status_code=503, detail="Plagiarism index is not configured")
+    if len(request.documents) > config.get("batch_max_items", 1000):
+        raise HTTPException(status_code=413, detail="Too many documents")
     try:
-        response = engine.run_module(ContentExpander(request.text))
-        logger.info(f"Content expanded successfully.")
-        return ResponseModel(status="success", message="Content expanded successfully", data=response.structured_arguments)
+        data = await asyncio.to_thread(plagiarism_index.add, [document.dict() for document in request.documents])
+        logger.info(f"Reference documents indexed.")
+        return ResponseModel(status="success", message="Reference documents indexed", data=data)
     except Exception as e:
-        logger.error(f"Error occurred in content expander: {str(e)}")
+        logger.error(f"Error occurred while indexing reference documents: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-@app.post("/textrewriting", summary="Rewrite a given text", tags=["Premium Modules"])
-async def text_rewriting(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received text rewriting request.")
+@app.post("/pipeline", summary="Run several modules on one text, fused into as few completions as possible", tags=["Batch"])
+async def pipeline(request: PipelineRequest, custom_header: str = Depends(check_admission)):
+    logger.info(f"Received pipeline request with {len(request.steps)} steps.")
+    if not request.steps:
+        raise HTTPException(status_code=422, detail="At least one step is required")
+    if len(request.steps) > config.get("pipeline_max_steps", 10):
+        raise HTTPException(status_code=413, detail="Too many pipeline steps")
+    unknown = [step.module for step in request.steps if step.module not in MODULES]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown modules: {', '.join(unknown)}")
     try:
-        response = engine.run_module(TextRewriting(request.text))
-        logger.info(f"Text rewritten successfully.")
-        return ResponseModel(status="success", message="Text rewritten successfully", data=response.structured_arguments)
+        results, text, usage = await engine.run_pipeline_async(request.text, [(step.module, step.params) for step in request.steps], request.fuse)
+        logger.info(f"Pipeline processed successfully.")
+        return FastJSONResponse({"status": "success", "message": "Pipeline processed successfully", "data": {"steps": results, "text": text, "usage": usage}})
+    except TypeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid params: {e}")
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UpstreamError as e:
+        raise upstream_http_error(e)
     except Exception as e:
-        logger.error(f"Error occurred in text rewriting: {str(e)}")
+        logger.error(f"Error occurred in pipeline: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-@app.post("/keywordoptimizer", summary="Optimize keywords in a given text", tags=["Premium Modules"])
-async def keyword_optimizer(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received keyword optimizer request.")
+async def owned_session(session_id: str, http_request: Request) -> dict:
+    if sessions is None:
+        raise HTTPException(status_code=503, detail="Document sessions are not enabled")
+    session = await sessions.get(session_id)
+    # Other tenants' sessions look the same as missing ones
+    if session is None or session["tenant"] != tenant_of(http_request):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+async def revise_session(session: dict, text: str):
+    module_class = MODULES[session["module"]]
+    field = module_class.function.required[0]
+
+    async def process(paragraph: str):
+        response = await engine.run_chunked_async(module_class, paragraph)
+        return response.structured_arguments[field], response
+
     try:
-        response = engine.run_module(KeywordOptimizer(request.text))
-        logger.info(f"Keywords optimized successfully.")
-        return ResponseModel(status="success", message="Keywords optimized successfully", data=response.structured_arguments)
+        data = await sessions.revise(session, text, process)
+        logger.info(f"Session revision processed successfully.")
+        return FastJSONResponse({"status": "success", "message": "Revision processed successfully", "data": data})
+    except TooManyParagraphs as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except SessionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UpstreamError as e:
+        raise upstream_http_error(e)
     except Exception as e:
-        logger.error(f"Error occurred in keyword optimizer: {str(e)}")
+        logger.error(f"Error occurred in session revision: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-@app.post("/textpersonalization", summary="Personalize text for a user", tags=["Premium Modules"])
-async def text_personalization(request: TextPersonalizationRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received text personalization request.")
+@app.post("/sessions", summary="Open a document session and process its first revision", tags=["Sessions"])
+async def create_session(request: SessionRequest, http_request: Request, custom_header: str = Depends(check_admission)):
+    logger.info(f"Received session request for {request.module}.")
+    if sessions is None:
+        raise HTTPException(status_code=503, detail="Document sessions are not enabled")
+    module_class = MODULES.get(request.module)
+    # Only modules whose output can be stitched back together paragraph by paragraph
+    if module_class is None or module_class.chunk_mode != "stitch":
+        raise HTTPException(status_code=422, detail=f"Module '{request.module}' does not support sessions")
+    return await revise_session(sessions.create(tenant_of(http_request), request.module), request.text)
+
+@app.put("/sessions/{session_id}", summary="Process a new revision, re-running only changed paragraphs", tags=["Sessions"])
+async def update_session(session_id: str, request: RevisionRequest, http_request: Request, custom_header: str = Depends(check_admission)):
+    logger.info(f"Received session revision.")
+    return await revise_session(await owned_session(session_id, http_request), request.text)
+
+@app.get("/sessions/{session_id}", summary="Latest processed revision of a document session", tags=["Sessions"])
+async def get_session(session_id: str, http_request: Request, custom_header: str = Depends(check_custom_header)):
+    session = await owned_session(session_id, http_request)
+    return ResponseModel(status="success", message=f"Session at revision {session['revision']}", data=session_view(session))
+
+@app.delete("/sessions/{session_id}", summary="Close a document session", tags=["Sessions"])
+async def delete_session(session_id: str, http_request: Request, custom_header: str = Depends(check_custom_header)):
+    await owned_session(session_id, http_request)
+    await sessions.delete(session_id)
+    return ResponseModel(status="success", message="Session closed", data=None)
+
+JOB_REQUESTS = {"module": BatchItem, "batch": BatchRequest, "pipeline": PipelineRequest}
+
+async def run_job(job: dict):
+    # Runs in a job worker, whose upstream calls use the engine's bulk lane
+    current_lane.set("bulk")
+    tally = UsageTally(job["id"], job["tenant"], f"job:{job['kind']}")
+    current_tally.set(tally)
     try:
-        response = engine.run_module(TextPersonalization(request.text, request.user, request.prefrence))  
-        logger.info(f"Text personalized successfully.")
-        return ResponseModel(status="success", message="Text personalized successfully", data=response.structured_arguments)
-    except Exception as e:
-        logger.error(f"Error occurred in text personalization: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        return await execute_job(job)
+    finally:
+        if ledger is not None:
+            ledger.settle(tally)
+
+async def execute_job(job: dict):
+    request = JOB_REQUESTS[job["kind"]](**job["payload"])
+    if job["kind"] == "module":
+        module_class = MODULES[request.module]
+        if module_class.chunk_mode is not None and set(request.params) == {"text"}:
+            response = await engine.run_chunked_async(module_class, request.params["text"])
+        else:
+            response = await engine.run_module_async(module_class(**request.params))
+        return response.get_dict()
+    if job["kind"] == "batch":
+        results, usage = await engine.run_batch_async(
+            [(item.module, item.params) for item in request.items],
+            config.get("batch_max_parallel", 16),
+            config.get("batch_pack_size", 20),
+            request.pack
+        )
+        return {"results": results, "usage": usage}
+    results, text, usage = await engine.run_pipeline_async(request.text, [(step.module, step.params) for step in request.steps], request.fuse)
+    return {"steps": results, "text": text, "usage": usage}
 
-# Utility Modules API with ResponseModel
-@app.post("/languagedetection", summary="Detect the language of a given text", tags=["Utility Modules"])
-async def language_detection(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received language detection request.")
+@app.post("/jobs", status_code=202, summary="Queue a module, batch or pipeline call and return a job id at once", tags=["Jobs"])
+async def submit_job(request: JobRequest, http_request: Request, custom_header: str = Depends(check_custom_header)):
+    logger.info(f"Received {request.kind} job.")
+    model = JOB_REQUESTS.get(request.kind)
+    if model is None:
+        raise HTTPException(status_code=422, detail=f"Unknown job kind '{request.kind}'")
+    # Reject bad payloads now rather than in a failed job later
     try:
-        response = engine.run_module(LanguageDetection(request.text))
-        logger.info(f"Language detected successfully.")
-        return ResponseModel(status="success", message="Language detected successfully", data=response.structured_arguments)
-    except Exception as e:
-        logger.error(f"Error occurred in language detection: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        payload = model(**request.payload)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid payload: {e}")
+    if request.kind == "module":
+        modules = [payload.module]
+    elif request.kind == "batch":
+        if len(payload.items) > config.get("batch_max_items", 1000):
+            raise HTTPException(status_code=413, detail="Too many batch items")
+        modules = []
+    else:
+        modules = [step.module for step in payload.steps]
+    unknown = [name for name in modules if name not in MODULES]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown modules: {', '.join(unknown)}")
+    try:
+        job = await jobs.submit(tenant_of(http_request), request.kind, request.payload, request.webhook_url)
+    except InvalidWebhook as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return ResponseModel(status="success", message="Job queued", data=public_view(job))
+
+@app.get("/jobs/{job_id}", summary="Status and result of a queued job", tags=["Jobs"])
+async def get_job(job_id: str, http_request: Request, custom_header: str = Depends(check_custom_header)):
+    job = await jobs.get(job_id)
+    # Other tenants' jobs look the same as missing ones
+    if job is None or job["tenant"] != tenant_of(http_request):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return FastJSONResponse({"status": "success", "message": f"Job {job['status']}", "data": public_view(job)})
 
-@app.post("/sentimentanalysis", summary="Analyze the sentiment of a text", tags=["Utility Modules"])
-async def sentiment_analysis(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received sentiment analysis request.")
+@app.post("/estimate", summary="Estimate tokens and cost before running a module", tags=["Utility Modules"])
+async def estimate(request: BatchItem, custom_header: str = Depends(check_custom_header)):
+    module_class = MODULES.get(request.module)
+    if module_class is None:
+        raise HTTPException(status_code=404, detail=f"Unknown module '{request.module}'")
     try:
-        response = engine.run_module(SentimentAnalysis(request.text))
-        logger.info(f"Sentiment analysis completed.")
-        return ResponseModel(status="success", message="Sentiment analysis completed", data=response.structured_arguments)
-    except Exception as e:
-        logger.error(f"Error occurred in sentiment analysis: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        return ResponseModel(status="success", message="Estimate computed", data=engine.estimate(module_class, request.params))
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except TypeError as e:
+        raise HTTPException(status_code=422, detail=f"Invalid params: {e}")
 
-@app.post("/emotionrecognition", summary="Recognize emotions from text", tags=["Utility Modules"])
-async def emotion_recognition(request: TextRequest, custom_header: str = Depends(check_custom_header)):
-    logger.info(f"Received emotion recognition request.")
+# Batch API
+@app.post("/batch", summary="Run many module calls in one request", tags=["Batch"])
+async def batch(request: BatchRequest, custom_header: str = Depends(check_admission)):
+    logger.info(f"Received batch request with {len(request.items)} items.")
+    if len(request.items) > config.get("batch_max_items", 1000):
+        raise HTTPException(status_code=413, detail="Too many batch items")
     try:
-        response = engine.run_module(EmotionRecognition(request.text))
-        logger.info(f"Emotion recognized successfully.")
-        return ResponseModel(status="success", message="Emotion recognized successfully", data=response.structured_arguments)
+        results, usage = await engine.run_batch_async(
+            [(item.module, item.params) for item in request.items],
+            config.get("batch_max_parallel", 16),
+            config.get("batch_pack_size", 20),
+            request.pack
+        )
+        logger.info(f"Batch processed successfully.")
+        # Plain dicts straight to the encoder, large batches skip FastAPI's field-by-field conversion
+        return FastJSONResponse({"status": "success", "message": "Batch processed successfully", "data": {"results": results, "usage": usage}})
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except UpstreamError as e:
+        raise upstream_http_error(e)
     except Exception as e:
-        logger.error(f"Error occurred in emotion recognition: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
\ No newline at end of file
+        logger.error(f"Error occurred in batch: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
@@ -0,0 +1,135 @@
+import os
+import time
+
+# Stamped before anything heavy is imported, so the imports count towards cold start
+os.environ.setdefault("APP_STARTED_AT", repr(time.time()))
+
+import argparse
+import gc
+import logging
+import signal
+import socket
+from typing import Set
+
+logger = logging.getLogger(__name__)
+
+# Pre-fork launcher: imports the app once, warms it up, then forks the workers from that process
+# so tokenizers, compiled schemas, response models and the plagiarism index are shared
+# copy-on-write instead of being built again in every worker.
+#
+#   python serve.py --workers 4 --port 8000
+#
+# SIGTERM or SIGINT drains: each worker fails /ready, stops accepting, finishes its in-flight
+# requests for up to graceful_timeout seconds and runs its shutdown hooks. Workers that exit on
+# their own are replaced.
+
+def bind(host: str, port: int, backlog: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def run_worker(application, sock: socket.socket, graceful_timeout: float, log_level: str):
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        def handle_exit(self, sig, frame):
+            # Fail readiness first, so the load balancer stops sending while requests drain
+            application.lifecycle.draining = True
+            super().handle_exit(sig, frame)
+
+    config = uvicorn.Config(application.app, lifespan="on", log_level=log_level, timeout_graceful_shutdown=graceful_timeout)
+    DrainingServer(config).run(sockets=[sock])
+
+def spawn(application, sock: socket.socket, graceful_timeout: float, log_level: str, respawn: bool = False) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    # Own process group, so a Ctrl-C in the terminal reaches the workers only through the launcher
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if respawn:
+        # A replacement starts from the warm launcher, its cold start is only its own startup
+        application.lifecycle.started_at = time.time()
+    code = 0
+    try:
+        run_worker(application, sock, graceful_timeout, log_level)
+    except BaseException as e:
+        # The shutdown hooks may have stopped this worker's log listener already
+        application.log_pipeline.start()
+        logger.error(f"worker {os.getpid()} failed: {type(e).__name__}: {e}")
+        code = 1
+    finally:
+        # os._exit skips interpreter cleanup, so the queued log lines are written out first
+        application.log_pipeline.stop()
+        os._exit(code)
+
+def supervise(application, sock: socket.socket, count: int, graceful_timeout: float, log_level: str):
+    workers: Set[int] = {spawn(application, sock, graceful_timeout, log_level) for _ in range(count)}
+    logger.info("workers started", extra={"keep": True, "fields": {"workers": sorted(workers), "address": list(sock.getsockname()[:2])}})
+    stopping = []
+    announced = False
+
+    def stop(signum, frame):
+        # No logging in here: a signal landing while the main loop is mid log call would block
+        # on the log queue's lock, which that call is holding
+        if not stopping:
+            stopping.append(time.monotonic())
+            stopping.append(signum)
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while workers:
+        if stopping and not announced:
+            announced = True
+            logger.info("draining workers", extra={"keep": True, "fields": {"signal": signal.Signals(stopping[1]).name, "workers": sorted(workers)}})
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping and time.monotonic() > stopping[0] + graceful_timeout + 5:
+                # Past the drain deadline, whatever is left is stuck
+                for pid in workers:
+                    os.kill(pid, signal.SIGKILL)
+            time.sleep(0.2)
+            continue
+        workers.discard(pid)
+        if not stopping:
+            logger.warning("worker exited, starting a new one", extra={"fields": {"pid": pid, "exit_code": os.waitstatus_to_exitcode(status)}})
+            time.sleep(1)
+            workers.add(spawn(application, sock, graceful_timeout, log_level, respawn=True))
+    logger.info("all workers stopped", extra={"keep": True})
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-fork launcher for the API")
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--workers", type=int, help="worker processes, default server.workers in the config")
+    parser.add_argument("--graceful-timeout", type=float)
+    parser.add_argument("--log-level", default="warning", help="uvicorn's own log level")
+    args = parser.parse_args()
+
+    # Builds every shared object: clients, engine, modules, indexes and stores
+    import main as application
+
+    settings = application.server_settings
+    host = args.host or settings["host"]
+    port = args.port if args.port is not None else settings["port"]
+    count = args.workers or settings["workers"] or os.cpu_count() or 1
+    graceful_timeout = args.graceful_timeout if args.graceful_timeout is not None else settings["graceful_timeout"]
+
+    application.warm_up()
+    lifecycle = application.lifecycle
+    logger.info("warm", extra={"keep": True, "fields": {"warm_seconds": round(lifecycle.warmed_at - lifecycle.started_at, 3), "warm_steps": lifecycle.warm_steps}})
+    sock = bind(host, port, settings["backlog"])
+    # Everything allocated so far stays out of the collector's reach, so collections in the
+    # workers do not write to the shared pages and copy them
+    gc.collect()
+    gc.freeze()
+    supervise(application, sock, count, graceful_timeout, log_level=args.log_level)
+    application.log_pipeline.stop()
+
+if __name__ == "__main__":
+    main()
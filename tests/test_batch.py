@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from ai.aiclient import Model
+from core.engine import Engine
+from core.local import LocalClassifiers
+
+class UnreachableClient:
+    model = Model("gpt-4o-mini", 0.00015, 0.0006)
+
+    async def chat_async(self, *args, **kwargs):
+        raise AssertionError("the upstream should not be called")
+
+def test_non_string_text_fails_only_its_own_item():
+    engine = Engine(UnreachableClient(), UnreachableClient.model, local=LocalClassifiers())
+    items = [
+        ("SentimentAnalysis", {"text": "I love this, it is wonderful and great!"}),
+        ("SentimentAnalysis", {"text": 123}),
+        ("LanguageDetection", {"text": None}),
+    ]
+    results, usage = asyncio.run(engine.run_batch_async(items))
+
+    assert results[0]["status"] == "success"
+    assert results[0]["source"] == "local"
+    assert results[1]["status"] == "fail"
+    assert results[2]["status"] == "fail"
@@ -0,0 +1,10 @@
+from core.modules import MODULES
+
+def test_loosely_typed_output_is_coerced_to_the_schema():
+    function = MODULES["SentimentAnalysis"].function
+    assert function.conform({"sentiment": "positive", "confidence": 8}) == {"sentiment": "positive", "confidence": "8"}
+
+def test_output_missing_a_required_field_is_rejected():
+    function = MODULES["SentimentAnalysis"].function
+    assert function.conform({"confidence": "8"}) is None
+    assert function.conform({"sentiment": ["positive"], "confidence": "8"}) is None
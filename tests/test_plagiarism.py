@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from core.plagiarism import PlagiarismIndex
+
+FIRST = "The quick brown fox jumps over the lazy dog while the farmer watches from the old red barn."
+SECOND = "Sailing across the northern sea takes patience, warm clothes and a reliable compass on board."
+
+def test_documents_added_by_another_worker_are_not_skipped(tmp_path):
+    # Two instances on one directory stand in for two workers
+    a = PlagiarismIndex(str(tmp_path), {"refresh_seconds": 3600})
+    b = PlagiarismIndex(str(tmp_path), {"refresh_seconds": 3600})
+    b.add([{"id": "d1", "text": FIRST}])
+    a.add([{"id": "d2", "text": SECOND}])
+
+    assert [match["document_id"] for match in a.search(FIRST)["matches"]] == ["d1"]
+
+    a.compact()
+    fresh = PlagiarismIndex(str(tmp_path), {"refresh_seconds": 3600})
+    assert fresh.stats()["segment_documents"] == 2
+    assert [match["document_id"] for match in fresh.search(FIRST)["matches"]] == ["d1"]
+    assert [match["document_id"] for match in fresh.search(SECOND)["matches"]] == ["d2"]